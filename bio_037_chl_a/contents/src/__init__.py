@@ -36,6 +36,10 @@ NODATA_VALUE = -32767.0
 # name of data directory in Docker container
 DATA_DIR = 'data'
 
+# creation options of the COGs we upload, see COG_OPTIONS in utils/rasterUtils.py
+COG_OPTIONS = ['-of', 'COG', '-co', 'COMPRESS=DEFLATE', '-co', 'PREDICTOR=YES', '-co', 'BLOCKSIZE=512',
+               '-co', 'NUM_THREADS=ALL_CPUS']
+
 # name of folder to store data in Google Cloud Storage
 GS_FOLDER = 'bio_037_chl_a'
 
@@ -318,8 +322,8 @@ def convert(files):
         sds_path = SDS_NAME.format(fname=f)
         # generate a name to save the tif file we will translate the netcdf file into
         tif = '{}.tif'.format(os.path.splitext(f)[0])
-        # translate the netcdf into a tif
-        cmd = ['gdal_translate','-q', '-a_nodata', str(NODATA_VALUE), '-a_srs', 'EPSG:4326', sds_path, tif] 
+        # translate the netcdf into a cloud-optimized tif
+        cmd = ['gdal_translate','-q', '-a_nodata', str(NODATA_VALUE), '-a_srs', 'EPSG:4326'] + COG_OPTIONS + [sds_path, tif]
         logging.debug('Converting {} to {}'.format(f, tif))
         # use subprocess to use gdal_translate in the command line from inside python
         subprocess.call(cmd) 
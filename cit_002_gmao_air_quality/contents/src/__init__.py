@@ -58,6 +58,11 @@ NODATA_VALUE = 9.9999999E14
 # name of data directory in Docker container
 DATA_DIR = 'data'
 
+# creation options for the daily tifs we upload; gdal_calc.py can't write a Cloud-Optimized GeoTIFF,
+# so it writes an internally tiled, compressed GeoTIFF in the same single pass instead
+# (codec and tile size are set per dataset, PREDICTOR=3 as the data are floats)
+CALC_OPTIONS = '--co TILED=YES --co BLOCKXSIZE=256 --co BLOCKYSIZE=256 --co COMPRESS=DEFLATE --co PREDICTOR=3'
+
 # name of collection in GEE where we will upload the final data
 COLLECTION = '/projects/resource-watch-gee/cit_002_gmao_air_quality'
 # generate name for dataset's parent folder on GEE which will be used to store
@@ -505,7 +510,7 @@ def daily_avg(date, var, period, tifs_for_date):
     # generate a file name for the daily average tif
     result_tif = DATA_DIR+'/'+FILENAME.format(period=period, metric=METRIC_BY_COMPOUND[var], var=var, date=date)+'.tif'
     # create the gdal command to calculate the average by putting it all together
-    cmd = ('gdal_calc.py {} --outfile="{}" {}').format(' '.join(gdal_tif_list), result_tif, calc)
+    cmd = ('gdal_calc.py {} --outfile="{}" {} {}').format(' '.join(gdal_tif_list), result_tif, calc, CALC_OPTIONS)
     # using gdal from command line from inside python
     subprocess.check_output(cmd, shell=True)
     return result_tif
@@ -543,7 +548,7 @@ def daily_max(date, var, period, tifs_for_date):
     #generate a file name for the daily maximum tif
     result_tif = DATA_DIR+'/'+FILENAME.format(period=period, metric=METRIC_BY_COMPOUND[var], var=var, date=date)+'.tif'
     # create the gdal command to calculate the maximum by putting it all together
-    cmd = ('gdal_calc.py {} --outfile="{}" {}').format(' '.join(gdal_tif_list), result_tif, calc)
+    cmd = ('gdal_calc.py {} --outfile="{}" {} {}').format(' '.join(gdal_tif_list), result_tif, calc, CALC_OPTIONS)
     # using gdal from command line from inside python
     subprocess.check_output(cmd, shell=True)
     return result_tif
@@ -28,6 +28,10 @@ SOURCE_FILENAME = '{N_or_S}_{date}_extent_v3.0.tif'
 # name of data directory in Docker container
 DATA_DIR = 'data'
 
+# creation options of the COGs we upload, see COG_OPTIONS in utils/rasterUtils.py
+COG_OPTIONS = ['-of', 'COG', '-co', 'COMPRESS=DEFLATE', '-co', 'PREDICTOR=YES', '-co', 'BLOCKSIZE=256',
+               '-co', 'NUM_THREADS=ALL_CPUS']
+
 # name of folder to store data in Google Cloud Storage
 GS_FOLDER = 'cli_005_polar_sea_ice_extent'
 
@@ -379,27 +383,15 @@ def reproject(filename, s_srs='EPSG:4326', extent='-180 -89.75 180 89.75'):
             extent: extent of output file to be created (string)
     RETURN  new_filename: name of reprojected tif file (string)
     '''
-    # create a filename to save the reprojected tif file under
-    tmp_filename = ''.join(['reprojected_',filename])
-    # reproject the data
-    cmd = ' '.join(['gdalwarp','-overwrite','-s_srs',s_srs,'-t_srs','EPSG:4326',
-                    '-te',extent,'-multi','-wo','NUM_THREADS=val/ALL_CPUS',
-                    os.path.join(DATA_DIR, filename),
-                    os.path.join(DATA_DIR, tmp_filename)])
-    subprocess.check_output(cmd, shell=True)
-
-    # create a filename to save compressed data under
+    # create a filename to save the reprojected, compressed data under
     new_filename = ''.join(['compressed_reprojected_',filename])
-    # compress the data
-    cmd = ' '.join(['gdal_translate','-co','COMPRESS=LZW','-stats',
-                    os.path.join(DATA_DIR, tmp_filename),
+    # reproject the data straight into a cloud-optimized tif, so it is compressed in the same pass
+    cmd = ' '.join(['gdalwarp','-overwrite','-s_srs',s_srs,'-t_srs','EPSG:4326',
+                    '-te',extent,'-multi','-wo','NUM_THREADS=val/ALL_CPUS'] + COG_OPTIONS +
+                   [os.path.join(DATA_DIR, filename),
                     os.path.join(DATA_DIR, new_filename)])
     subprocess.check_output(cmd, shell=True)
 
-    # remove the intermediary files that we don't need anymore
-    os.remove(os.path.join(DATA_DIR, tmp_filename))
-    os.remove(os.path.join(DATA_DIR, tmp_filename+'.aux.xml'))
-
     logging.debug('Reprojected {} to {}'.format(filename, new_filename))
     return new_filename
 
@@ -5,10 +5,10 @@ import sys
 import urllib.request
 import datetime
 import logging
-import subprocess
 import eeUtil
 from netCDF4 import Dataset
 import rasterio as rio
+import rasterio.shutil
 from collections import defaultdict
 import requests
 import time
@@ -37,6 +37,9 @@ COLLECTION_NAMES = {
 # name of data directory in Docker container
 DATA_DIR = 'data'
 
+# creation options of the COGs we upload, see COG_OPTIONS in utils/rasterUtils.py
+COG_OPTIONS = {'compress': 'ZSTD', 'predictor': 'YES', 'blocksize': 512, 'num_threads': 'ALL_CPUS'}
+
 # do you want to delete everything currently in the GEE collection when you run this script?
 CLEAR_COLLECTION_FIRST = False
 
@@ -306,7 +309,7 @@ def fetch(date):
 
 def convert(nc_file, var, collection, date):
     '''
-    convert variable in netcdf file to compressed tif file
+    convert variable in netcdf file to a cloud-optimized tif file
     INPUT   nc_file: file location of netcdf we are converting to a tif (string)
             var: variable we are converting to tif (string)
             collection: GEE collection where this file will be uploaded (string)
@@ -317,8 +320,6 @@ def convert(nc_file, var, collection, date):
     logging.info('Extracting subdata')
     # open netcdf file
     nc = Dataset(nc_file)
-    # generate a file name for the tif file we will extract
-    extracted_var_tif = '{}_{}.tif'.format(os.path.splitext(nc_file)[0], var)
     # extract data
     data = nc[var][:, :]
     # create a copy of the data
@@ -345,22 +346,18 @@ def convert(nc_file, var, collection, date):
         'transform': transform,
         'nodata': nc[var]._FillValue
     }
-    # write the tif file
-    with rio.open(extracted_var_tif, 'w', **profile) as dst:
-        dst.write(outdata.astype(rio.float32), 1)
+    # generate a file name to use for the tif file we will create
+    new_file = os.path.join(DATA_DIR, '{}.tif'.format(FILENAME.format(collection = collection, date = date)))
+    logging.info('Writing {}'.format(new_file))
+    # the COG driver can only copy an existing dataset, so build the tif in memory and
+    # write it out compressed, tiled and with overviews, without an intermediate file
+    with rio.MemoryFile() as memfile:
+        with memfile.open(**profile) as mem:
+            mem.write(outdata.astype(rio.float32), 1)
+            rio.shutil.copy(mem, new_file, driver='COG', **COG_OPTIONS)
     # delete the netcdf variable
     del nc
 
-    logging.info('Compressing')
-    # generate a file name to use for the compressed tif file we will create
-    new_file = os.path.join(DATA_DIR, '{}.tif'.format(FILENAME.format(collection = collection, date = date)))
-    # compress tif file
-    cmd = ['gdal_translate','-co','COMPRESS=LZW','-of','GTiff', extracted_var_tif, new_file]
-    subprocess.call(cmd)
-
-    # delete uncompressed tif file
-    os.remove(extracted_var_tif)
-
     logging.info('Converted {} to {}'.format(nc_file, new_file))
     return new_file
 
@@ -31,6 +31,10 @@ NODATA_VALUE = None
 # name of data directory in Docker container
 DATA_DIR = 'data'
 
+# creation options of the COGs we upload, see COG_OPTIONS in utils/rasterUtils.py
+COG_OPTIONS = ['-of', 'COG', '-co', 'COMPRESS=ZSTD', '-co', 'PREDICTOR=YES', '-co', 'BLOCKSIZE=512',
+               '-co', 'NUM_THREADS=ALL_CPUS']
+
 # name of folder to store data in Google Cloud Storage
 GS_FOLDER = 'for_012_fire_risk'
 
@@ -288,25 +292,22 @@ def convert(files):
     tifs = []
     # go through each netcdf file and translate
     for f in files:
-        # create an empty list to store the names of the tifs we generate from this netcdf file
-        band_tifs = []
-        # go through each variables to process in this netcdf file
-        for sds_name in SDS_NAMES:
-            # extract subdataset by name
-            sds_path = sds_name.format(fname=f)
-            # generate a name to save the tif file we will translate the netcdf file's subdataset into
-            band_tif = '{}_{}.tif'.format(os.path.splitext(f)[0], sds_name.split('_')[-1]) 
-            # translate the netcdf file's subdataset into a tif
-            cmd = ['gdal_translate','-q', '-a_nodata', str(NODATA_VALUE), '-a_srs', 'EPSG:4326', sds_path, band_tif] 
-            logging.debug('Converting {} to {}'.format(f, band_tif))
-            subprocess.call(cmd)
-            # add the new subdataset tif files to the list of tifs generated from this netcdf file
-            band_tifs.append(band_tif)
-        # generate a name to save the tif file that will be produced by merging all the sub tifs from this netcdf   
-        merged_tif = '{}.tif'.format(os.path.splitext(f)[0])  
-        # merge all the sub tifs from this netcdf to create an overall tif representing all variables
-        merge_cmd = ['gdal_merge.py', '-seperate'] + band_tifs + ['-o', merged_tif]
-        subprocess.call(merge_cmd)
+        # extract the subdatasets of all variables to process in this netcdf file
+        sds_paths = [sds_name.format(fname=f) for sds_name in SDS_NAMES]
+        # generate a name to save a virtual raster stacking the subdatasets as separate bands
+        # (a small xml file, so no pixels are copied until we write the final tif)
+        merged_vrt = '{}.vrt'.format(os.path.splitext(f)[0])
+        cmd = ['gdalbuildvrt', '-q', '-separate', merged_vrt] + sds_paths
+        logging.debug('Stacking {} into {}'.format(f, merged_vrt))
+        subprocess.call(cmd)
+        # generate a name to save the tif file that will be produced by merging all the subdatasets from this netcdf
+        merged_tif = '{}.tif'.format(os.path.splitext(f)[0])
+        # translate the stack into a cloud-optimized tif representing all variables, in a single write
+        cmd = ['gdal_translate', '-q', '-a_nodata', str(NODATA_VALUE), '-a_srs', 'EPSG:4326'] + COG_OPTIONS + [merged_vrt, merged_tif]
+        logging.debug('Converting {} to {}'.format(f, merged_tif))
+        subprocess.call(cmd)
+        # delete the virtual raster
+        os.remove(merged_vrt)
         # add the new tif files to the list of tifs
         tifs.append(merged_tif)
     return tifs
@@ -45,6 +45,10 @@ FILENAME = 'ocn_011_total_suspended_matter_{var}_{date}'
 # name of data directory in Docker container
 DATA_DIR = os.path.join(os.getcwd(),'data')
 
+# creation options of the COGs we upload, see COG_OPTIONS in utils/rasterUtils.py
+COG_OPTIONS = ['-of', 'COG', '-co', 'COMPRESS=DEFLATE', '-co', 'PREDICTOR=YES', '-co', 'BLOCKSIZE=512',
+               '-co', 'NUM_THREADS=ALL_CPUS']
+
 # name of collection in GEE where we will upload the final data
 COLLECTION = '/projects/resource-watch-gee/ocn_011_nrt_total_suspended_matter'
 
@@ -325,8 +329,8 @@ def processNewData():
             sds_path = f'NETCDF:"{nc}":{sds}'
             # generate a name to save the tif file we will translate the netcdf file's subdataset into
             sds_tif = '{}_{}.tif'.format(os.path.splitext(nc)[0], sds_path.split(':')[-1])
-            # create the gdal command and run it to convert the netcdf to tif
-            cmd = ['gdal_translate','-q', '-a_srs', 'EPSG:4326',  sds_path, sds_tif]
+            # create the gdal command and run it to convert the netcdf to a cloud-optimized tif
+            cmd = ['gdal_translate','-q', '-a_srs', 'EPSG:4326'] + COG_OPTIONS + [sds_path, sds_tif]
             completed_process = subprocess.run(cmd, shell=False)
             logging.debug(str(completed_process))
             # store the file path to the tif file in the data dictionary
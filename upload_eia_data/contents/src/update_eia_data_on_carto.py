@@ -1,5 +1,6 @@
 import logging
 import sys
+import functools
 import pandas as pd
 import datetime
 import requests
@@ -38,15 +39,35 @@ CARTO_SCHEMA = OrderedDict([
 # name of data directory in Docker container
 DATA_DIR = 'data'
 
-# pull in sheet with information about each EIA dataset and where it is stored on Carto and the RW API
-eia_rw_table = pd.read_csv(
-    'https://raw.githubusercontent.com/resource-watch/nrt-scripts/master/upload_eia_data/EIA_RW_dataset_names_ids.csv').set_index(
-    'Carto Table')
-# pull in sheet with information about each country/region name and Alpha-3 code
-country_table = pd.read_csv('https://raw.githubusercontent.com/resource-watch/nrt-scripts/master/upload_eia_data/country_region_list.csv')
+@functools.lru_cache(maxsize=None)
+def get_eia_rw_table():
+    '''
+    This function pulls in the sheet with information about each EIA dataset and where it is stored on Carto and the RW API.
+    It is called on first use rather than at import time, so importing this module does not make any network calls
+    INPUT   none
+    RETURN  EIA dataset information, indexed by Carto table (dataframe)
+    '''
+    return pd.read_csv(
+        'https://raw.githubusercontent.com/resource-watch/nrt-scripts/master/upload_eia_data/EIA_RW_dataset_names_ids.csv').set_index(
+        'Carto Table')
 
-# get list of all current Carto table names
-carto_table_names = cartosql.getTables(user = CARTO_USER, key = CARTO_KEY)
+@functools.lru_cache(maxsize=None)
+def get_country_table():
+    '''
+    This function pulls in the sheet with information about each country/region name and Alpha-3 code, on first use
+    INPUT   none
+    RETURN  country/region names and Alpha-3 codes (dataframe)
+    '''
+    return pd.read_csv('https://raw.githubusercontent.com/resource-watch/nrt-scripts/master/upload_eia_data/country_region_list.csv')
+
+@functools.lru_cache(maxsize=None)
+def get_carto_table_names():
+    '''
+    This function gets the list of all current Carto table names, on first use
+    INPUT   none
+    RETURN  Carto table names (list of strings)
+    '''
+    return cartosql.getTables(user = CARTO_USER, key = CARTO_KEY)
 
 def upload_to_aws(local_file, bucket, s3_file):
     '''
@@ -80,9 +101,9 @@ def fetch_eia_data(table_name, country_table):
     RETURN  all_eia_data: dataframe of processed data for this table (pandas dataframe)
     '''
     # pull the eia activityId, productId, unit that is included in this table info
-    activityId = eia_rw_table.loc[table_name, 'activityId']
-    productId = eia_rw_table.loc[table_name, 'productId']
-    unit = eia_rw_table.loc[table_name, 'unit']
+    activityId = get_eia_rw_table().loc[table_name, 'activityId']
+    productId = get_eia_rw_table().loc[table_name, 'productId']
+    unit = get_eia_rw_table().loc[table_name, 'unit']
 
     # create an empty dataframe to store data 
     df = pd.DataFrame()
@@ -189,7 +210,7 @@ def main():
         os.mkdir(DATA_DIR)
 
     # process each Carto table for EIA datasets one at a time
-    for table_name, info in eia_rw_table.iterrows():
+    for table_name, info in get_eia_rw_table().iterrows():
         # get the dataset name (table name without the '_edit' at the end of the table_name
         if table_name[-5:] == '_edit':
             dataset_name = table_name[:-5]
@@ -200,7 +221,7 @@ def main():
         '''
         Download data and save to your data directory
         '''
-        df, raw_data_file = fetch_eia_data(table_name, country_table)
+        df, raw_data_file = fetch_eia_data(table_name, get_country_table())
 
         '''
         Process data
@@ -213,7 +234,7 @@ def main():
         logging.info('Uploading processed data to Carto.')
         # check if table exists
         # if table does not exist, create it
-        if not table_name in carto_table_names:
+        if not table_name in get_carto_table_names():
             logging.info(f'Table {table_name} does not exist, creating')
             # Change privacy of table on Carto
             # set up carto authentication using local variables for username (CARTO_USER) and API key (CARTO_KEY)
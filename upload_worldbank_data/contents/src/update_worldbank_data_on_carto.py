@@ -1,5 +1,6 @@
 import logging
 import sys
+import functools
 import pandas as pd
 import numpy as np
 import datetime
@@ -25,18 +26,48 @@ CARTO_KEY = os.getenv('CARTO_WRI_RW_KEY')
 # name of data directory in Docker container
 DATA_DIR = 'data'
 
-# pull in sheet with information about each World Bank dataset and where it is stored on Carto and the RW API
-wb_rw_table = pd.read_csv(
-    'https://raw.githubusercontent.com/resource-watch/nrt-scripts/master/upload_worldbank_data/WB_RW_dataset_names_ids.csv').set_index(
-    'Carto Table')
+@functools.lru_cache(maxsize=None)
+def get_wb_rw_table():
+    '''
+    This function pulls in the sheet with information about each World Bank dataset and where it is stored on Carto and the RW API.
+    It is called on first use rather than at import time, so importing this module does not make any network calls
+    INPUT   none
+    RETURN  World Bank dataset information, indexed by Carto table (dataframe)
+    '''
+    return pd.read_csv(
+        'https://raw.githubusercontent.com/resource-watch/nrt-scripts/master/upload_worldbank_data/WB_RW_dataset_names_ids.csv').set_index(
+        'Carto Table')
+
+@functools.lru_cache(maxsize=None)
+def get_wb_name_to_iso3_conversion():
+    '''
+    This function pulls in the sheet with World Bank name to iso3 conversions, on first use
+    INPUT   none
+    RETURN  ISO3 codes, indexed by World Bank name (dataframe)
+    '''
+    return pd.read_csv(
+        'https://raw.githubusercontent.com/resource-watch/nrt-scripts/master/upload_worldbank_data/WB_name_to_ISO3.csv').set_index(
+        'WB_name')
 
-# pull in sheet with World Bank name to iso3 conversions
-wb_name_to_iso3_conversion = pd.read_csv(
-    'https://raw.githubusercontent.com/resource-watch/nrt-scripts/master/upload_worldbank_data/WB_name_to_ISO3.csv').set_index(
-    'WB_name')
+@functools.lru_cache(maxsize=None)
+def get_carto_table_names():
+    '''
+    This function gets the list of all current Carto table names, on first use
+    INPUT   none
+    RETURN  Carto table names (list of strings)
+    '''
+    return cartosql.getTables(user = CARTO_USER, key = CARTO_KEY)
 
-# get list of all current Carto table names
-carto_table_names = cartosql.getTables(user = CARTO_USER, key = CARTO_KEY)
+@functools.lru_cache(maxsize=None)
+def get_country_info():
+    '''
+    This function pulls in the table of standard Resource Watch country names and ISO codes, on first use
+    INPUT   none
+    RETURN  Resource Watch country names and ISO3 codes (dataframe)
+    '''
+    sql_statement = 'SELECT iso_a3, name FROM wri_countries_a'
+    country_html = requests.get(f'https://{CARTO_USER}.carto.com/api/v2/sql?q={sql_statement}')
+    return pd.DataFrame(country_html.json()['rows'])
 
 def upload_to_aws(local_file, bucket, s3_file):
     '''
@@ -70,16 +101,11 @@ def add_iso(name):
     '''
     # try to match the country name to the ISO3 code based on loaded conversion table
     try:
-        return wb_name_to_iso3_conversion.loc[name, "ISO"]
+        return get_wb_name_to_iso3_conversion().loc[name, "ISO"]
     # if no match can be found, return None
     except:
         return np.nan
 
-# pull in table of standard Resource Watch country names and ISO codes
-sql_statement = 'SELECT iso_a3, name FROM wri_countries_a'
-country_html = requests.get(f'https://{CARTO_USER}.carto.com/api/v2/sql?q={sql_statement}')
-country_info = pd.DataFrame(country_html.json()['rows'])
-
 def add_rw_name(code):
     '''
     This function takes an ISO3 code and matches it to the standard Resource Watch name for the country
@@ -87,6 +113,7 @@ def add_rw_name(code):
     RETURN  standard Resource Watch name for input country (string)
     '''
     # try to find the RW country name for the ISO3 code based on loaded conversion table
+    country_info = get_country_info()
     temp = country_info.loc[country_info['iso_a3'] == code]
     temp = temp['name'].tolist()
     if temp != []:
@@ -101,6 +128,7 @@ def add_rw_code(code):
     RETURN  standard Resource Watch ISO3 code for input country (string)
     '''
     # try to find the RW ISO3 code for the ISO3 code based on loaded conversion table
+    country_info = get_country_info()
     temp = country_info.loc[country_info['iso_a3'] == code]
     temp = temp['iso_a3'].tolist()
     if temp != []:
@@ -115,6 +143,7 @@ def fetch_wb_data(table):
     RETURN  all_world_bank_data: dataframe of processed data for this table (pandas dataframe)
     '''
     # pull the WB indicators that are included in this table
+    wb_rw_table = get_wb_rw_table()
     indicators = wb_rw_table.loc[table, 'wb_indicators'].split(";")
     # pull the list of column names used in the Carto table associated with each indicator
     value_names = wb_rw_table.loc[table, 'Carto Column'].split(";")
@@ -254,6 +283,7 @@ def main():
         os.mkdir(data_dir)
 
     # process each Carto table for World Bank datasets one at a time
+    wb_rw_table = get_wb_rw_table()
     for table_name, info in wb_rw_table[wb_rw_table['skip'] != True].iterrows():
         # get the dataset name (table name without the '_edit' at the end of the table_name
         dataset_name = table_name[:-5]
@@ -291,7 +321,7 @@ def main():
         logging.info('Uploading processed data to Carto.')
         # check if table exists
         # if table does not exist, create it
-        if not table_name in carto_table_names:
+        if not table_name in get_carto_table_names():
             logging.info(f'Table {table_name} does not exist, creating')
             # Change privacy of table on Carto
             # set up carto authentication using local variables for username (CARTO_WRI_RW_USER) and API key (CARTO_WRI_RW_KEY)
@@ -0,0 +1,56 @@
+'''
+Benchmark insertRows against copyRows on the local CARTO stand-in
+Usage: python benchCopy.py [rows] [latency_seconds]
+Reports wall time and peak Python memory for loading the same generated
+point table through each path.
+'''
+from __future__ import print_function
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import cartoUploads
+from cartoStandIn import CartoStandIn
+
+FIELDS = ('uid', 'the_geom', 'datetime', 'value', 'name')
+DTYPES = ('text', 'geometry', 'timestamp', 'numeric', 'text')
+
+
+def genRows(n):
+    '''Generate `n` rows of point data'''
+    for i in range(n):
+        yield [
+            'uid_{}'.format(i),
+            {'type': 'Point', 'coordinates': [i % 360 - 180, i % 180 - 90]},
+            '2020-01-01 00:00:{:02d}'.format(i % 60),
+            i * 0.5,
+            "station's name {}".format(i),
+        ]
+
+
+def run(name, load):
+    '''Time `load()` and trace its peak memory'''
+    tracemalloc.start()
+    start = time.time()
+    num = load()
+    elapsed = time.time() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print('{:<12} {:>10} rows {:>8.2f}s {:>10.1f} MB peak'.format(
+        name, num, elapsed, peak / 1e6))
+
+
+def main(n=100000, latency=0.0):
+    with CartoStandIn(latency=latency) as server:
+        client = cartoUploads.CartoClient('bench', 'key', url=server.url)
+        client.createTable('bench', list(zip(FIELDS, DTYPES)))
+        run('insertRows', lambda: client.insertRows(
+            'bench', FIELDS, DTYPES, genRows(n)).rows)
+        run('copyRows', lambda: client.copyRows(
+            'bench', FIELDS, DTYPES, genRows(n)))
+
+
+if __name__ == '__main__':
+    main(*[float(a) if i else int(a) for i, a in enumerate(sys.argv[1:])])
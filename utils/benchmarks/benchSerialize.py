@@ -0,0 +1,60 @@
+'''
+Micro-benchmark of the column-wise SQL serializer against _dumpRows
+Usage: python benchSerialize.py [point_rows] [polygon_rows]
+Times escaping a point table (default 100k rows) and a polygon table
+(default 10k rows of 64-vertex rings) with the per-cell _dumpRows and the
+per-column _dumpColumns, and reports the SQL size each produces.
+'''
+from __future__ import print_function
+import math
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import cartoUploads
+
+DTYPES = ('text', 'geometry', 'timestamp', 'numeric', 'text')
+
+
+def genRows(n, vertices=0):
+    '''Generate `n` rows of point data, or polygons with `vertices`'''
+    rows = []
+    for i in range(n):
+        x, y = i % 360 - 180, i % 180 - 90
+        if vertices:
+            ring = [[x + math.cos(2 * math.pi * k / vertices),
+                     y + math.sin(2 * math.pi * k / vertices)]
+                    for k in range(vertices)]
+            geom = {'type': 'Polygon', 'coordinates': [ring + ring[:1]]}
+        else:
+            geom = {'type': 'Point', 'coordinates': [x, y]}
+        rows.append(['uid_{}'.format(i), geom,
+                     '2020-01-01 00:00:{:02d}'.format(i % 60), i * 0.5,
+                     "station's name {}".format(i)])
+    return rows
+
+
+def timeit(fn):
+    start = time.time()
+    out = fn()
+    return time.time() - start, sum(len(v) for v in out)
+
+
+def bench(name, rows):
+    columns = list(zip(*rows))
+    old, old_size = timeit(lambda: [cartoUploads._dumpRows(rows, DTYPES)])
+    new, new_size = timeit(lambda: cartoUploads._dumpColumns(columns, DTYPES))
+    print('{:<10} {:>7} rows  _dumpRows {:>6.2f}s {:>6.1f} MB  '
+          '_dumpColumns {:>6.2f}s {:>6.1f} MB  {:>4.1f}x'.format(
+              name, len(rows), old, old_size / 1e6, new, new_size / 1e6,
+              old / new))
+
+
+def main(points=100000, polygons=10000):
+    bench('points', genRows(points))
+    bench('polygons', genRows(polygons, 64))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,490 @@
+'''
+Offline record/replay benchmarks of whole NRT jobs
+Usage (from the repository root):
+```
+# run a job live once, recording every response into a fixture bundle
+python utils/benchmarks/recordReplay.py record cit_002_gmao_air_quality
+# run it again offline from the bundle, with 50 ms latency and 20 MB/s
+python utils/benchmarks/recordReplay.py replay cit_002_gmao_air_quality \
+    --latency 0.05 --bandwidth 20e6
+# replay the representative job of each family, each in its own process
+python utils/benchmarks/recordReplay.py suite
+```
+HTTP(S) traffic is captured at urllib3, which requests, cartosql, eeUtil's
+storage client and boto3 (S3) all go through; FTP and plain urllib requests
+(urlretrieve) at urllib.request.urlopen. Clients on other stacks, such as
+the httplib2 transport of the Earth Engine API, are not captured. Bundles
+(FIXTURES/<job>/, not committed) hold an index.jsonl of requests and their
+response bodies by sha256. Credentials are scrubbed before anything is
+written: query parameters and response headers that carry them are blanked,
+and so are token fields of JSON responses (e.g. OAuth token exchanges),
+which are then stored uncompressed.
+
+Jobs pick dates from the clock, so replays are run at the time of the
+recording when freezegun is installed; otherwise some requests of a job
+recorded on another day may have no recorded response.
+'''
+from __future__ import print_function, unicode_literals
+import argparse
+import email.message
+import gzip
+import hashlib
+import importlib
+import io
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import urllib.response
+import zlib
+from collections import defaultdict, deque
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import urllib3
+from urllib3.connectionpool import HTTPConnectionPool
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import jobRunner
+import traceUtils
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'fixtures')
+# one representative job per family: raster/GEE, point ingest, polygons,
+# interaction table
+SUITE = ('cit_002_gmao_air_quality', 'dis_001_significant_earthquakes',
+         'bio_007_world_database_on_protected_areas',
+         'foo_053_alerts_price_spikes')
+SECRET_PARAMS = ('api_key', 'key', 'apikey', 'token', 'access_token',
+                 'password', 'apitoken', 'client_secret', 'refresh_token',
+                 'assertion', 'signature', 'x-goog-signature')
+SECRET_HEADERS = ('authorization', 'proxy-authorization', 'set-cookie',
+                  'cookie', 'x-api-key')
+SECRET_FIELDS = ('access_token', 'refresh_token', 'id_token',
+                 'client_secret')
+
+_poolUrlopen = HTTPConnectionPool.urlopen
+_urlopen = urllib.request.urlopen
+
+
+def _cleanUrl(url):
+    '''url with sorted query parameters and credentials blanked'''
+    parts = urlsplit(url)
+    query = sorted((k, '' if k.lower() in SECRET_PARAMS else v)
+                   for k, v in parse_qsl(parts.query, keep_blank_values=True))
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+def _blanked(value):
+    '''JSON value with the values of SECRET_FIELDS blanked, at any depth'''
+    if isinstance(value, dict):
+        return dict((k, '' if k.lower() in SECRET_FIELDS else _blanked(v))
+                    for k, v in value.items())
+    if isinstance(value, list):
+        return [_blanked(v) for v in value]
+    return value
+
+
+def _scrub(headers, content):
+    '''
+    Response headers and body with credentials blanked; a body that had to
+    be changed is returned decoded, without its Content-Encoding
+    '''
+    headers = [(k, '' if k.lower() in SECRET_HEADERS else v)
+               for k, v in headers]
+    types = dict((k.lower(), v.lower()) for k, v in headers)
+    if 'json' not in types.get('content-type', ''):
+        return headers, content
+    encoding = types.get('content-encoding', 'identity')
+    try:
+        if encoding == 'gzip':
+            text = gzip.decompress(content)
+        elif encoding == 'deflate':
+            try:
+                text = zlib.decompress(content)
+            except zlib.error:
+                text = zlib.decompress(content, -zlib.MAX_WBITS)
+        elif encoding == 'identity':
+            text = content
+        else:
+            return headers, content
+        data = json.loads(text.decode('utf-8'))
+    except (ValueError, OSError, zlib.error):
+        return headers, content
+    scrubbed = _blanked(data)
+    if scrubbed == data:
+        return headers, content
+    headers = [(k, v) for k, v in headers if k.lower() not in
+               ('content-encoding', 'content-length')]
+    return headers, json.dumps(scrubbed).encode('utf-8')
+
+
+def _bodyBytes(body):
+    '''A request body as bytes, so it can be hashed and still sent'''
+    if body is None:
+        return b''
+    if isinstance(body, bytes):
+        return body
+    if isinstance(body, str):
+        return body.encode('utf-8')
+    if hasattr(body, 'read'):
+        return body.read()
+    return b''.join(c.encode('utf-8') if isinstance(c, str) else c
+                    for c in body)
+
+
+class Bundle(object):
+    '''
+    Recorded responses of one job run
+    `path` folder of index.jsonl and bodies/<sha256>
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.bodies = os.path.join(path, 'bodies')
+        self._lock = threading.Lock()
+        self.entries = []
+        self.info = {}
+        index = os.path.join(path, 'index.jsonl')
+        if os.path.exists(index):
+            with io.open(index, encoding='utf-8') as f:
+                for line in f:
+                    self.entries.append(json.loads(line))
+        info = os.path.join(path, 'bundle.json')
+        if os.path.exists(info):
+            with io.open(info, encoding='utf-8') as f:
+                self.info = json.load(f)
+
+    def add(self, method, url, body, status, reason, headers, content):
+        headers, content = _scrub(headers, content)
+        sha = hashlib.sha256(content).hexdigest()
+        path = os.path.join(self.bodies, sha)
+        entry = {
+            'method': method,
+            'url': _cleanUrl(url),
+            'body_sha256': hashlib.sha256(body).hexdigest(),
+            'status': status,
+            'reason': reason,
+            'headers': headers,
+            'content_sha256': sha,
+            'bytes': len(content),
+        }
+        with self._lock:
+            if not os.path.exists(path):
+                with io.open(path, 'wb') as f:
+                    f.write(content)
+            self.entries.append(entry)
+            with io.open(os.path.join(self.path, 'index.jsonl'), 'a',
+                         encoding='utf-8') as f:
+                f.write(json.dumps(entry) + '\n')
+
+    def content(self, entry):
+        with io.open(os.path.join(self.bodies, entry['content_sha256']),
+                     'rb') as f:
+            return f.read()
+
+
+class Recorder(object):
+    '''Captures responses into a Bundle while the job runs live'''
+    def __init__(self, bundle):
+        self.bundle = bundle
+        if os.path.isdir(bundle.path):
+            shutil.rmtree(bundle.path)
+        os.makedirs(bundle.bodies)
+        bundle.entries = []
+        bundle.info = {'recorded_at': time.time()}
+        with io.open(os.path.join(bundle.path, 'bundle.json'), 'w',
+                     encoding='utf-8') as f:
+            f.write(json.dumps(bundle.info))
+
+    def poolUrlopen(self, pool, method, url, body=None, headers=None,
+                    **kwargs):
+        body = _bodyBytes(body)
+        preload = kwargs.pop('preload_content', True)
+        decode = kwargs.pop('decode_content', True)
+        r = _poolUrlopen(pool, method, url, body=body, headers=headers,
+                         preload_content=False, decode_content=False,
+                         **kwargs)
+        content = r.read(decode_content=False)
+        r.release_conn()
+        full = url if '://' in url else '{}://{}:{}{}'.format(
+            pool.scheme, pool.host, pool.port, url)
+        self.bundle.add(method, full, body, r.status, r.reason,
+                        r.headers.items(), content)
+        return urllib3.HTTPResponse(
+            body=io.BytesIO(content), headers=r.headers, status=r.status,
+            reason=r.reason, preload_content=preload, decode_content=decode,
+            request_method=method, request_url=full)
+
+    def urlopen(self, url, data=None, *args, **kwargs):
+        full = url if isinstance(url, str) else url.full_url
+        method = 'POST' if data else 'GET'
+        r = _urlopen(url, data, *args, **kwargs)
+        content = r.read()
+        status = getattr(r, 'status', None) or r.getcode() or 200
+        headers = r.info().items() if r.info() else []
+        r.close()
+        self.bundle.add(method, full, _bodyBytes(data), status, '', headers,
+                        content)
+        return _addinfourl(content, headers, full, status)
+
+
+def _addinfourl(content, headers, url, status):
+    message = email.message.Message()
+    for k, v in headers:
+        message[k] = v
+    return urllib.response.addinfourl(io.BytesIO(content), message, url,
+                                      status)
+
+
+class Replayer(object):
+    '''
+    Serves recorded responses instead of the network
+    `latency` seconds added to every request
+    `bandwidth` bytes per second for response bodies; 0 for unlimited
+    '''
+    def __init__(self, bundle, latency=0.0, bandwidth=0):
+        self.bundle = bundle
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.stats = {'requests': 0, 'bytes': 0, 'unmatched': 0}
+        self._lock = threading.Lock()
+        # identical requests get the recorded responses in order; the last
+        # one repeats. Requests whose body changed fall back to the URL.
+        self._exact = defaultdict(deque)
+        self._byUrl = defaultdict(deque)
+        for e in bundle.entries:
+            self._exact[(e['method'], e['url'], e['body_sha256'])].append(e)
+            self._byUrl[(e['method'], e['url'])].append(e)
+
+    def _next(self, queue):
+        return queue.popleft() if len(queue) > 1 else queue[0]
+
+    def _lookup(self, method, url, body):
+        url = _cleanUrl(url)
+        key = (method, url, hashlib.sha256(body).hexdigest())
+        with self._lock:
+            self.stats['requests'] += 1
+            if self._exact.get(key):
+                entry = self._next(self._exact[key])
+            elif self._byUrl.get((method, url)):
+                entry = self._next(self._byUrl[(method, url)])
+            else:
+                self.stats['unmatched'] += 1
+                logging.warning('No recorded response for {} {}'.format(
+                    method, url))
+                return None
+            self.stats['bytes'] += entry['bytes']
+        delay = self.latency
+        if self.bandwidth:
+            delay += entry['bytes'] / float(self.bandwidth)
+        if delay:
+            time.sleep(delay)
+        return entry
+
+    def poolUrlopen(self, pool, method, url, body=None, headers=None,
+                    **kwargs):
+        full = url if '://' in url else '{}://{}:{}{}'.format(
+            pool.scheme, pool.host, pool.port, url)
+        entry = self._lookup(method, full, _bodyBytes(body))
+        if entry is None:
+            raise urllib3.exceptions.ProtocolError(
+                'No recorded response for {} {}'.format(method, full))
+        return urllib3.HTTPResponse(
+            body=io.BytesIO(self.bundle.content(entry)),
+            headers=urllib3.HTTPHeaderDict(entry['headers']),
+            status=entry['status'], reason=entry['reason'],
+            preload_content=kwargs.get('preload_content', True),
+            decode_content=kwargs.get('decode_content', True),
+            request_method=method, request_url=full)
+
+    def urlopen(self, url, data=None, *args, **kwargs):
+        full = url if isinstance(url, str) else url.full_url
+        entry = self._lookup('POST' if data else 'GET', full,
+                             _bodyBytes(data))
+        if entry is None:
+            raise urllib.error.URLError('No recorded response for ' + full)
+        return _addinfourl(self.bundle.content(entry), entry['headers'], full,
+                           entry['status'])
+
+
+class patched(object):
+    '''Route urllib3 and urllib.request through a Recorder or Replayer'''
+    def __init__(self, handler):
+        self.handler = handler
+
+    def __enter__(self):
+        handler = self.handler
+        HTTPConnectionPool.urlopen = \
+            lambda pool, *a, **kw: handler.poolUrlopen(pool, *a, **kw)
+        urllib.request.urlopen = handler.urlopen
+        return handler
+
+    def __exit__(self, *exc):
+        HTTPConnectionPool.urlopen = _poolUrlopen
+        urllib.request.urlopen = _urlopen
+        return False
+
+
+def _frozen(bundle):
+    '''Clock of the recording if freezegun is installed, else a no-op'''
+    try:
+        import freezegun
+    except ImportError:
+        logging.warning('freezegun not installed, replaying at the current '
+                        'date')
+        return _NoOp()
+    recorded = bundle.info.get('recorded_at')
+    if not recorded:
+        return _NoOp()
+    return freezegun.freeze_time(
+        time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(recorded)), tick=True)
+
+
+class _NoOp(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+def _forgetSrc():
+    '''Drop the imported job package, so the next job imports its own'''
+    for name in list(sys.modules):
+        if name == 'src' or name.startswith('src.'):
+            del sys.modules[name]
+
+
+def runJob(job):
+    '''
+    Run a job's main() from a scratch copy of its contents/, so every run
+    starts from an empty data/ folder and a fresh import of its src package;
+    import and main are traced stages, and only this run's are kept
+    '''
+    job = jobRunner.Job(job)
+    scratch = tempfile.mkdtemp(prefix=job.name + '-')
+    contents = os.path.join(scratch, 'contents')
+    shutil.copytree(os.path.join(job.path, 'contents'), contents)
+    os.environ.update(job.env())
+    os.environ['NAME'] = job.name
+    cwd = os.getcwd()
+    os.chdir(contents)
+    sys.path.insert(0, contents)
+    os.makedirs('data', exist_ok=True)
+    _forgetSrc()
+    # the stages go into the measurement, not a report of their own
+    traceUtils.enable(at_exit=False)
+    traceUtils.reset()
+    try:
+        with traceUtils.stage('import'):
+            src = importlib.import_module('src')
+        with traceUtils.stage('main'):
+            src.main()
+    finally:
+        os.chdir(cwd)
+        sys.path.remove(contents)
+        _forgetSrc()
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def record(job, bundle_path=None):
+    '''Run job live, recording its traffic'''
+    bundle = Bundle(bundle_path or os.path.join(
+        FIXTURES, os.path.basename(os.path.abspath(job))))
+    recorder = Recorder(bundle)
+    with patched(recorder):
+        runJob(job)
+    print('Recorded {} responses, {:.1f} MB to {}'.format(
+        len(bundle.entries), sum(e['bytes'] for e in bundle.entries) / 1e6,
+        bundle.path))
+
+
+def replay(job, bundle_path=None, latency=0.0, bandwidth=0, report=None):
+    '''Run job offline from its bundle and return the benchmark summary'''
+    name = os.path.basename(os.path.abspath(job))
+    bundle = Bundle(bundle_path or os.path.join(FIXTURES, name))
+    if not bundle.entries:
+        raise Exception('No recorded responses in {}'.format(bundle.path))
+    replayer = Replayer(bundle, latency, bandwidth)
+    ok = True
+    with _frozen(bundle), patched(replayer):
+        try:
+            runJob(job)
+        except Exception:
+            logging.exception('{} failed'.format(name))
+            ok = False
+    summary = {
+        'job': name,
+        'ok': ok,
+        'latency': latency,
+        'bandwidth': bandwidth,
+        'requests': replayer.stats,
+        'peak_rss_bytes': traceUtils._peakRss(),
+        'stages': traceUtils.stages(),
+    }
+    if report:
+        with io.open(report, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(summary))
+    return summary
+
+
+def printSummary(summary):
+    print('{job}: ok={ok}, {requests[requests]} requests, '
+          '{requests[unmatched]} unmatched, peak RSS {rss:.0f} MB'.format(
+              rss=(summary['peak_rss_bytes'] or 0) / 2 ** 20, **summary))
+    for s in summary['stages']:
+        print('  {:<24} {:>8.2f}s wall {:>8.2f}s cpu'.format(
+            s['stage'], s['wall_seconds'], s['cpu_seconds']))
+
+
+def suite(jobs=SUITE, latency=0.0, bandwidth=0):
+    '''Replay each job in its own interpreter, for clean memory numbers'''
+    for job in jobs:
+        fd, report = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        cmd = [sys.executable, os.path.abspath(__file__), 'replay', job,
+               '--latency', str(latency), '--bandwidth', str(bandwidth),
+               '--report', report, '--quiet']
+        subprocess.call(cmd)
+        try:
+            with io.open(report, encoding='utf-8') as f:
+                printSummary(json.load(f))
+        except ValueError:
+            print('{}: replay did not complete'.format(job))
+        os.remove(report)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Record/replay benchmarks')
+    parser.add_argument('command', choices=('record', 'replay', 'suite'))
+    parser.add_argument('jobs', nargs='*', help='job folders')
+    parser.add_argument('--bundle', help='fixture folder (one job only)')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds per request')
+    parser.add_argument('--bandwidth', type=float, default=0,
+                        help='bytes per second, 0 for unlimited')
+    parser.add_argument('--report', help='write the summary JSON here')
+    parser.add_argument('--quiet', action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(stream=sys.stderr, level=logging.WARNING
+                        if args.quiet else logging.INFO)
+    if args.command == 'suite':
+        suite(args.jobs or SUITE, args.latency, args.bandwidth)
+    for job in args.jobs if args.command != 'suite' else ():
+        if args.command == 'record':
+            record(job, args.bundle)
+        else:
+            summary = replay(job, args.bundle, args.latency, args.bandwidth,
+                             args.report)
+            if not args.quiet:
+                printSummary(summary)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+'''
+Server-side retention for CARTO tables, shared by the Carto jobs
+Example:
+```
+import cartoRetention
+# drop rows older than MAX_AGE, then all but the newest MAX_ROWS
+num_dropped = cartoRetention.deleteExcessRows(
+    CARTO_TABLE, MAX_ROWS, TIME_FIELD, MAX_AGE, user=CARTO_USER, key=CARTO_KEY)
+```
+Replaces the deleteExcessRows copied into each job, which downloaded every
+cartodb_id ordered by time and sent the excess back in an IN list.
+'''
+from __future__ import unicode_literals
+import datetime
+import logging
+import cartoUploads
+from cartoUploads import CARTO_USER, CARTO_KEY
+
+
+def _excessWhere(table, max_rows, time_field, max_age, id_field):
+    '''WHERE clause matching rows past max_age or beyond the newest max_rows'''
+    conds = []
+    if isinstance(max_age, (datetime.datetime, datetime.date)):
+        max_age = max_age.isoformat()
+    if max_age:
+        conds.append('{} < {}'.format(
+            time_field, cartoUploads._escapeValue(max_age, 'timestamp')))
+    if max_rows is not None:
+        # rows older than max_age sort last, so ranking the whole table
+        # keeps the same rows as dropping by age first
+        conds.append('{0} IN (SELECT {0} FROM "{1}" ORDER BY {2} DESC '
+                     'OFFSET {3})'.format(id_field, table, time_field,
+                                          int(max_rows)))
+    return ' OR '.join(conds)
+
+
+def deleteExcessRows(table, max_rows, time_field, max_age='', user=CARTO_USER,
+                     key=CARTO_KEY, id_field='cartodb_id', dry_run=False,
+                     state=None):
+    '''
+    Delete rows older than `max_age` and bring the table down to the newest
+    `max_rows` (ordered by `time_field`), in one statement
+    `max_age` datetime or ISO string; '' or None for no age limit
+    `max_rows` None for no row limit
+    `dry_run` only count the rows that would be dropped
+    `state` IngestState of the table; the UIDs of the dropped rows are
+        discarded from it, so its checksum keeps matching the table
+    Returns the number of rows dropped (or that would be)
+    '''
+    where = _excessWhere(table, max_rows, time_field, max_age, id_field)
+    if not where:
+        return 0
+    client = cartoUploads.getClient(user, key)
+    if dry_run:
+        sql = 'SELECT count(*) AS n FROM "{}" WHERE {}'.format(table, where)
+        num_dropped = client.get(sql).json()['rows'][0]['n']
+        logging.info('Would drop {} old rows from {}'.format(num_dropped,
+                                                              table))
+        return num_dropped
+    if state is not None:
+        sql = 'DELETE FROM "{}" WHERE {} RETURNING {}'.format(
+            table, where, state.id_field)
+        rows = client.post(sql).json()['rows']
+        state.discard(row[state.id_field] for row in rows)
+        num_dropped = len(rows)
+    else:
+        num_dropped = client.deleteRows(table, where).json()['total_rows']
+    if num_dropped:
+        logging.info('Dropped {} old rows from {}'.format(num_dropped, table))
+    return num_dropped
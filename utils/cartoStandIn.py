@@ -0,0 +1,549 @@
+'''
+Local stand-in for the CARTO SQL API, for testing and benchmarking
+cartoUploads without network access
+Example:
+```
+import cartoUploads
+from cartoStandIn import CartoStandIn
+with CartoStandIn(max_concurrent=4) as server:
+    client = cartoUploads.CartoClient('user', 'key', url=server.url)
+    client.createTable('mytable', schema)
+    client.copyRows('mytable', fields, dtypes, rows)
+    print(server.query('SELECT count(*) FROM mytable'))
+```
+Statements run against an embedded SQLite database (in memory by default),
+after translating the PostgreSQL/PostGIS used by cartoUploads and the jobs:
+casts, `= ANY(ARRAY[...])`, `OFFSET` without `LIMIT`, TRUNCATE, index
+methods, CDB_UserTables(), cdb_cartodbfytable() and the information_schema
+column listing. Geometries are stored as GeoJSON text; ST_GeomFromGeoJSON,
+ST_GeomFromWKB, ST_SetSRID, ST_MakePoint, ST_AsGeoJSON, ST_X and ST_Y are
+provided. Responses are JSON, or CSV / GeoJSON with `format`, and carry
+`total_rows`. The COPY endpoint (`/api/v2/sql/copyfrom`) loads the
+streamed CSV into the table. Set `latency`, `throttle_rate` or
+`max_concurrent` to simulate a slow or rate-limited account (429s).
+'''
+from __future__ import unicode_literals
+import binascii
+import csv
+import io
+import json
+import random
+import re
+import sqlite3
+import struct
+import threading
+import time
+from collections import defaultdict
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+
+SQL_PATH = '/api/v2/sql'
+COPY_PATH = SQL_PATH + '/copyfrom'
+COPY_TABLE = re.compile(r'^\s*COPY\s+"?([\w.]+)"?\s*(?:\(([^)]*)\))?',
+                        re.IGNORECASE)
+COPY_NULL = re.compile(r"\bNULL\s+'((?:[^']|'')*)'", re.IGNORECASE)
+# rows per executemany while loading a COPY stream
+COPY_BATCH = 5000
+
+_LITERAL = re.compile(r"('(?:[^']|'')*')")
+_CAST = re.compile(r'::\s*(?:double\s+precision|character\s+varying|'
+                   r'timestamp(?:tz)?(?:\s+with(?:out)?\s+time\s+zone)?|\w+)'
+                   r'(?:\s*\(\s*\d+(?:\s*,\s*\d+)?\s*\))?(?:\s*\[\s*\])?',
+                   re.IGNORECASE)
+_ANY = re.compile(r'=\s*ANY\s*\(\s*ARRAY\s*\[', re.IGNORECASE)
+_ANY_END = re.compile(r'\]\s*\)')
+_OFFSET = re.compile(r'(ORDER\s+BY\s+[^()]*?)\s+OFFSET\b', re.IGNORECASE)
+_TRUNCATE = re.compile(r'^\s*TRUNCATE\s+(?:TABLE\s+)?', re.IGNORECASE)
+_USING = re.compile(r'\bUSING\s+\w+\s*(?=\()', re.IGNORECASE)
+_GEOM_TYPE = re.compile(r'\bgeometry\s*\([^)]*\)', re.IGNORECASE)
+_ILIKE = re.compile(r'\bILIKE\b', re.IGNORECASE)
+_CREATE = re.compile(r'^\s*CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?'
+                     r'"?([\w.]+)"?\s*\(', re.IGNORECASE)
+_USER_TABLES = re.compile(r'\bFROM\s+CDB_UserTables\(\)', re.IGNORECASE)
+_CARTODBFY = re.compile(r'^\s*SELECT\s+cdb_cartodbfytable\(', re.IGNORECASE)
+_COLUMNS = re.compile(r'\binformation_schema\.columns\b.*?\btable_name\s*=\s*'
+                      r"'((?:[^']|'')*)'", re.IGNORECASE | re.DOTALL)
+
+
+def translate(sql):
+    '''Rewrite PostgreSQL as used with CARTO into SQLite'''
+    literals = []
+
+    def hide(match):
+        literals.append(match.group(0))
+        return '\0'
+    # rewrite only outside string literals, which are put back at the end
+    p = _LITERAL.sub(hide, sql.strip().rstrip(';'))
+    p = _CAST.sub('', p)
+    p = _ANY.sub(' IN (', p)
+    p = _ANY_END.sub(')', p)
+    p = _OFFSET.sub(r'\1 LIMIT -1 OFFSET', p)
+    p = _USING.sub('', p)
+    p = _GEOM_TYPE.sub('geometry', p)
+    p = _ILIKE.sub('LIKE', p)
+    p = _TRUNCATE.sub('DELETE FROM ', p)
+    parts = p.split('\0')
+    out = [parts[0]]
+    for literal, part in zip(literals, parts[1:]):
+        out.append(literal)
+        out.append(part)
+    return ''.join(out)
+
+
+_WKB_POINT, _WKB_LINE, _WKB_POLYGON = 1, 2, 3
+_GEOJSON_TYPES = {1: 'Point', 2: 'LineString', 3: 'Polygon', 4: 'MultiPoint',
+                  5: 'MultiLineString', 6: 'MultiPolygon',
+                  7: 'GeometryCollection'}
+
+
+def _readWkb(data, pos=0):
+    '''Parse (E)WKB at pos into a GeoJSON dict; returns (geom, next pos)'''
+    order = '<' if data[pos] == 1 else '>'
+    kind = struct.unpack_from(order + 'I', data, pos + 1)[0]
+    pos += 5
+    if kind & 0x20000000:
+        # EWKB SRID
+        pos += 4
+    dims = 2 + bool(kind & 0x80000000) + bool(kind & 0x40000000)
+    kind &= 0xffff
+    if kind > 1000:
+        # ISO Z/M/ZM codes
+        dims = 2 + (kind // 1000 in (1, 2)) + (kind // 1000 in (2, 3))
+        kind %= 1000
+    point = struct.Struct(order + 'd' * dims)
+
+    def points(pos):
+        n = struct.unpack_from(order + 'I', data, pos)[0]
+        pos += 4
+        coords = [list(point.unpack_from(data, pos + k * point.size))
+                  for k in range(n)]
+        return coords, pos + n * point.size
+
+    if kind == _WKB_POINT:
+        coords = list(point.unpack_from(data, pos))
+        pos += point.size
+    elif kind == _WKB_LINE:
+        coords, pos = points(pos)
+    elif kind == _WKB_POLYGON:
+        n = struct.unpack_from(order + 'I', data, pos)[0]
+        pos += 4
+        coords = []
+        for _ in range(n):
+            ring, pos = points(pos)
+            coords.append(ring)
+    else:
+        n = struct.unpack_from(order + 'I', data, pos)[0]
+        pos += 4
+        parts = []
+        for _ in range(n):
+            part, pos = _readWkb(data, pos)
+            parts.append(part)
+        if kind == 7:
+            return {'type': 'GeometryCollection', 'geometries': parts}, pos
+        coords = [p['coordinates'] for p in parts]
+    return {'type': _GEOJSON_TYPES[kind], 'coordinates': coords}, pos
+
+
+def _geomFromWkb(wkb, srid=None):
+    if wkb is None:
+        return None
+    if isinstance(wkb, str):
+        wkb = binascii.unhexlify(wkb)
+    return json.dumps(_readWkb(bytes(wkb))[0])
+
+
+def _geomFromGeoJSON(text):
+    return None if text is None else json.dumps(json.loads(text))
+
+
+def _geomText(value):
+    '''A stored geometry from COPY CSV: hex (E)WKB or GeoJSON text'''
+    if value is None or value.lstrip().startswith('{'):
+        return value
+    return _geomFromWkb(value)
+
+
+def _coordinate(geom, i):
+    if geom is None:
+        return None
+    return json.loads(geom)['coordinates'][i]
+
+
+def _decode(value, fmt):
+    if value is None:
+        return None
+    if fmt == 'hex':
+        return binascii.unhexlify(value)
+    if fmt == 'base64':
+        return binascii.a2b_base64(value)
+    return value
+
+
+_FUNCTIONS = {
+    ('ST_GeomFromGeoJSON', 1): _geomFromGeoJSON,
+    ('ST_GeomFromWKB', 1): _geomFromWkb,
+    ('ST_GeomFromWKB', 2): _geomFromWkb,
+    ('ST_SetSRID', 2): lambda geom, srid: geom,
+    ('ST_AsGeoJSON', 1): lambda geom: geom,
+    ('ST_MakePoint', 2): lambda x, y: json.dumps(
+        {'type': 'Point', 'coordinates': [x, y]}),
+    ('ST_X', 1): lambda geom: _coordinate(geom, 0),
+    ('ST_Y', 1): lambda geom: _coordinate(geom, 1),
+    ('decode', 2): _decode,
+    ('now', 0): lambda: time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime()),
+    ('current_schema', 0): lambda: 'public',
+}
+
+
+def _dataType(declared):
+    '''information_schema (data_type, udt_name) for a declared column type'''
+    t = declared.lower()
+    if t.startswith('geometry'):
+        return 'USER-DEFINED', 'geometry'
+    if t.startswith('timestamp'):
+        return 'timestamp without time zone', 'timestamp'
+    if t in ('int', 'integer', 'bigint', 'smallint'):
+        return t if t != 'int' else 'integer', 'int4'
+    if t.startswith(('numeric', 'real', 'double', 'float', 'decimal')):
+        return 'numeric', 'numeric'
+    if t.startswith(('varchar', 'character varying')):
+        return 'character varying', 'varchar'
+    return t or 'text', t or 'text'
+
+
+class StandInDatabase(object):
+    '''
+    Embedded SQLite database answering translated CARTO SQL
+    `path` SQLite file, or ':memory:'
+    '''
+    def __init__(self, path=':memory:'):
+        self.db = sqlite3.connect(path, check_same_thread=False,
+                                  isolation_level=None)
+        self._lock = threading.Lock()
+        for (name, nargs), fn in _FUNCTIONS.items():
+            self.db.create_function(name, nargs, fn)
+
+    def columns(self, table):
+        '''[(name, declared type)] of table'''
+        return [(r[1], r[2]) for r in self.db.execute(
+            'PRAGMA table_info("{}")'.format(table.replace('"', '')))]
+
+    def execute(self, sql):
+        '''Run one statement; returns (field names, rows, total_rows)'''
+        with self._lock:
+            if _USER_TABLES.search(sql):
+                rows = self.db.execute(
+                    "SELECT name FROM sqlite_master WHERE type = 'table' "
+                    "AND name NOT LIKE 'sqlite_%' ORDER BY name").fetchall()
+                return ['cdb_usertables'], rows, len(rows)
+            if _CARTODBFY.match(sql):
+                return ['cdb_cartodbfytable'], [(None,)], 1
+            columns = 'information_schema' in sql and _COLUMNS.search(sql)
+            if columns:
+                table = columns.group(1).replace("''", "'")
+                rows = [(name,) + _dataType(t)
+                        for name, t in self.columns(table)]
+                return (['column_name', 'data_type', 'udt_name'], rows,
+                        len(rows))
+            create = _CREATE.match(sql)
+            if create and not re.search(r'\bcartodb_id\b', sql, re.I):
+                # CARTO tables always have the serial cartodb_id
+                sql = sql[:create.end()] + 'cartodb_id INTEGER PRIMARY KEY,' \
+                    + sql[create.end():]
+            cursor = self.db.execute(translate(sql))
+            if cursor.description is None:
+                return [], [], max(cursor.rowcount, 0)
+            fields = [d[0] for d in cursor.description]
+            rows = cursor.fetchall()
+            return fields, rows, len(rows)
+
+    def copy(self, table, fields, records):
+        '''Insert CSV records (lists of str or None); returns the count'''
+        declared = dict(self.columns(table))
+        if not declared:
+            raise sqlite3.OperationalError('no such table: ' + table)
+        fields = fields or [name for name in declared if name != 'cartodb_id']
+        geoms = [i for i, f in enumerate(fields)
+                 if declared.get(f, '').lower().startswith('geometry')]
+        sql = 'INSERT INTO "{}" ({}) VALUES ({})'.format(
+            table, ', '.join(fields), ', '.join('?' * len(fields)))
+        num = 0
+        batch = []
+        with self._lock:
+            self.db.execute('BEGIN')
+            try:
+                for record in records:
+                    for i in geoms:
+                        record[i] = _geomText(record[i])
+                    batch.append(record)
+                    if len(batch) >= COPY_BATCH:
+                        self.db.executemany(sql, batch)
+                        num += len(batch)
+                        batch = []
+                self.db.executemany(sql, batch)
+                num += len(batch)
+                self.db.execute('COMMIT')
+            except Exception:
+                self.db.execute('ROLLBACK')
+                raise
+        return num
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _body(self):
+        '''Yield the request body, decoding chunked transfer encoding'''
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                if not size:
+                    self.rfile.readline()
+                    return
+                yield self.rfile.read(size)
+                self.rfile.readline()
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            yield self.rfile.read(length)
+
+    def _send(self, status, data, content_type, headers=()):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        for k, v in headers:
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _reply(self, status, body, headers=()):
+        self._send(status, json.dumps(body).encode('utf-8'),
+                   'application/json', headers)
+
+    def _copy(self, query):
+        start = time.time()
+        sql = query.get('q', [''])[0]
+        match = COPY_TABLE.match(sql)
+        if not match:
+            for _ in self._body():
+                pass
+            return self._reply(400, {'error': ['not a COPY statement']})
+        table = match.group(1)
+        fields = [f.strip().strip('"') for f in (match.group(2) or '').split(
+            ',') if f.strip()]
+        null = COPY_NULL.search(sql)
+        null = null.group(1).replace("''", "'") if null else ''
+        # parse the CSV as it arrives rather than buffering the body
+        text = io.TextIOWrapper(io.BufferedReader(_ChunkReader(self._body())),
+                                encoding='utf-8', newline='')
+        records = ([None if v == null else v for v in record]
+                   for record in csv.reader(text))
+        try:
+            num = self.server.standIn.database.copy(table, fields, records)
+        except sqlite3.Error as e:
+            for _ in text:
+                pass
+            return self._reply(400, {'error': [str(e)]})
+        self.server.standIn._copied(table, num)
+        self._reply(200, {'time': time.time() - start, 'total_rows': num})
+
+    def _sql(self, payload):
+        start = time.time()
+        standIn = self.server.standIn
+        sql = payload.get('q', '')
+        with standIn._lock:
+            standIn.statements.append(sql)
+        try:
+            fields, rows, total = standIn.database.execute(sql)
+        except sqlite3.Error as e:
+            return self._reply(400, {'error': [str(e)]})
+        f = payload.get('format', '').lower()
+        if f == 'csv':
+            out = io.StringIO()
+            writer = csv.writer(out)
+            writer.writerow(fields)
+            writer.writerows(rows)
+            return self._send(200, out.getvalue().encode('utf-8'),
+                              'text/csv; charset=utf-8')
+        if f == 'geojson':
+            return self._reply(200, _featureCollection(fields, rows))
+        self._reply(200, {
+            'rows': [dict(zip(fields, row)) for row in rows],
+            'time': time.time() - start,
+            'fields': {name: {} for name in fields},
+            'total_rows': total,
+        })
+
+    def _throttled(self):
+        '''Answer 429 if the simulated account is over its limits'''
+        standIn = self.server.standIn
+        with standIn._lock:
+            over = (standIn.max_concurrent and
+                    standIn.in_flight > standIn.max_concurrent) or \
+                random.random() < standIn.throttle_rate
+            if over:
+                standIn.throttled += 1
+        if over:
+            for _ in self._body():
+                pass
+            headers = [('Retry-After', str(standIn.retry_after))] \
+                if standIn.retry_after is not None else []
+            self._reply(429, {'error': ['You are over platform\'s limits']},
+                        headers)
+        return over
+
+    def _handle(self, method):
+        standIn = self.server.standIn
+        with standIn._lock:
+            standIn.in_flight += 1
+        try:
+            time.sleep(standIn.latency)
+            if self._throttled():
+                return
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            if method == 'POST' and url.path == COPY_PATH:
+                return self._copy(query)
+            payload = {k: v[0] for k, v in query.items()}
+            if method == 'POST':
+                body = b''.join(self._body())
+                if body:
+                    payload.update(json.loads(body.decode('utf-8')))
+            if url.path != SQL_PATH:
+                return self._reply(404, {'error': ['not found']})
+            self._sql(payload)
+        finally:
+            with standIn._lock:
+                standIn.in_flight -= 1
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+
+def _featureCollection(fields, rows):
+    '''GeoJSON of rows, with the_geom (or the first geometry) as geometry'''
+    geom = 'the_geom' if 'the_geom' in fields else None
+    features = []
+    for row in rows:
+        props = dict(zip(fields, row))
+        if geom is None:
+            for k, v in props.items():
+                if isinstance(v, str) and v.startswith('{"type"'):
+                    geom = k
+                    break
+        value = props.pop(geom, None) if geom else None
+        props.pop('the_geom_webmercator', None)
+        features.append({'type': 'Feature', 'properties': props,
+                         'geometry': json.loads(value) if value else None})
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+class _ChunkReader(io.RawIOBase):
+    '''File-like reader over an iterator of byte chunks'''
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buf = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.buf:
+            try:
+                self.buf = memoryview(next(self.chunks))
+            except StopIteration:
+                return 0
+        n = min(len(b), len(self.buf))
+        b[:n] = self.buf[:n]
+        self.buf = self.buf[n:]
+        return n
+
+
+class CartoStandIn(object):
+    '''
+    Threaded local server speaking the CARTO SQL API
+    `port` 0 picks a free port; the endpoint is at `url`
+    `db` SQLite file backing the account, by default in memory
+    `latency` seconds to wait before answering each request
+    `throttle_rate` fraction of requests answered with 429
+    `max_concurrent` requests in flight beyond this get 429; 0 for no limit
+    `retry_after` Retry-After seconds sent with 429s, None to omit it
+    `rows` rows loaded per table through COPY
+    `statements` SQL received through the SQL endpoint
+    `throttled` number of 429s sent
+    '''
+    def __init__(self, host='127.0.0.1', port=0, latency=0, db=':memory:',
+                 throttle_rate=0.0, max_concurrent=0, retry_after=None):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.max_concurrent = max_concurrent
+        self.retry_after = retry_after
+        self.database = StandInDatabase(db)
+        self.rows = defaultdict(int)
+        self.statements = []
+        self.throttled = 0
+        self.in_flight = 0
+        self._lock = threading.Lock()
+        self._server = _Server((host, port), _Handler)
+        self._server.standIn = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}{}'.format(host, port, SQL_PATH)
+
+    def query(self, sql):
+        '''Run sql on the backing database directly; returns the rows'''
+        return self.database.execute(sql)[1]
+
+    def _copied(self, table, num):
+        with self._lock:
+            self.rows[table] += num
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='CARTO SQL API stand-in')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--db', default=':memory:', help='SQLite file')
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--throttle-rate', type=float, default=0.0)
+    parser.add_argument('--max-concurrent', type=int, default=0)
+    args = parser.parse_args()
+    server = CartoStandIn(port=args.port, db=args.db, latency=args.latency,
+                          throttle_rate=args.throttle_rate,
+                          max_concurrent=args.max_concurrent)
+    print('Serving CARTO SQL API stand-in at {}'.format(server.url))
+    server._server.serve_forever()
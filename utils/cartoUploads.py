@@ -7,6 +7,13 @@ import cartosql
 # CARTO_USER and CARTO_KEY read from environment if not specified
 r = cartosql.get('select * from mytable', user=CARTO_USER, key=CARTO_KEY)
 data = r.json()
+
+# or hold a pooled, retrying client for the account
+client = cartosql.CartoClient(CARTO_USER, CARTO_KEY, pool_size=4)
+client.insertRows('mytable', fields, dtypes, rows)
+
+# record every request (also a JSON-lines file) and log a summary at exit
+cartosql.instrument('carto_requests.jsonl')
 ```
 Read more at:
 http://carto.com/docs/carto-engine/sql-api/making-calls/
@@ -14,35 +21,911 @@ http://carto.com/docs/carto-engine/sql-api/making-calls/
 from __future__ import unicode_literals
 from builtins import str
 import requests
+import urllib3
+from requests.adapters import HTTPAdapter
 import os
 import logging
 import json
+import binascii
+import csv
+import io
+import struct
+import random
+import time
+import threading
+import re
+import atexit
+from collections import namedtuple, OrderedDict
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+try:
+    import traceUtils
+except ImportError:
+    # optional: without it insertRows and copyRows run untraced
+    traceUtils = None
+
+
+def _traced(name):
+    '''traceUtils.traced, or the function untouched without traceUtils'''
+    if traceUtils is None:
+        return lambda fn: fn
+    return traceUtils.traced(name)
+
 
 CARTO_URL = 'https://{}.carto.com/api/v2/sql'
 CARTO_USER = os.environ.get('CARTO_USER')
 CARTO_KEY = os.environ.get('CARTO_KEY')
 STRICT = True
 
-def sendSql(sql, user=CARTO_USER, key=CARTO_KEY, f='', post=True):
-    '''Send arbitrary sql and return response object or False'''
-    url = CARTO_URL.format(user)
-    payload = {
-        'api_key': key,
-        'q': sql,
+# connection pool and retry defaults for CartoClient
+POOL_SIZE = 10
+RETRIES = 5
+BACKOFF = 1.0
+BACKOFF_MAX = 60.0
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+# insertRows block budget; statements over this are split before sending
+MAX_BLOCK_BYTES = 2 * 1024 * 1024
+# responses meaning an insert block was too big and should be bisected;
+# a 504 is not among them since the statement may still commit
+TOO_LARGE_STATUS = (408, 413)
+TOO_LARGE_ERRORS = ('statement timeout', 'too large')
+# an INSERT without on_conflict is not idempotent: after a 500, 502 or 504,
+# or a connection dropped once the request was sent, it may have committed,
+# so it is only retried on responses meaning it never ran
+INSERT_RETRY_STATUS = (429, 503)
+
+
+# one block of an insertRows call; `start` is the index of its first row
+# and `inserted` how many of its rows were written (under on_conflict, new or,
+# with update, overwritten)
+InsertBlock = namedtuple('InsertBlock',
+                         ('start', 'rows', 'bytes', 'ok', 'inserted'))
+
+
+# concurrent batches sent by deleteRowsByIDs and selectRowsByIDs
+ID_WORKERS = 4
+
+# seconds CartoCatalog trusts a fetched table list or schema
+CATALOG_TTL = 300
+
+# read buffer for streamed query results, and the field types iterFields
+# returns as numbers
+STREAM_CHUNK_BYTES = 64 * 1024
+INT_TYPES = ('int', 'integer', 'bigint', 'smallint')
+NUMERIC_TYPES = INT_TYPES + ('numeric', 'float', 'real', 'double precision')
+# schema field types sent as unquoted literals, and those quoted like text
+# and cast, so they also compare in ANY(ARRAY[...]); arrays ('int4[]') are
+# cast too, and any other type is escaped as text
+RAW_TYPES = NUMERIC_TYPES + ('boolean',)
+CAST_TYPES = ('uuid', 'json', 'jsonb')
+
+# rows escaped per column-wise batch in insertRows
+SERIALIZE_BATCH = 5000
+
+# COPY streaming: chunk size, NULL marker, and responses meaning the
+# endpoint does not exist
+COPY_CHUNK_BYTES = 256 * 1024
+COPY_NULL = '\\N'
+COPY_UNAVAILABLE_STATUS = (404, 405, 501)
+
+
+class InsertResult(object):
+    '''
+    Outcome of insertRows, true if every block was inserted
+    `blocks` list of InsertBlock, in row order
+    `inserted` rows written: less than `rows` when on_conflict skips
+        existing ones; with update, rows added plus rows overwritten
+    `failed` list of (start, stop) row index ranges that were not inserted
+    `error` message of the last failed block
+    '''
+    def __init__(self):
+        self.blocks = []
+        self.error = None
+
+    @property
+    def ok(self):
+        return all(b.ok for b in self.blocks)
+
+    def __bool__(self):
+        return self.ok
+    __nonzero__ = __bool__
+
+    @property
+    def rows(self):
+        return sum(b.rows for b in self.blocks if b.ok)
+
+    @property
+    def inserted(self):
+        return sum(b.inserted for b in self.blocks if b.ok)
+
+    @property
+    def failed(self):
+        return [(b.start, b.start + b.rows) for b in self.blocks if not b.ok]
+
+
+class InsertError(Exception):
+    '''Raised by insertRows under STRICT; `result` holds the InsertResult'''
+    def __init__(self, message, result):
+        super(InsertError, self).__init__(message)
+        self.result = result
+
+
+# instrumentation: callables each given a record dict for every request to
+# the SQL API, see instrument()
+SINKS = []
+
+_KIND = re.compile(r'^\s*(\w+)')
+_TABLE = re.compile(r'\b(?:INTO|FROM|TABLE|UPDATE|COPY)\s+"?([\w.]+)',
+                    re.IGNORECASE)
+_TOTAL_ROWS = re.compile(br'"total_rows":\s*(\d+)')
+
+
+def _record(sql, start, r, retries, rows=None, stream=False,
+            request_bytes=None):
+    '''Describe one SQL API call for SINKS'''
+    kind = _KIND.match(sql)
+    table = _TABLE.search(sql)
+    response_bytes = None
+    if r is not None:
+        if request_bytes is None:
+            body = r.request.body
+            request_bytes = len(body) if body else len(r.request.url)
+        if stream:
+            response_bytes = int(r.headers.get('Content-Length') or 0) or None
+        else:
+            response_bytes = len(r.content)
+            if rows is None:
+                total = _TOTAL_ROWS.search(r.content[-256:])
+                rows = int(total.group(1)) if total else None
+    return {
+        'time': start,
+        'kind': kind.group(1).upper() if kind else '',
+        'table': table.group(1) if table else '',
+        'rows': rows,
+        'request_bytes': request_bytes,
+        'response_bytes': response_bytes,
+        'latency': time.time() - start,
+        'status': r.status_code if r is not None else None,
+        'retries': retries,
     }
-    if len(f):
-        payload['format'] = f
-    logging.debug((url, payload))
-    if post:
-        r = requests.post(url, json=payload)
-    else:
-        r = requests.get(url, params=payload)
-    if not r.ok:
+
+
+def _emit(record):
+    '''Hand a record to every sink; a failing sink never fails the call'''
+    for sink in list(SINKS):
+        try:
+            sink(record)
+        except Exception as e:
+            logging.warning('Instrumentation sink failed: {}'.format(e))
+
+
+def _counted(chunks, sent):
+    '''Pass chunks through, adding their size to sent[0]'''
+    for chunk in chunks:
+        sent[0] += len(chunk)
+        yield chunk
+
+
+class JsonLinesSink(object):
+    '''Instrumentation sink appending each record to a JSON-lines file'''
+    def __init__(self, path):
+        self._file = io.open(path, 'a', buffering=1)
+        self._lock = threading.Lock()
+
+    def __call__(self, record):
+        line = json.dumps(record)
+        with self._lock:
+            self._file.write(line + '\n')
+
+    def close(self):
+        self._file.close()
+
+
+class StatsSink(object):
+    '''
+    Instrumentation sink aggregating records by statement kind and table
+    `stats` OrderedDict of (kind, table) to totals
+    '''
+    TOTALS = ('calls', 'rows', 'request_bytes', 'response_bytes', 'latency',
+              'max_latency', 'retries', 'errors')
+
+    def __init__(self):
+        self.stats = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __call__(self, record):
+        with self._lock:
+            totals = self.stats.setdefault(
+                (record['kind'], record['table']),
+                dict.fromkeys(self.TOTALS, 0))
+            totals['calls'] += 1
+            for k in ('rows', 'request_bytes', 'response_bytes', 'latency',
+                      'retries'):
+                totals[k] += record[k] or 0
+            totals['max_latency'] = max(totals['max_latency'],
+                                        record['latency'])
+            status = record['status']
+            totals['errors'] += status is None or status >= 400
+
+    def summary(self):
+        '''Table of totals, slowest statement kind and table first'''
+        header = '{:<8} {:<40} {:>6} {:>9} {:>9} {:>9} {:>9} {:>7} {:>7} ' \
+            '{:>6}'.format('kind', 'table', 'calls', 'rows', 'sent MB',
+                           'recv MB', 'seconds', 'max s', 'retries',
+                           'errors')
+        lines = [header]
+        with self._lock:
+            items = sorted(self.stats.items(),
+                           key=lambda item: -item[1]['latency'])
+        for (kind, table), t in items:
+            lines.append(
+                '{:<8} {:<40} {:>6} {:>9} {:>9.2f} {:>9.2f} {:>9.2f} {:>7.2f} '
+                '{:>7} {:>6}'.format(
+                    kind, table[:40], t['calls'], t['rows'],
+                    t['request_bytes'] / 1e6, t['response_bytes'] / 1e6,
+                    t['latency'], t['max_latency'], t['retries'],
+                    t['errors']))
+        return '\n'.join(lines)
+
+
+def instrument(path=None, summary=True):
+    '''
+    Start recording every SQL API request; returns the StatsSink
+    `path` also append each record to this JSON-lines file
+    `summary` log the StatsSink summary table when the process exits
+    Set the CARTO_INSTRUMENT environment variable to 1 (or to a file path)
+    to enable this at import, without changing the calling script
+    '''
+    stats = StatsSink()
+    SINKS.append(stats)
+    if path:
+        SINKS.append(JsonLinesSink(path))
+    if summary:
+        atexit.register(
+            lambda: logging.info('CARTO requests:\n' + stats.summary()))
+    return stats
+
+
+def _conflictClause(fields, on_conflict, update=False):
+    '''ON CONFLICT clause for insertRows, empty if `on_conflict` is not set'''
+    if not on_conflict:
+        return ''
+    targets = (on_conflict,) if isinstance(on_conflict, str) else on_conflict
+    sets = ', '.join('{0} = EXCLUDED.{0}'.format(f)
+                     for f in fields if f not in targets)
+    # with nothing but the conflict targets there is nothing to overwrite
+    if not update or not sets:
+        return ' ON CONFLICT ({}) DO NOTHING'.format(','.join(targets))
+    return ' ON CONFLICT ({}) DO UPDATE SET {}'.format(','.join(targets), sets)
+
+
+def _notSent(e):
+    '''Check if a failed request never reached the server'''
+    if isinstance(e, requests.exceptions.ConnectTimeout):
+        return True
+    reason = e.args[0] if e.args else None
+    # requests wraps urllib3's MaxRetryError, whose reason is the cause
+    reason = getattr(reason, 'reason', reason)
+    # NewConnectionError (refused, DNS) is a ConnectTimeoutError too
+    return isinstance(reason, urllib3.exceptions.ConnectTimeoutError)
+
+
+def _tooLarge(r):
+    '''Check if a failed response means the statement was too big'''
+    if r.status_code in TOO_LARGE_STATUS:
+        return True
+    text = r.text.lower()
+    return any(e in text for e in TOO_LARGE_ERRORS)
+
+
+class CartoCatalog(object):
+    '''
+    Cached table names and column schemas of one CARTO account
+    `ttl` seconds a fetched table list or schema is trusted; createTable
+        and dropTable on the owning client invalidate it immediately, and
+        a table or column missing from the cache is looked up again before
+        it is reported missing, in case it was created elsewhere (a raw
+        post, another job, the web UI). Columns dropped or retyped
+        elsewhere can still be served stale for up to `ttl`.
+    '''
+    def __init__(self, client, ttl=CATALOG_TTL):
+        self.client = client
+        self.ttl = ttl
+        self._tables = None
+        self._schemas = {}
+        self._lock = threading.Lock()
+
+    def _fresh(self, entry):
+        return entry is not None and time.time() - entry[0] < self.ttl
+
+    def tables(self, refresh=False):
+        '''Set of table names in the account; `refresh` skips the cache'''
+        with self._lock:
+            if refresh or not self._fresh(self._tables):
+                self._tables = (time.time(), set(self.client.getTables()))
+            return self._tables[1]
+
+    def exists(self, table):
+        '''Check if table exists'''
+        with self._lock:
+            cached = self._fresh(self._tables)
+        return table in self.tables() or \
+            (cached and table in self.tables(refresh=True))
+
+    def schema(self, table, refresh=False):
+        '''
+        OrderedDict of column names to field types for table
+        `refresh` skips the cache
+        '''
+        with self._lock:
+            entry = self._schemas.get(table)
+            if refresh or not self._fresh(entry):
+                sql = ("SELECT column_name, data_type, udt_name "
+                       "FROM information_schema.columns WHERE table_name = "
+                       "{} AND table_schema = current_schema() "
+                       "ORDER BY ordinal_position").format(
+                           _escapeValue(table, 'text'))
+                rows = self.client.get(sql).json()['rows']
+                entry = (time.time(), OrderedDict(
+                    (r['column_name'], _fieldType(r['data_type'], r['udt_name']))
+                    for r in rows))
+                self._schemas[table] = entry
+            return entry[1]
+
+    def dtypes(self, table, fields):
+        '''Field types of `fields` in table, for insertRows'''
+        schema = self.schema(table)
+        if any(f not in schema for f in fields):
+            schema = self.schema(table, refresh=True)
+        missing = [f for f in fields if f not in schema]
+        if missing:
+            raise Exception('Fields {} not in table {}'.format(missing, table))
+        return [schema[f] for f in fields]
+
+    def invalidate(self, table=None):
+        '''Forget the table list and the schema of `table` (or all)'''
+        with self._lock:
+            self._tables = None
+            if table is None:
+                self._schemas.clear()
+            else:
+                self._schemas.pop(table, None)
+
+
+def _fieldType(data_type, udt_name):
+    '''Field type as used in schemas here, from information_schema'''
+    if udt_name == 'geometry':
+        return 'geometry'
+    if data_type.startswith('timestamp') or data_type in ('date', 'time'):
+        return 'timestamp'
+    if data_type == 'character varying':
+        return 'varchar'
+    if data_type in RAW_TYPES or data_type in CAST_TYPES:
+        return data_type
+    if data_type == 'ARRAY':
+        # the udt_name of an array type is its element type prefixed by _
+        return udt_name[1:] + '[]'
+    return 'text'
+
+
+class CartoClient(object):
+    '''
+    CARTO SQL API client holding a keep-alive session for one account
+    `pool_size` number of connections kept open (set to the number of
+        threads that share the client)
+    `retries` times to retry a statement on 429/5xx or a dropped connection
+    `backoff` base delay in seconds; retry n sleeps a random time up to
+        min(backoff_max, backoff * 2**n), or the server's Retry-After
+    `url` SQL API endpoint, defaults to the account's CARTO_URL
+    `catalog_ttl` seconds to cache the account's table list and schemas
+    '''
+    def __init__(self, user=CARTO_USER, key=CARTO_KEY, pool_size=POOL_SIZE,
+                 retries=RETRIES, backoff=BACKOFF, backoff_max=BACKOFF_MAX,
+                 url=None, catalog_ttl=CATALOG_TTL):
+        self.user = user
+        self.key = key
+        self.url = url or CARTO_URL.format(user)
+        self._copy = None
+        self.catalog = CartoCatalog(self, catalog_ttl)
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def _sleepTime(self, attempt, r=None):
+        '''Seconds to wait before retry `attempt` (full jitter)'''
+        if r is not None and r.headers.get('Retry-After', '').isdigit():
+            return min(self.backoff_max, float(r.headers['Retry-After']))
+        return random.uniform(
+            0, min(self.backoff_max, self.backoff * 2 ** attempt))
+
+    def _request(self, sql, f='', post=True, retry_status=RETRY_STATUS,
+                 stream=False, rows=None, replay_sent=True):
+        '''
+        Send sql, retrying transient errors; return the last response
+        `rows` row count to report to SINKS, if not in the response
+        `replay_sent` also retry when the connection failed after the
+            request may have been sent; False for non-idempotent statements
+        '''
+        payload = {
+            'api_key': self.key,
+            'q': sql,
+        }
+        if len(f):
+            payload['format'] = f
+        logging.debug((self.url, payload))
+        start = time.time()
+        attempt = 0
+        while True:
+            try:
+                if post:
+                    r = self.session.post(self.url, json=payload,
+                                          stream=stream)
+                else:
+                    r = self.session.get(self.url, params=payload,
+                                         stream=stream)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= self.retries or not (replay_sent or
+                                                   _notSent(e)):
+                    if SINKS:
+                        _emit(_record(sql, start, None, attempt, rows))
+                    raise
+                wait = self._sleepTime(attempt)
+                logging.warning('CARTO request failed ({}), retrying in '
+                                '{:.1f}s'.format(e, wait))
+            else:
+                if r.ok or r.status_code not in retry_status or \
+                        attempt >= self.retries:
+                    if SINKS:
+                        _emit(_record(sql, start, r, attempt, rows, stream))
+                    return r
+                wait = self._sleepTime(attempt, r)
+                logging.warning('CARTO returned {}, retrying in {:.1f}s'.format(
+                    r.status_code, wait))
+            time.sleep(wait)
+            attempt += 1
+
+    def sendSql(self, sql, f='', post=True, **retry):
+        '''
+        Send arbitrary sql and return response object or False
+        `retry` retry_status and replay_sent, see _request
+        '''
+        r = self._request(sql, f, post, **retry)
+        if not r.ok:
+            logging.error(r.text)
+            if STRICT:
+                raise Exception(r.text)
+            return False
+        return r
+
+    def get(self, sql, f=''):
+        '''Send arbitrary sql and return response object or False'''
+        return self.sendSql(sql, f, False)
+
+    def post(self, sql, f=''):
+        '''Send arbitrary sql and return response object or False'''
+        return self.sendSql(sql, f)
+
+    def getFields(self, fields, table, where='', order='', f='', post=False):
+        '''Select fields from table'''
+        fields = (fields,) if isinstance(fields, str) else fields
+        where = ' WHERE {}'.format(where) if where else ''
+        order = ' ORDER BY {}'.format(order) if order else ''
+        sql = 'SELECT {} FROM "{}" {} {}'.format(
+            ','.join(fields), table, where, order)
+        return self.sendSql(sql, f, post)
+
+    def _streamCsv(self, sql):
+        '''Yield the rows of a CSV query result as they arrive'''
+        r = self._request(sql, 'csv', stream=True)
+        try:
+            if not r.ok:
+                logging.error(r.text)
+                if STRICT:
+                    raise Exception(r.text)
+                return
+            r.raw.decode_content = True
+            r.raw.auto_close = False
+            reader = csv.reader(io.TextIOWrapper(
+                io.BufferedReader(r.raw, STREAM_CHUNK_BYTES),
+                encoding=r.encoding or 'utf-8', newline=''))
+            next(reader, None)
+            for row in reader:
+                yield row
+        finally:
+            r.close()
+
+    def _iterValues(self, field, table, where, order, pagesize, dtype):
+        where = '({})'.format(where) if where else ''
+        if not pagesize:
+            order = ' ORDER BY {}'.format(order) if order else ''
+            sql = 'SELECT {} FROM "{}"{}{}'.format(
+                field, table, ' WHERE ' + where if where else '', order)
+            for row in self._streamCsv(sql):
+                yield row[0] if row else ''
+            return
+        last = None
+        while True:
+            conds = [where] if where else []
+            conds.append('{} IS NOT NULL'.format(field))
+            if last is not None:
+                conds.append('{} > {}'.format(field, _escapeValue(last, dtype)))
+            sql = 'SELECT {0} FROM "{1}" WHERE {2} ORDER BY {0} LIMIT {3}'.format(
+                field, table, ' AND '.join(conds), pagesize)
+            n = 0
+            for row in self._streamCsv(sql):
+                last = row[0]
+                n += 1
+                yield last
+            if n < pagesize:
+                return
+
+    def iterFields(self, field, table, where='', order='', collect=None,
+                   pagesize=0, dtype='text'):
+        '''
+        Stream the values of one field from table without buffering the
+        whole response
+        `collect` None for a generator, or 'list', 'set' or 'array' (a NumPy
+            array, int64 for integer dtypes, else float64)
+        `pagesize` if set, fetch pages of this many rows using keyset
+            pagination on `field`, which must then be unique and is also the
+            sort order (`order` is not allowed); NULLs are skipped
+        `dtype` field type; numeric types are returned as numbers
+        '''
+        if pagesize and order:
+            raise ValueError('order cannot be combined with pagesize')
+        values = self._iterValues(field, table, where, order, pagesize, dtype)
+        if dtype in INT_TYPES:
+            values = (int(v) for v in values if v != '')
+        elif dtype in NUMERIC_TYPES:
+            values = (float(v) for v in values if v != '')
+        if collect == 'list':
+            return list(values)
+        if collect == 'set':
+            return set(values)
+        if collect == 'array':
+            import numpy as np
+            return np.fromiter(
+                values, dtype='int64' if dtype in INT_TYPES else 'float64')
+        return values
+
+    def getTables(self, f='csv'):
+        '''Get the list of tables'''
+        r = self.get('SELECT * FROM CDB_UserTables()', f=f)
+        if f == 'csv':
+            return r.text.split("\r\n")[1:-1]
+        return r
+
+    def tableExists(self, table):
+        '''Check if table exists, using the cached catalog'''
+        return self.catalog.exists(table)
+
+    def createTable(self, table, schema):
+        '''
+        Create table with schema and CartoDBfy table
+        `schema` should be a dict or list of tuple pairs with
+         - keys as field names and
+         - values as field types
+        '''
+        items = schema.items() if isinstance(schema, dict) else schema
+        defslist = ['{} {}'.format(k, v) for k, v in items]
+        sql = 'CREATE TABLE "{}" ({})'.format(table, ','.join(defslist))
+        r = self.post(sql)
+        self.catalog.invalidate(table)
+        if r:
+            return self._cdbfyTable(table)
+        return False
+
+    def _cdbfyTable(self, table):
+        '''CartoDBfy table so that it appears in Carto UI'''
+        sql = "SELECT cdb_cartodbfytable('{}','\"{}\"')".format(
+            self.user, table)
+        return self.post(sql)
+
+    def createIndex(self, table, fields, unique='', using=''):
+        '''Create index on table on field(s)'''
+        fields = (fields,) if isinstance(fields, str) else fields
+        f_underscore = '_'.join(fields)
+        f_comma = ','.join(fields)
+        unique = 'UNIQUE' if unique else ''
+        using = 'USING {}'.format(using) if using else ''
+        sql = 'CREATE {} INDEX idx_{}_{} ON {} {} ({})'.format(
+            unique, table, f_underscore, table, using, f_comma)
+        return self.post(sql)
+
+    def _insertRows(self, table, fields, dtypes, rows):
+        values = _dumpRows(rows, tuple(dtypes))
+        sql = 'INSERT INTO "{}" ({}) VALUES {}'.format(
+            table, ', '.join(fields), values)
+        # a plain INSERT replayed after it may have committed duplicates rows
+        return self.sendSql(sql, retry_status=INSERT_RETRY_STATUS,
+                            replay_sent=False)
+
+    def _insertBlock(self, head, values, start, result, tail=''):
+        '''
+        Insert a block of dumped rows, bisecting it while CARTO rejects it
+        as too large; record each block sent in `result`
+        `head` the statement up to VALUES, `tail` any clause after them
+        '''
+        sql = head + ','.join(values) + tail
+        nbytes = len(sql.encode('utf-8'))
+        # with an ON CONFLICT clause a replayed block can't duplicate rows
+        try:
+            r = self._request(sql, retry_status=RETRY_STATUS if tail
+                              else INSERT_RETRY_STATUS, rows=len(values),
+                              replay_sent=bool(tail))
+        except Exception as e:
+            logging.error(e)
+            result.error = str(e)
+            result.blocks.append(
+                InsertBlock(start, len(values), nbytes, False, 0))
+            return False
+        if r.ok:
+            inserted = r.json().get('total_rows', len(values))
+            result.blocks.append(
+                InsertBlock(start, len(values), nbytes, True, inserted))
+            return True
+        if len(values) > 1 and _tooLarge(r):
+            half = len(values) // 2
+            logging.warning('Block of {} rows ({} bytes) rejected by CARTO, '
+                            'splitting'.format(len(values), nbytes))
+            first = self._insertBlock(
+                head, values[:half], start, result, tail)
+            second = self._insertBlock(
+                head, values[half:], start + half, result, tail)
+            return first and second
         logging.error(r.text)
-        if STRICT:
-            raise Exception(r.text)
+        result.error = r.text
+        result.blocks.append(InsertBlock(start, len(values), nbytes, False, 0))
         return False
-    return r
+
+    @_traced('carto_insert')
+    def insertRows(self, table, fields, dtypes, rows, blocksize=None,
+                   maxbytes=MAX_BLOCK_BYTES, workers=1, on_conflict='',
+                   update=False):
+        '''
+        Insert rows into table
+        `rows` must be an iterable of lists containing the data to be
+            inserted, or a pandas DataFrame with the columns in order
+        `fields` field names for the columns in `rows`
+        `dtypes` field types for the columns in `rows`, or None to look
+            them up in the table's cached schema
+        Rows are escaped column-wise in batches, see _dumpColumns
+        Packs rows into requests of up to `maxbytes` of SQL (and at most
+        `blocksize` rows, if given); blocks that CARTO rejects as too large or
+        that hit the statement timeout are split in half and retried
+        A failed block does not stop the rest, so `failed` of the result
+        lists every row range that was not inserted
+        With `workers` > 1, blocks are serialized while up to `workers`
+        earlier blocks are in flight; keep `workers` within the client's
+        pool_size
+        `on_conflict` field(s) with a unique index (e.g. from createIndex
+            with unique=True); rows whose values already exist are skipped
+            server side (ON CONFLICT DO NOTHING), or with `update`, overwrite
+            the existing row (a block must then not repeat a value); only
+            then are blocks retried after errors that may follow a commit
+            (500, 502, 504, a connection dropped mid-request)
+        Returns an InsertResult, true if all rows were inserted, whose
+        `inserted` counts the rows actually written (skipped ones excluded;
+        with `update`, overwritten ones included); under STRICT a failure
+        raises InsertError carrying the result instead
+        '''
+        fields = list(fields)
+        if dtypes is None:
+            dtypes = self.catalog.dtypes(table, fields)
+        escapers = [_escaperFor(d) for d in dtypes]
+        head = 'INSERT INTO "{}" ({}) VALUES '.format(table, ', '.join(fields))
+        tail = _conflictClause(fields, on_conflict, update)
+        result = InsertResult()
+        executor = ThreadPoolExecutor(workers) if workers > 1 else None
+        # future of each block in flight: its first row, rows and bytes
+        pending = {}
+
+        def collect(futures):
+            '''Record blocks whose worker raised as failed'''
+            for future in futures:
+                start, nrows, nbytes = pending.pop(future)
+                try:
+                    future.result()
+                except Exception as e:
+                    logging.error(e)
+                    result.error = str(e)
+                    result.blocks.append(
+                        InsertBlock(start, nrows, nbytes, False, 0))
+
+        def flush(block, start, nbytes):
+            if executor is None:
+                self._insertBlock(head, block, start, result, tail)
+                return
+            # keep at most `workers` blocks in flight
+            while len(pending) >= workers:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            future = executor.submit(
+                self._insertBlock, head, block, start, result, tail)
+            pending[future] = (start, len(block), nbytes)
+
+        block = []
+        start = nbytes = 0
+        try:
+            for i, value in enumerate(_iterDumped(rows, escapers)):
+                size = len(value.encode('utf-8')) + 1
+                if block and (nbytes + size > maxbytes or
+                              len(block) == blocksize):
+                    flush(block, start, nbytes)
+                    block = []
+                    start = i
+                    nbytes = 0
+                block.append(value)
+                nbytes += size
+            if block:
+                flush(block, start, nbytes)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+                collect(list(pending))
+        result.blocks.sort()
+        if result.rows:
+            logging.info('Inserted {} rows into {} in {} blocks of {}'.format(
+                result.inserted, table, len(result.blocks),
+                ', '.join('{} rows/{} bytes'.format(b.rows, b.bytes)
+                          for b in result.blocks if b.ok)))
+        if not result.ok and STRICT:
+            raise InsertError(result.error, result)
+        return result
+
+    def _copyFrom(self, sql, data):
+        '''Post a COPY ... FROM STDIN statement with `data` as its body'''
+        params = {
+            'api_key': self.key,
+            'q': sql,
+        }
+        logging.debug((self.url + '/copyfrom', sql))
+        start = time.time()
+        sent = [len(data)] if isinstance(data, bytes) else [0]
+        if SINKS and not isinstance(data, bytes):
+            data = _counted(data, sent)
+        r = self.session.post(
+            self.url + '/copyfrom', params=params, data=data,
+            headers={'Content-Type': 'application/octet-stream'})
+        if SINKS:
+            _emit(_record(sql, start, r, 0, request_bytes=sent[0]))
+        return r
+
+    @_traced('carto_copy')
+    def copyRows(self, table, fields, dtypes, rows,
+                 chunksize=COPY_CHUNK_BYTES):
+        '''
+        Bulk load rows into table through the SQL API COPY endpoint
+        `rows` an iterable (e.g. a generator) of lists of values; they are
+            streamed as CSV in chunks of `chunksize` bytes, never held in
+            memory all at once
+        `fields` field names for the columns in `rows`
+        `dtypes` field types for the columns in `rows` (None to use the
+            table's cached schema); geometry objects
+            are sent as EWKB hex (needs shapely), geometry strings as is,
+            so they must be WKT, EWKT or hex (E)WKB rather than SQL
+        Falls back to insertRows if the account has no COPY endpoint; the
+        streamed load cannot be replayed, so it is not retried
+        Returns the number of rows loaded, or False
+        '''
+        fields = list(fields)
+        if dtypes is None:
+            dtypes = self.catalog.dtypes(table, fields)
+        dtypes = tuple(dtypes)
+        sql = ('COPY "{}" ({}) FROM STDIN '
+               "WITH (FORMAT csv, NULL '{}')").format(
+            table, ', '.join(fields), COPY_NULL)
+        if self._copy is None:
+            # an empty load is a no-op, use it to probe for the endpoint
+            self._copy = self._copyFrom(sql, b'').status_code not in \
+                COPY_UNAVAILABLE_STATUS
+        if not self._copy:
+            logging.info('COPY unavailable, falling back to insertRows')
+            result = self.insertRows(table, fields, dtypes, rows)
+            return result.rows if result else False
+        r = self._copyFrom(sql, _csvChunks(rows, dtypes, chunksize))
+        if not r.ok:
+            logging.error(r.text)
+            if STRICT:
+                raise Exception(r.text)
+            return False
+        num = r.json()['total_rows']
+        logging.info('Copied {} rows into {}'.format(num, table))
+        return num
+
+    def deleteRows(self, table, where):
+        '''Delete rows from table'''
+        sql = 'DELETE FROM "{}" WHERE {}'.format(table, where)
+        return self.post(sql)
+
+    def _byIDs(self, head, table, id_field, ids, dtype, maxbytes, workers,
+               f=''):
+        '''
+        Run `head` + `id_field` = ANY(ARRAY[...]) for batches of ids of up to
+        `maxbytes`, `workers` at a time; return the responses in order
+        The array is cast to `dtype`, by default the column's type in the
+        cached schema, so e.g. timestamps given as text still compare
+        '''
+        if not dtype:
+            dtype = self.catalog.dtypes(table, [id_field])[0]
+        escape = _escaperFor(dtype)
+        cast = '' if callable(dtype) or dtype.endswith('[]') or \
+            dtype == 'geometry' else '::{}[]'.format(dtype)
+        head = '{}{} = ANY(ARRAY['.format(head, id_field)
+        tail = ']{})'.format(cast)
+        batches = list(_arrayBatches(escape(list(ids)), maxbytes))
+        if workers > 1 and len(batches) > 1:
+            with ThreadPoolExecutor(min(workers, len(batches))) as executor:
+                return list(executor.map(
+                    lambda b: self.post(head + b + tail, f), batches))
+        return [self.post(head + b + tail, f) for b in batches]
+
+    def deleteRowsByIDs(self, table, ids, id_field='cartodb_id', dtype='',
+                        maxbytes=MAX_BLOCK_BYTES, workers=ID_WORKERS):
+        '''
+        Delete rows from table by IDs
+        `ids` values of `id_field`, escaped and cast as `dtype` (by default
+            the column's type)
+        IDs are sent as `id_field = ANY(ARRAY[...])` in batches of up to
+        `maxbytes`, `workers` batches at a time
+        Returns the number of rows deleted
+        '''
+        head = 'DELETE FROM "{}" WHERE '.format(table)
+        responses = self._byIDs(head, table, id_field, ids, dtype, maxbytes,
+                                workers)
+        return sum(r.json()['total_rows'] for r in responses if r)
+
+    def selectRowsByIDs(self, table, ids, fields='*', id_field='cartodb_id',
+                        dtype='', f='', maxbytes=MAX_BLOCK_BYTES,
+                        workers=ID_WORKERS):
+        '''
+        Select rows from table by IDs, batched like deleteRowsByIDs
+        Returns the rows as a list of dicts, or with f='GeoJSON' a
+        FeatureCollection dict
+        '''
+        fields = (fields,) if isinstance(fields, str) else fields
+        head = 'SELECT {} FROM "{}" WHERE '.format(','.join(fields), table)
+        responses = self._byIDs(head, table, id_field, ids, dtype, maxbytes,
+                                workers, f)
+        if f.lower() == 'geojson':
+            return {'type': 'FeatureCollection', 'features': [
+                feat for r in responses if r for feat in r.json()['features']]}
+        return [row for r in responses if r for row in r.json()['rows']]
+
+    def dropTable(self, table):
+        '''Delete table'''
+        sql = 'DROP TABLE "{}"'.format(table)
+        r = self.post(sql)
+        self.catalog.invalidate(table)
+        return r
+
+    def truncateTable(self, table):
+        '''Delete table'''
+        sql = 'TRUNCATE TABLE "{}"'.format(table)
+        return self.post(sql)
+
+
+# one shared client per account, so module-level calls reuse connections
+_clients = {}
+
+
+def getClient(user=CARTO_USER, key=CARTO_KEY):
+    '''Return the shared CartoClient for an account'''
+    client = _clients.get((user, key))
+    if client is None:
+        client = _clients.setdefault((user, key), CartoClient(user, key))
+    return client
+
+
+def sendSql(sql, user=CARTO_USER, key=CARTO_KEY, f='', post=True):
+    '''Send arbitrary sql and return response object or False'''
+    return getClient(user, key).sendSql(sql, f, post)
 
 
 def get(sql, user=CARTO_USER, key=CARTO_KEY, f=''):
@@ -58,25 +941,27 @@ def post(sql, user=CARTO_USER, key=CARTO_KEY, f=''):
 def getFields(fields, table, where='', order='', user=CARTO_USER,
               key=CARTO_KEY, f='', post=False):
     '''Select fields from table'''
-    fields = (fields,) if isinstance(fields, str) else fields
-    where = ' WHERE {}'.format(where) if where else ''
-    order = ' ORDER BY {}'.format(order) if order else ''
-    sql = 'SELECT {} FROM "{}" {} {}'.format(
-        ','.join(fields), table, where, order)
-    return sendSql(sql, user, key, f, post)
+    return getClient(user, key).getFields(fields, table, where, order, f, post)
+
+
+def iterFields(field, table, where='', order='', user=CARTO_USER,
+               key=CARTO_KEY, collect=None, pagesize=0, dtype='text'):
+    '''
+    Stream the values of one field from table, as a generator or collected
+    into a list, set or NumPy array; see CartoClient.iterFields
+    '''
+    return getClient(user, key).iterFields(field, table, where, order,
+                                           collect, pagesize, dtype)
 
 
 def getTables(user=CARTO_USER, key=CARTO_KEY, f='csv'):
     '''Get the list of tables'''
-    r = get('SELECT * FROM CDB_UserTables()',user, key, f=f)
-    if f == 'csv':
-        return r.text.split("\r\n")[1:-1]
-    return r
+    return getClient(user, key).getTables(f)
 
 
 def tableExists(table, user=CARTO_USER, key=CARTO_KEY):
     '''Check if table exists'''
-    return table in getTables()
+    return getClient(user, key).tableExists(table)
 
 
 def createTable(table, schema, user=CARTO_USER, key=CARTO_KEY):
@@ -86,31 +971,18 @@ def createTable(table, schema, user=CARTO_USER, key=CARTO_KEY):
      - keys as field names and
      - values as field types
     '''
-    items = schema.items() if isinstance(schema, dict) else schema
-    defslist = ['{} {}'.format(k, v) for k, v in items]
-    sql = 'CREATE TABLE "{}" ({})'.format(table, ','.join(defslist))
-    if post(sql, user, key):
-        return _cdbfyTable(table, user, key)
-    return False
+    return getClient(user, key).createTable(table, schema)
 
 
 def _cdbfyTable(table, user=CARTO_USER, key=CARTO_KEY):
     '''CartoDBfy table so that it appears in Carto UI'''
-    sql = "SELECT cdb_cartodbfytable('{}','\"{}\"')".format(user, table)
-    return post(sql, user, key)
+    return getClient(user, key)._cdbfyTable(table)
 
 
 def createIndex(table, fields, unique='', using='', user=CARTO_USER,
                 key=CARTO_KEY):
     '''Create index on table on field(s)'''
-    fields = (fields,) if isinstance(fields, str) else fields
-    f_underscore = '_'.join(fields)
-    f_comma = ','.join(fields)
-    unique = 'UNIQUE' if unique else ''
-    using = 'USING {}'.format(using) if using else ''
-    sql = 'CREATE {} INDEX idx_{}_{} ON {} {} ({})'.format(
-        unique, table, f_underscore, table, using, f_comma)
-    return post(sql, user, key)
+    return getClient(user, key).createIndex(table, fields, unique, using)
 
 
 def _escapeValue(value, dtype):
@@ -141,69 +1013,353 @@ def _escapeValue(value, dtype):
         return str(value)
 
 
+def _dumpRow(row, dtypes):
+    '''Escapes a row of data to an SQL tuple string'''
+    escaped = [
+        _escapeValue(row[i], dtypes[i])
+        for i in range(len(dtypes))
+    ]
+    return '({})'.format(','.join(escaped))
+
+
 def _dumpRows(rows, dtypes):
     '''Escapes rows of data to SQL strings'''
-    dumpedRows = []
+    return ','.join(_dumpRow(row, dtypes) for row in rows)
+
+
+def _isNull(v):
+    '''Check if v is None or a NaN/NaT, pandas' missing values'''
+    if v is None:
+        return True
+    try:
+        return bool(v != v)
+    except (TypeError, ValueError):
+        # e.g. pandas.NA, or an array value
+        return False
+
+
+def _textEscaper(values):
+    '''Escape a text column: quote strings and escape quotes, NaN as NULL'''
+    return ["NULL" if v is None or v != v
+            else "'" + str(v).replace("'", "''") + "'" for v in values]
+
+
+# timestamps are quoted like text, NaT as NULL
+_timestampEscaper = _textEscaper
+
+
+def _rawEscaper(values):
+    '''Escape a numeric (or other) column: as is, with NaN as NULL'''
+    return ["NULL" if v is None or v != v else str(v) for v in values]
+
+
+def _jsonText(value):
+    '''A json value as text: strings as is, other objects dumped'''
+    return value if isinstance(value, str) else json.dumps(value)
+
+
+def _arrayText(value):
+    '''A list as a Postgres array literal; strings are passed through'''
+    if isinstance(value, str):
+        return value
+    return '{' + ','.join(
+        'NULL' if v is None else
+        '"' + str(v).replace('\\', '\\\\').replace('"', '\\"') + '"'
+        for v in value) + '}'
+
+
+def _castEscaper(cast, text=str):
+    '''
+    Escaper for a column quoted like text and cast to the type `cast`
+    `text` converts each (non-NULL) value to its text representation
+    '''
+    def escape(values):
+        return ["NULL" if v is None or v != v else
+                "'" + text(v).replace("'", "''") + "'::" + cast
+                for v in values]
+    return escape
+
+
+def _geometryEscaper(values):
+    '''
+    Escape a geometry column: strings as is, GeoJSON dicts and shapely
+    geometries as hex WKB encoded in bulk (needs numpy, and shapely 2 for
+    shapely geometries); falls back to GeoJSON text without them
+    '''
+    escaped = ["NULL" if _isNull(v) else v for v in values]
+    objs = [i for i, v in enumerate(escaped) if not isinstance(v, str)]
+    if not objs:
+        return escaped
+    try:
+        wkbs = _bulkWkbHex([escaped[i] for i in objs])
+    except ImportError:
+        for i in objs:
+            # shapely geometries as their GeoJSON mapping
+            escaped[i] = _escapeValue(
+                getattr(escaped[i], '__geo_interface__', escaped[i]),
+                'geometry')
+        return escaped
+    for i, wkb in zip(objs, wkbs):
+        escaped[i] = "ST_GeomFromWKB(decode('" + wkb + "','hex'),4326)"
+    return escaped
+
+
+def _bulkWkbHex(geoms):
+    '''Encode GeoJSON dicts or shapely geometries as hex WKB in one pass'''
+    import numpy as np
+    wkbs = [None] * len(geoms)
+    # 2D GeoJSON points are packed straight from a coordinate array
+    points = [i for i, g in enumerate(geoms) if isinstance(g, dict) and
+              g.get('type') == 'Point' and len(g['coordinates']) == 2]
+    if points:
+        dtype = np.dtype([('order', 'u1'), ('type', '<u4'), ('xy', '<f8', 2)])
+        packed = np.empty(len(points), dtype=dtype)
+        packed['order'] = 1
+        packed['type'] = 1
+        packed['xy'] = [geoms[i]['coordinates'] for i in points]
+        hexed = binascii.hexlify(packed.tobytes()).decode('ascii').upper()
+        n = 2 * dtype.itemsize
+        for k, i in enumerate(points):
+            wkbs[i] = hexed[k * n:(k + 1) * n]
+    # other 2D GeoJSON is packed shape by shape from coordinate arrays
+    for i, g in enumerate(geoms):
+        if wkbs[i] is None and isinstance(g, dict):
+            wkb = _packGeoJSON(g, np)
+            if wkb is not None:
+                wkbs[i] = binascii.hexlify(wkb).decode('ascii').upper()
+    others = [i for i, w in enumerate(wkbs) if w is None]
+    if others:
+        # shapely geometries (e.g. a GeoDataFrame column) use vectorized to_wkb
+        import shapely
+        from shapely.geometry import shape
+        if not hasattr(shapely, 'to_wkb'):
+            raise ImportError('shapely 2 is needed to encode in bulk')
+        arr = np.empty(len(others), dtype=object)
+        arr[:] = [g if isinstance(g, shapely.Geometry) else shape(g)
+                  for g in (geoms[i] for i in others)]
+        for i, wkb in zip(others, shapely.to_wkb(arr, hex=True)):
+            wkbs[i] = wkb
+    return wkbs
+
+
+_WKB_TYPES = {'Point': 1, 'LineString': 2, 'Polygon': 3, 'MultiPoint': 4,
+              'MultiLineString': 5, 'MultiPolygon': 6}
+_MULTI_PARTS = {'MultiPoint': 'Point', 'MultiLineString': 'LineString',
+                'MultiPolygon': 'Polygon'}
+
+
+def _packGeoJSON(geom, np):
+    '''WKB bytes of a 2D GeoJSON geometry dict, or None if unsupported'''
+    kind = geom.get('type')
+    coords = geom.get('coordinates')
+    if kind not in _WKB_TYPES or coords is None:
+        return None
+    if kind in _MULTI_PARTS:
+        parts = [_packGeoJSON({'type': _MULTI_PARTS[kind], 'coordinates': c},
+                              np) for c in coords]
+        if any(p is None for p in parts):
+            return None
+        return struct.pack('<BII', 1, _WKB_TYPES[kind], len(parts)) + \
+            b''.join(parts)
+    rings = [coords] if kind != 'Polygon' else coords
+    arrays = [np.asarray(r, dtype='<f8') for r in rings]
+    if any(a.shape[-1:] != (2,) for a in arrays):
+        return None
+    if kind == 'Point':
+        return struct.pack('<BI', 1, 1) + arrays[0].tobytes()
+    body = b''.join(struct.pack('<I', len(a)) + a.tobytes() for a in arrays)
+    if kind == 'LineString':
+        return struct.pack('<BI', 1, 2) + body
+    return struct.pack('<BII', 1, 3, len(arrays)) + body
+
+
+# column escaper for each field type; arrays are cast (see _escaperFor) and
+# other types use _rawEscaper
+_COLUMN_ESCAPERS = {
+    'geometry': _geometryEscaper,
+    'text': _textEscaper,
+    'varchar': _textEscaper,
+    'timestamp': _timestampEscaper,
+    'uuid': _castEscaper('uuid'),
+    'json': _castEscaper('json', _jsonText),
+    'jsonb': _castEscaper('jsonb', _jsonText),
+}
+
+
+def _escaperFor(dtype):
+    '''Column escaper for a field type; escapers are passed through'''
+    if callable(dtype):
+        return dtype
+    if dtype in _COLUMN_ESCAPERS:
+        return _COLUMN_ESCAPERS[dtype]
+    if dtype.endswith('[]'):
+        return _castEscaper(dtype, _arrayText)
+    return _rawEscaper
+
+
+def _dumpColumns(columns, dtypes):
+    '''
+    Escapes columns of data to SQL row strings
+    `columns` a sequence of columns (lists, NumPy arrays or pandas Series)
+    `dtypes` field types, or escapers from _COLUMN_ESCAPERS, per column
+    '''
+    escapers = [_escaperFor(d) for d in dtypes]
+    escaped = [escape(col) for escape, col in zip(escapers, columns)]
+    return ['(' + ','.join(row) + ')' for row in zip(*escaped)]
+
+
+def _iterDumped(rows, escapers, batchsize=SERIALIZE_BATCH):
+    '''Yield rows (lists or a DataFrame) as SQL row strings, by batch'''
+    ncols = len(escapers)
+    if hasattr(rows, 'iloc'):
+        for i in range(0, len(rows), batchsize):
+            batch = rows.iloc[i:i + batchsize]
+            for value in _dumpColumns(
+                    [batch.iloc[:, j].values for j in range(ncols)], escapers):
+                yield value
+        return
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, batchsize))
+        if not batch:
+            return
+        for value in _dumpColumns(list(zip(*batch))[:ncols], escapers):
+            yield value
+
+
+def _arrayBatches(values, maxbytes):
+    '''Join escaped values into comma separated lists of up to `maxbytes`'''
+    batch = []
+    nbytes = 0
+    for v in values:
+        size = len(v.encode('utf-8')) + 1
+        if batch and nbytes + size > maxbytes:
+            yield ','.join(batch)
+            batch = []
+            nbytes = 0
+        batch.append(v)
+        nbytes += size
+    if batch:
+        yield ','.join(batch)
+
+
+def _ewkbHex(geom):
+    '''Geometry as hex EWKB (SRID 4326); strings are passed through'''
+    if isinstance(geom, str):
+        return geom
+    # GeoJSON points are by far the most common, pack them directly
+    if isinstance(geom, dict) and geom.get('type') == 'Point' and \
+            len(geom['coordinates']) == 2:
+        ewkb = _EWKB_POINT.pack(1, 0x20000001, 4326, *geom['coordinates'])
+        return binascii.hexlify(ewkb).decode('ascii').upper()
+    from shapely import geometry, wkb
+    return wkb.dumps(geometry.shape(geom), hex=True, srid=4326)
+
+
+_EWKB_POINT = struct.Struct('<BIIdd')
+
+
+def _csvChunks(rows, dtypes, chunksize=COPY_CHUNK_BYTES):
+    '''Yield rows as utf-8 CSV for COPY, in chunks of about `chunksize`'''
+    geoms = [i for i, dtype in enumerate(dtypes) if dtype == 'geometry']
+    # json and array columns given as objects are sent in their text form
+    texts = [(i, _jsonText if dtype in ('json', 'jsonb') else _arrayText)
+             for i, dtype in enumerate(dtypes)
+             if dtype in ('json', 'jsonb') or dtype.endswith('[]')]
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator='\n')
     for row in rows:
-        escaped = [
-            _escapeValue(row[i], dtypes[i])
-            for i in range(len(dtypes))
-        ]
-        dumpedRows.append('({})'.format(','.join(escaped)))
-    return ','.join(dumpedRows)
+        # NaN as NULL, as insertRows sends it
+        row = [None if _isNull(v) else v for v in row]
+        for i in geoms:
+            if row[i] is not None:
+                row[i] = _ewkbHex(row[i])
+        for i, text in texts:
+            if row[i] is not None:
+                row[i] = text(row[i])
+        row = [COPY_NULL if v is None else v for v in row]
+        writer.writerow(row)
+        if buf.tell() >= chunksize:
+            yield buf.getvalue().encode('utf-8')
+            buf.seek(0)
+            buf.truncate()
+    if buf.tell():
+        yield buf.getvalue().encode('utf-8')
 
 
 def _insertRows(table, fields, dtypes, rows, user=CARTO_USER, key=CARTO_KEY):
-    values = _dumpRows(rows, tuple(dtypes))
-    sql = 'INSERT INTO "{}" ({}) VALUES {}'.format(
-        table, ', '.join(fields), values)
-    return post(sql, user, key)
+    return getClient(user, key)._insertRows(table, fields, dtypes, rows)
 
 
 def insertRows(table, fields, dtypes, rows, user=CARTO_USER,
-               key=CARTO_KEY, blocksize=1000):
+               key=CARTO_KEY, blocksize=None, maxbytes=MAX_BLOCK_BYTES,
+               workers=1, on_conflict='', update=False):
     '''
     Insert rows into table
-    `rows` must be a list of lists containing the data to be inserted
+    `rows` must be an iterable of lists containing the data to be inserted
     `fields` field names for the columns in `rows`
     `dtypes` field types for the columns in `rows`
-    Automatically breaks into multiple requests at `blocksize` rows
+    Automatically breaks into multiple requests of up to `maxbytes` of SQL
+    (and `blocksize` rows, if given), optionally sending `workers` blocks
+    concurrently; rows conflicting on the unique `on_conflict` field(s) are
+    skipped, or with `update` overwritten; see CartoClient.insertRows
     '''
-    # iterate in blocks
-    while len(rows):
-        if not _insertRows(table, fields, dtypes, rows[:blocksize], user, key):
-            return False
-        rows = rows[blocksize:]
-    return True
+    return getClient(user, key).insertRows(table, fields, dtypes, rows,
+                                           blocksize, maxbytes, workers,
+                                           on_conflict, update)
 
 # Alias insertRows
 blockInsertRows = insertRows
 
 
+def copyRows(table, fields, dtypes, rows, user=CARTO_USER, key=CARTO_KEY,
+             chunksize=COPY_CHUNK_BYTES):
+    '''
+    Bulk load rows into table by streaming CSV to the COPY endpoint,
+    falling back to insertRows; see CartoClient.copyRows
+    '''
+    return getClient(user, key).copyRows(table, fields, dtypes, rows,
+                                         chunksize)
+
+
 def deleteRows(table, where, user=CARTO_USER, key=CARTO_KEY):
     '''Delete rows from table'''
-    sql = 'DELETE FROM "{}" WHERE {}'.format(table, where)
-    return post(sql)
+    return getClient(user, key).deleteRows(table, where)
 
 
 def deleteRowsByIDs(table, ids, id_field='cartodb_id', dtype='',
-                    user=CARTO_USER, key=CARTO_KEY):
-    '''Delete rows from table by IDs'''
-    if dtype:
-        ids = [_escapeValue(i, dtype) for i in ids]
-    where = '{} in ({})'.format(id_field, ','.join(ids))
-    return deleteRows(table, where, user, key)
+                    user=CARTO_USER, key=CARTO_KEY, maxbytes=MAX_BLOCK_BYTES,
+                    workers=ID_WORKERS):
+    '''
+    Delete rows from table by IDs, in concurrent batches of
+    `id_field` = ANY(ARRAY[...]); returns the number of rows deleted
+    '''
+    return getClient(user, key).deleteRowsByIDs(table, ids, id_field, dtype,
+                                                maxbytes, workers)
+
+
+def selectRowsByIDs(table, ids, fields='*', id_field='cartodb_id', dtype='',
+                    user=CARTO_USER, key=CARTO_KEY, f='',
+                    maxbytes=MAX_BLOCK_BYTES, workers=ID_WORKERS):
+    '''
+    Select rows from table by IDs, in concurrent batches; returns a list of
+    row dicts, or with f='GeoJSON' a FeatureCollection dict
+    '''
+    return getClient(user, key).selectRowsByIDs(table, ids, fields, id_field,
+                                                dtype, f, maxbytes, workers)
 
 
 def dropTable(table, user=CARTO_USER, key=CARTO_KEY):
     '''Delete table'''
-    sql = 'DROP TABLE "{}"'.format(table)
-    return post(sql)
+    return getClient(user, key).dropTable(table)
 
 def truncateTable(table, user=CARTO_USER, key=CARTO_KEY):
     '''Delete table'''
-    sql = 'TRUNCATE TABLE "{}"'.format(table)
-    return post(sql)
+    return getClient(user, key).truncateTable(table)
+
+if os.environ.get('CARTO_INSTRUMENT'):
+    instrument(None if os.environ['CARTO_INSTRUMENT'] in ('1', 'true')
+               else os.environ['CARTO_INSTRUMENT'])
 
 if __name__ == '__main__':
     from . import cli
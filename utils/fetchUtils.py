@@ -0,0 +1,473 @@
+'''
+Shared download layer with an on-disk, content-addressed cache
+Example:
+```
+import fetchUtils
+# drop-in for urllib.request.urlretrieve(url, filename)
+result = fetchUtils.fetch(url, os.path.join(DATA_DIR, 'source.nc'))
+if not result.changed:
+    logging.info('Source unchanged, nothing to process')
+logging.info(fetchUtils.stats())
+```
+Each URL's ETag and Last-Modified are kept, so repeat downloads are
+conditional GETs; a 304 (or a body whose sha256 is already cached) is
+served from the cache. Files are streamed to a temporary file and renamed
+into place, so a dropped connection never leaves a partial file behind.
+The cache is kept out of data/, which the jobs empty on every run; set
+FETCH_CACHE_DIR to a folder on a volume that outlives the container. URLs
+not fetched for CACHE_MAX_AGE, and the least recently fetched beyond
+CACHE_MAX_BYTES, are dropped along with blobs no URL refers to any more.
+
+For large archives, download() fetches byte ranges concurrently and can
+resume after a failure:
+```
+fetchUtils.download(WDPA_URL, os.path.join(DATA_DIR, 'wdpa.zip'))
+```
+'''
+from __future__ import unicode_literals
+import hashlib
+import io
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from urllib.parse import urlparse
+from urllib.request import urlopen
+
+try:
+    import traceUtils
+except ImportError:
+    # optional: without it fetches are not traced or counted
+    traceUtils = None
+
+
+def _traced(name):
+    '''traceUtils.traced, or the function untouched without traceUtils'''
+    if traceUtils is None:
+        return lambda fn: fn
+    return traceUtils.traced(name)
+
+
+def _traceCount(**counts):
+    '''traceUtils.count, if traceUtils is available'''
+    if traceUtils is not None:
+        traceUtils.count(**counts)
+
+
+CACHE_DIR = os.environ.get('FETCH_CACHE_DIR', os.path.join('cache', 'fetch'))
+CACHE_MAX_AGE = 30 * 24 * 3600
+CACHE_MAX_BYTES = 20 * 1024 ** 3
+CHUNK_BYTES = 1024 * 1024
+# ranged downloads: size of each range, parallel connections and attempts
+PART_BYTES = 16 * 1024 * 1024
+WORKERS = 8
+RETRIES = 5
+BACKOFF = 2.0
+
+
+class FetchResult(object):
+    '''
+    Outcome of FetchCache.fetch
+    `path` local file with the content
+    `sha256` hex digest of the content
+    `changed` False if the content is the same as the last fetch of the URL
+    `cached` True if no body was downloaded (the server answered 304)
+    '''
+    def __init__(self, path, sha256, changed, cached):
+        self.path = path
+        self.sha256 = sha256
+        self.changed = changed
+        self.cached = cached
+
+    def __repr__(self):
+        return 'FetchResult({!r}, changed={}, cached={})'.format(
+            self.path, self.changed, self.cached)
+
+
+def _place(src, dest):
+    '''Atomically put a copy (a hard link where possible) of src at dest'''
+    directory = os.path.dirname(os.path.abspath(dest))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.fetch-')
+    os.close(fd)
+    os.remove(tmp)
+    try:
+        os.link(src, tmp)
+    except (OSError, AttributeError):
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dest)
+
+
+class FetchCache(object):
+    '''
+    Content-addressed download cache
+    `root` cache directory; blobs live in root/objects by sha256 and the
+        per-URL validators in root/index.json
+    `session` requests session to reuse for http(s) downloads
+    `stats` hits (304s), misses (bodies downloaded), unchanged (downloaded
+        bodies already in the cache), bytes_downloaded and bytes_saved
+    '''
+    def __init__(self, root=CACHE_DIR, session=None):
+        self.root = root
+        self.session = session or requests.Session()
+        self.stats = dict.fromkeys(('hits', 'misses', 'unchanged',
+                                    'bytes_downloaded', 'bytes_saved'), 0)
+        self._lock = threading.Lock()
+        self._objects = os.path.join(root, 'objects')
+        if not os.path.isdir(self._objects):
+            os.makedirs(self._objects)
+        self._indexPath = os.path.join(root, 'index.json')
+        try:
+            with io.open(self._indexPath, encoding='utf-8') as f:
+                self.index = json.load(f)
+        except (IOError, OSError, ValueError):
+            self.index = {}
+
+    def objectPath(self, sha256):
+        '''Path of the cached blob with this digest'''
+        return os.path.join(self._objects, sha256[:2], sha256)
+
+    def _saveIndex(self):
+        fd, tmp = tempfile.mkstemp(dir=self.root, prefix='.index-')
+        with io.open(fd, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(self.index, sort_keys=True))
+        os.replace(tmp, self._indexPath)
+
+    def prune(self, max_age=CACHE_MAX_AGE, max_bytes=CACHE_MAX_BYTES):
+        '''
+        Drop URLs not fetched in `max_age` seconds, then the least recently
+        fetched until their blobs fit in `max_bytes`, and delete the blobs
+        no URL refers to; returns the bytes freed
+        '''
+        now = time.time()
+        with self._lock:
+            entries = sorted(self.index.items(),
+                             key=lambda item: -item[1].get('used', 0))
+            keep = {}
+            total = 0
+            for url, entry in entries:
+                if now - entry.get('used', 0) > max_age:
+                    continue
+                if entry['sha256'] not in keep.values():
+                    if total + entry['size'] > max_bytes:
+                        continue
+                    total += entry['size']
+                keep[url] = entry['sha256']
+            if len(keep) < len(self.index):
+                self.index = {url: self.index[url] for url in keep}
+                self._saveIndex()
+            referenced = set(keep.values())
+        freed = 0
+        for folder, _, names in os.walk(self._objects):
+            for name in names:
+                path = os.path.join(folder, name)
+                # a blob just stored by another process may not be indexed
+                # yet, so only old ones are removed
+                if name not in referenced and \
+                        now - os.path.getmtime(path) > 3600:
+                    freed += os.path.getsize(path)
+                    os.remove(path)
+        if freed:
+            logging.info('Pruned {} MB from the fetch cache'.format(
+                freed // 2 ** 20))
+        return freed
+
+    def _count(self, **counts):
+        with self._lock:
+            for k, v in counts.items():
+                self.stats[k] += v
+
+    def _open(self, url, entry):
+        '''Open url, conditionally if validators are known; None on 304'''
+        if urlparse(url).scheme not in ('http', 'https'):
+            # e.g. ftp, as urlretrieve supported; no validators there
+            return urlopen(url), {}
+        headers = {}
+        if entry and os.path.exists(self.objectPath(entry['sha256'])):
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        r = self.session.get(url, headers=headers, stream=True)
+        if r.status_code == 304:
+            r.close()
+            return None, {}
+        r.raise_for_status()
+        r.raw.decode_content = True
+        return r.raw, r.headers
+
+    def _store(self, body):
+        '''
+        Stream a response body into the cache
+        Returns (sha256, size, whether the blob was already cached)
+        '''
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp = tempfile.mkstemp(dir=self.root, prefix='.download-')
+        try:
+            with io.open(fd, 'wb') as f:
+                while True:
+                    chunk = body.read(CHUNK_BYTES)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+        except Exception:
+            os.remove(tmp)
+            raise
+        finally:
+            body.close()
+        _traceCount(bytes_downloaded=size)
+        sha256 = digest.hexdigest()
+        path = self.objectPath(sha256)
+        if os.path.exists(path):
+            os.remove(tmp)
+            return sha256, size, True
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        os.replace(tmp, path)
+        return sha256, size, False
+
+    @_traced('fetch')
+    def fetch(self, url, dest=None):
+        '''
+        Download url through the cache and return a FetchResult
+        `dest` file to place the content at (hard-linked to the cache, so
+            replace rather than edit it in place); by default the cached blob's
+            path is returned, which must not be modified
+        '''
+        with self._lock:
+            entry = self.index.get(url)
+        body, headers = self._open(url, entry)
+        if body is None:
+            sha256, changed, cached = entry['sha256'], False, True
+            self._count(hits=1, bytes_saved=entry['size'])
+            logging.info('Not modified, using cached {}'.format(url))
+            with self._lock:
+                self.index[url]['used'] = time.time()
+                self._saveIndex()
+        else:
+            sha256, size, known = self._store(body)
+            changed = not entry or entry['sha256'] != sha256
+            cached = False
+            self._count(misses=1, bytes_downloaded=size,
+                        unchanged=0 if changed else 1)
+            with self._lock:
+                self.index[url] = {
+                    'sha256': sha256,
+                    'size': size,
+                    'etag': headers.get('ETag'),
+                    'last_modified': headers.get('Last-Modified'),
+                    'used': time.time(),
+                }
+                self._saveIndex()
+            if known and changed:
+                logging.info('Downloaded {}, content already cached'.format(
+                    url))
+        path = self.objectPath(sha256)
+        if dest:
+            _place(path, dest)
+            path = dest
+        return FetchResult(path, sha256, changed, cached)
+
+
+def _probe(session, url):
+    '''(size, validator) if the server serves byte ranges of url, else None'''
+    r = session.get(url, headers={'Range': 'bytes=0-0',
+                                  'Accept-Encoding': 'identity'}, stream=True)
+    r.close()
+    content_range = r.headers.get('Content-Range', '')
+    if r.status_code != 206 or '/' not in content_range:
+        return None
+    size = content_range.rsplit('/', 1)[1]
+    if not size.isdigit():
+        return None
+    # If-Range only accepts a strong ETag or a date
+    etag = r.headers.get('ETag')
+    if etag and etag.startswith('W/'):
+        etag = None
+    return int(size), etag or r.headers.get('Last-Modified')
+
+
+class _Changed(Exception):
+    '''The remote file changed during a ranged download'''
+
+
+def _retry(fn, what, retries):
+    '''Call fn, retrying failed attempts with exponential backoff'''
+    for attempt in range(retries):
+        try:
+            return fn()
+        except (requests.RequestException, IOError) as e:
+            if attempt == retries - 1:
+                raise
+            wait = BACKOFF * 2 ** attempt
+            logging.warning('{} failed ({}), retrying in {}s'.format(
+                what, e, wait))
+            time.sleep(wait)
+
+
+class _Ranges(object):
+    '''
+    Completed ranges of a partial download, persisted next to it so an
+    interrupted download resumes where it stopped
+    '''
+    def __init__(self, path, size, validator, part_bytes):
+        self.path = path
+        self.key = [size, validator, part_bytes]
+        self.done = set()
+        self._lock = threading.Lock()
+        try:
+            with io.open(path, encoding='utf-8') as f:
+                state = json.load(f)
+            if state['key'] == self.key:
+                self.done = set(state['done'])
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
+    def add(self, i):
+        with self._lock:
+            self.done.add(i)
+            with io.open(self.path, 'w', encoding='utf-8') as f:
+                f.write(json.dumps({'key': self.key,
+                                    'done': sorted(self.done)}))
+
+
+def _fetchRange(session, url, path, start, end, validator=None):
+    '''
+    Write bytes start..end (inclusive) of url at the same offsets of path
+    `validator` ETag or Last-Modified of the file the other ranges came
+        from; raises _Changed if the remote file no longer matches it
+    '''
+    headers = {'Range': 'bytes={}-{}'.format(start, end),
+               'Accept-Encoding': 'identity'}
+    if validator:
+        headers['If-Range'] = validator
+    r = session.get(url, headers=headers, stream=True)
+    try:
+        if r.status_code == 200 and validator:
+            # the whole, different, file instead of the range
+            raise _Changed(url)
+        if r.status_code != 206:
+            raise IOError('Range not served: HTTP {}'.format(r.status_code))
+        with io.open(path, 'r+b') as f:
+            f.seek(start)
+            for chunk in r.iter_content(CHUNK_BYTES):
+                f.write(chunk)
+                start += len(chunk)
+                _traceCount(bytes_downloaded=len(chunk))
+    finally:
+        r.close()
+    if start != end + 1:
+        raise IOError('Range ended at {} instead of {}'.format(start, end + 1))
+
+
+def _fetchStream(session, url, path):
+    '''Download url to path in a single stream'''
+    r = session.get(url, stream=True)
+    try:
+        r.raise_for_status()
+        with io.open(path, 'wb') as f:
+            for chunk in r.iter_content(CHUNK_BYTES):
+                f.write(chunk)
+                _traceCount(bytes_downloaded=len(chunk))
+    finally:
+        r.close()
+
+
+@_traced('fetch')
+def download(url, dest, workers=WORKERS, part_bytes=PART_BYTES,
+             retries=RETRIES, session=None):
+    '''
+    Download a large file with concurrent ranged requests
+    Ranges are written into a preallocated dest.part; after a failure,
+    calling again resumes from the ranges already completed, as long as
+    the remote file is unchanged (ranges are requested with If-Range, and
+    a download whose file changed midway starts over). Servers without
+    range support get a single stream, and files without an ETag or
+    Last-Modified are never resumed.
+    `workers` parallel connections
+    `part_bytes` size of each range
+    `retries` attempts per range (or for the whole stream)
+    Returns dest
+    '''
+    if session is None:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=workers)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+    for attempt in range(retries):
+        try:
+            return _download(url, dest, workers, part_bytes, retries,
+                             session)
+        except _Changed:
+            logging.warning('{} changed while downloading, starting '
+                            'over'.format(url))
+            for path in (dest + '.part', dest + '.part.json'):
+                if os.path.exists(path):
+                    os.remove(path)
+    raise IOError('{} kept changing while downloading'.format(url))
+
+
+def _download(url, dest, workers, part_bytes, retries, session):
+    partial = dest + '.part'
+    probe = _retry(lambda: _probe(session, url), url, retries)
+    if not probe or probe[0] <= part_bytes:
+        logging.info('Downloading {}'.format(url))
+        _retry(lambda: _fetchStream(session, url, partial), url, retries)
+        os.replace(partial, dest)
+        return dest
+    size, validator = probe
+    ranges = _Ranges(partial + '.json', size, validator, part_bytes)
+    if not validator or not ranges.done or not os.path.exists(partial):
+        # without a validator, ranges left by an earlier run may be of
+        # another version of the file
+        ranges.done = set()
+        with io.open(partial, 'wb') as f:
+            f.truncate(size)
+    starts = range(0, size, part_bytes)
+    todo = [i for i in range(len(starts)) if i not in ranges.done]
+    logging.info('Downloading {} ({} MB) in {} of {} ranges'.format(
+        url, size // 2 ** 20, len(todo), len(starts)))
+
+    def part(i):
+        start = starts[i]
+        end = min(start + part_bytes, size) - 1
+        _retry(lambda: _fetchRange(session, url, partial, start, end,
+                                   validator),
+               '{} bytes {}-{}'.format(url, start, end), retries)
+        ranges.add(i)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # list() so the first failed range raises here
+        list(pool.map(part, todo))
+    os.replace(partial, dest)
+    os.remove(ranges.path)
+    return dest
+
+
+_cache = None
+
+
+def getCache():
+    '''Return the shared FetchCache under CACHE_DIR, pruned once per process'''
+    global _cache
+    if _cache is None:
+        _cache = FetchCache()
+        _cache.prune()
+    return _cache
+
+
+def fetch(url, dest=None):
+    '''Download url through the shared cache, see FetchCache.fetch'''
+    return getCache().fetch(url, dest)
+
+
+def stats():
+    '''Counters of the shared cache'''
+    return dict(getCache().stats)
@@ -1,14 +1,86 @@
 import ee
+import hashlib
+import itertools
+import json
+import math
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from google.cloud import storage 
 import os
 import rasterio
 
+try:
+    import traceUtils
+except ImportError:
+    # staging and ingestion are only traced when traceUtils is around
+    traceUtils = None
 
+
+def _traced(name):
+    '''traceUtils.traced, or the function untouched without traceUtils'''
+    if traceUtils is None:
+        return lambda fn: fn
+    return traceUtils.traced(name)
+
+
+def _traceCount(**counts):
+    '''traceUtils.count, if traceUtils is available'''
+    if traceUtils is not None:
+        traceUtils.count(**counts)
+
+
+# the state reported for ids Earth Engine doesn't know, which will never change
+TASK_UNKNOWN = 'UNKNOWN'
 TASK_FINISHED_STATES = (ee.batch.Task.State.COMPLETED,
                         ee.batch.Task.State.FAILED,
-                        ee.batch.Task.State.CANCELLED)
+                        ee.batch.Task.State.CANCELLED,
+                        TASK_UNKNOWN)
+
+# GCS staging: files uploaded at once, and files from this size up are sent
+# as parts in parallel and composed into one object (at most 32 parts)
+STAGING_WORKERS = 8
+COMPOSITE_THRESHOLD = 150 * 1024 * 1024
+COMPOSITE_PART_SIZE = 64 * 1024 * 1024
+MAX_COMPOSITE_PARTS = 32
+
+# content hashes: read size, and the asset property / GCS metadata key
+# holding them, so unchanged files are neither restaged nor reingested
+HASH_CHUNK = 8 * 1024 * 1024
+HASH_PROPERTY = 'source_sha256'
+
+# image validation: headers read at once, and the cache of headers and
+# content hashes by path, size and mtime kept across runs (out of data/,
+# which the jobs empty on every run)
+VALIDATION_WORKERS = 8
+VALIDATION_CACHE = os.environ.get('GEE_VALIDATION_CACHE', os.path.join('cache', 'gee_validation.json'))
+
+# task manager: tasks running at once, the range of the adaptive delay
+# between status polls and how long to wait for all tasks (seconds)
+MAX_IN_FLIGHT = 10
+POLL_MIN = 5
+POLL_MAX = 60
+TASK_TIMEOUT = 6 * 3600
+TASK_TIMED_OUT = 'TIMED_OUT'
+
+
+def fileHash(path):
+    """sha256 hex digest of a file, read in chunks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def readHeader(path):
+    """Reads the metadata checksImages needs from the header of an image, without scanning its folder or reading pixels"""
+    with rasterio.Env(GDAL_DISABLE_READDIR_ON_OPEN='EMPTY_DIR'):
+        with rasterio.open(path) as src:
+            transform = src.transform
+            return {'dtype': src.dtypes[0], 'driver': src.driver, 'nodata': src.nodata, 'nBands': src.count,
+                    'crs': src.crs.to_string() if src.crs else None,
+                    'pixel': [transform.a, transform.b, transform.d, transform.e]}
 
 
 class getJsonEnv():
@@ -48,6 +120,9 @@ class assetManagement(object):
         getJsonEnv()
         self.meta=imageObject
         self.imageNames=self.getImageName()
+        self.sourcePaths=dict(zip(self.imageNames, self.meta['sources']))
+        self.hashes = {}
+        self.cache = None
         self.gcsBucket=self.setUpCredentials()
         self.sources = []
         
@@ -55,24 +130,70 @@ class assetManagement(object):
         """gets the listof names from sources"""
         return [os.path.basename(name) for name in self.meta['sources']]
     
+    def statKey(self, imageName):
+        """Cache key of a source: its path, size and mtime, so a file is read or hashed again only once it changes"""
+        path = self.sourcePaths[imageName]
+        stat = os.stat(path)
+        return '{0}|{1}|{2}'.format(os.path.abspath(path), stat.st_size, stat.st_mtime)
+
+    def loadCache(self):
+        """Headers and hashes of the sources seen in earlier runs, by statKey"""
+        if self.cache is None:
+            try:
+                with open(VALIDATION_CACHE) as f:
+                    self.cache = json.load(f)['files']
+            except (IOError, ValueError, KeyError):
+                self.cache = {}
+        return self.cache
+
+    def saveCache(self):
+        """Writes the cache back, without the entries of files that changed or are gone"""
+        def current(key):
+            path, size, mtime = key.rsplit('|', 2)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return False
+            return [str(stat.st_size), str(stat.st_mtime)] == [size, mtime]
+
+        files = {key: entry for key, entry in self.loadCache().items() if current(key)}
+        if os.path.dirname(VALIDATION_CACHE) and not os.path.isdir(os.path.dirname(VALIDATION_CACHE)):
+            os.makedirs(os.path.dirname(VALIDATION_CACHE))
+        with open(VALIDATION_CACHE + '.tmp', 'w') as f:
+            json.dump({'files': files}, f)
+        os.replace(VALIDATION_CACHE + '.tmp', VALIDATION_CACHE)
+
+    def readHeaders(self, workers=VALIDATION_WORKERS):
+        """Reads the headers of all the sources concurrently, reusing those cached for unchanged files"""
+        cache = self.loadCache()
+
+        def header(imageName):
+            entry = cache.setdefault(self.statKey(imageName), {})
+            if 'header' not in entry:
+                entry['header'] = readHeader(self.sourcePaths[imageName])
+            return entry['header']
+
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(self.imageNames)))) as pool:
+            result = list(pool.map(header, self.imageNames))
+        self.saveCache()
+        return result
+
     def checksImages(self):
         """Checks the images that we will compose have the same n bands as they are going to become one image and part of the image collection"""
-        metadata=[]
-        for image in self.meta['sources']:
-            with rasterio.open(image) as src:
-                metaData=src.meta
-                
-                assert metaData['driver'] == 'GTiff', "Driver is not supported: {0}".format(metaData['driver'])
-                assert metaData['count'] == len(self.meta['bandNames']), "Nbands incorrect, expected: {0}, {1} provided".format(metaData['count'],len(self.meta['bandNames']))
-                
-                metadata.append({'dtype': metaData['dtype'], 'driver': metaData['driver'], 'nodata': metaData['nodata'], 'nBands': metaData['count'],'crs': src.crs.to_string()})
-        
-        assert len(set([item['dtype'] for item in metadata])) == 1, "Images list dtypes aren't compatibles. Expected: 1, {1} provided".format(metaData['count'],len(set([item['dtype'] for item in metadata])))
-        assert len(set([item['driver'] for item in metadata])) == 1, "Images list drivers aren't compatibles. Expected: 1, 1 provided".format(metaData['count'],len(set([item['driver'] for item in metadata])))
-        assert len(set([item['nodata'] for item in metadata])) == 1, "Images list nodata values aren't compatibles. Expected: 1, {1} provided".format(metaData['count'],len(set([item['nodata'] for item in metadata])))
-        assert len(set([item['nBands'] for item in metadata])) == 1, "Images list nBands number aren't compatibles. Expected: 1, {1} provided".format(metaData['count'],len(set([item['nBands'] for item in metadata])))
-        assert len(set([item['crs'] for item in metadata])) == 1, "Images list crs aren't compatibles. Expected: 1, {1} provided".format(metaData['count'],len(set([item['crs'] for item in metadata])))       
-        return metadata[0]
+        metadata = self.readHeaders()
+        problems = []
+        for imageName, meta in zip(self.imageNames, metadata):
+            if meta['driver'] != 'GTiff':
+                problems.append("{0}: driver is not supported: {1}".format(imageName, meta['driver']))
+            if meta['nBands'] != len(self.meta['bandNames']):
+                problems.append("{0}: Nbands incorrect, expected: {1}, {2} provided".format(imageName, len(self.meta['bandNames']), meta['nBands']))
+        for key, label in (('dtype', 'dtypes'), ('nodata', 'nodata values'), ('nBands', 'nBands number'), ('crs', 'crs'), ('pixel', 'pixel sizes')):
+            values = [repr(meta[key]) for meta in metadata]
+            if len(set(values)) > 1:
+                problems.append("Images list {0} aren't compatibles: {1}".format(label, ', '.join(
+                    '{0}={1}'.format(imageName, value) for imageName, value in zip(self.imageNames, values))))
+        assert not problems, 'Images failed validation:\n' + '\n'.join(problems)
+        return {key: metadata[0][key] for key in ('dtype', 'driver', 'nodata', 'nBands', 'crs')}
                     
     
     def setUpCredentials(self):
@@ -93,15 +214,104 @@ class assetManagement(object):
             ee.data.setAssetAcl(self.meta['collectionAsset'],aclSet)
        
     
+    def sourceHash(self, imageName):
+        """Content hash of a source, computed once per version of the file"""
+        if imageName not in self.hashes:
+            entry = self.loadCache().setdefault(self.statKey(imageName), {})
+            if 'sha256' not in entry:
+                entry['sha256'] = fileHash(self.sourcePaths[imageName])
+            self.hashes[imageName] = entry['sha256']
+        return self.hashes[imageName]
+
+    def contentHash(self):
+        """Hash of all the sources of the image, stored on the asset"""
+        digest = hashlib.sha256()
+        for imageName in self.imageNames:
+            digest.update('{0}:{1}\n'.format(imageName, self.sourceHash(imageName)).encode('utf-8'))
+        return digest.hexdigest()
+
+    def assetId(self):
+        return '{collectionAsset}/{assetName}'.format(collectionAsset= self.meta['collectionAsset'],assetName =self.meta['assetName'])
+
+    def isIngested(self):
+        """Checks if the asset exists and was ingested from these exact sources"""
+        info = ee.data.getInfo(self.assetId())
+        return bool(info) and info.get('properties', {}).get(HASH_PROPERTY) == self.contentHash()
+
+    def gcsPath(self, imageName):
+        """Source entry for the ingestion request of a staged image"""
+        return {'primaryPath': 'gs://{gcsBucket}/{collectionName}/{imageNa}'.format(gcsBucket=self.meta['gcsBucket'],collectionName=self.meta['collectionAsset'],imageNa=imageName)}
+
+    def uploadComposite(self, blob, path, size):
+        """Uploads a large file as parts in parallel and composes them into blob"""
+        nParts = min(MAX_COMPOSITE_PARTS, int(math.ceil(size / float(COMPOSITE_PART_SIZE))))
+        partSize = int(math.ceil(size / float(nParts)))
+        parts = [self.gcsBucket.blob('{0}.part{1}'.format(blob.name, i)) for i in range(nParts)]
+
+        def uploadPart(i):
+            with open(path, 'rb') as f:
+                f.seek(i * partSize)
+                parts[i].upload_from_file(f, size=min(partSize, size - i * partSize))
+
+        with ThreadPoolExecutor(max_workers=min(STAGING_WORKERS, nParts)) as pool:
+            list(pool.map(uploadPart, range(nParts)))
+        blob.compose(parts)
+        # compose takes no predefined ACL; make_public reads the ACL first, so it can't go in a batch
+        blob.make_public()
+        # one batched request to clean up the parts
+        with self.gcsBucket.client.batch():
+            for part in parts:
+                part.delete()
+
+    def uploadBlob(self, imageName):
+        """
+        Uploads one source to GCS, public, unless an object with the same content hash is already staged
+        Returns the blob and the bytes uploaded
+        """
+        path = self.sourcePaths[imageName]
+        size = os.path.getsize(path)
+        name = '{0}/{1}'.format(self.meta['collectionAsset'],imageName)
+        sha256 = self.sourceHash(imageName)
+        staged = self.gcsBucket.get_blob(name)
+        if staged is not None and (staged.metadata or {}).get(HASH_PROPERTY) == sha256:
+            print('Already staged {0}, skipping upload'.format(imageName))
+            # a previous run may have stopped before setting its ACL
+            if 'READER' not in staged.acl.all().get_roles():
+                staged.make_public()
+            return staged, 0
+        blob = self.gcsBucket.blob(name)
+        blob.metadata = {HASH_PROPERTY: sha256}
+        start = time.time()
+        if size >= COMPOSITE_THRESHOLD:
+            self.uploadComposite(blob, path, size)
+        else:
+            # public at upload time, instead of a make_public round trip
+            blob.upload_from_filename(path, predefined_acl='publicRead')
+        elapsed = time.time() - start
+        print('Staged {0}: {1:.1f} MB in {2:.1f}s ({3:.1f} MB/s)'.format(
+            imageName, size / 1e6, elapsed, size / 1e6 / max(elapsed, 1e-6)))
+        return blob, size
+
+    @_traced('gcs_staging')
     def uploadGCS(self, imageName):
         """Upload the image to google cloud storage"""
-        imageIndex = self.imageNames.index(imageName)
-        blob = self.gcsBucket.blob('{0}/{1}'.format(self.meta['collectionAsset'],imageName))
-        blob.upload_from_filename(self.meta['sources'][imageIndex])
-        blob.make_public()
-        
-        return {'primaryPath': 'gs://{gcsBucket}/{collectionName}/{imageNa}'.format(gcsBucket=self.meta['gcsBucket'],collectionName=self.meta['collectionAsset'],imageNa=imageName)}
+        self.uploadBlob(imageName)
+        return self.gcsPath(imageName)
+
+    @_traced('gcs_staging')
+    def stageSources(self, workers=STAGING_WORKERS):
+        """Uploads all the sources to google cloud storage concurrently and makes them public"""
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(self.imageNames)))) as pool:
+            results = list(pool.map(self.uploadBlob, self.imageNames))
+        elapsed = time.time() - start
+        total = sum(size for blob, size in results)
+        _traceCount(assets=len(results), bytes_uploaded=total)
+        print('Staged {0} files, {1:.1f} MB in {2:.1f}s ({3:.1f} MB/s)'.format(
+            len(results), total / 1e6, elapsed, total / 1e6 / max(elapsed, 1e-6)))
+        return [self.gcsPath(imageName) for imageName in self.imageNames]
         
+    @_traced('gee_ingestion')
     def transferGEE(self):
         """Transfers the images from google cloud storage to gee asset"""
         task_id = ee.data.newTaskId()[0]
@@ -109,8 +319,9 @@ class assetManagement(object):
         
         self.meta['properties']['system:time_start'] = ee.Date(time).getInfo()['value']
         
+        self.meta['properties'][HASH_PROPERTY] = self.contentHash()
         request = {
-            'id':'{collectionAsset}/{assetName}'.format(collectionAsset= self.meta['collectionAsset'],assetName =self.meta['assetName']),
+            'id':self.assetId(),
             'properties':self.meta['properties'],
             'tilesets': [{'sources': self.sources}],
             'pyramidingPolicy':self.meta['pyramidingPolicy'].upper(),
@@ -130,6 +341,8 @@ class assetManagement(object):
             state = status['state']
             if state in TASK_FINISHED_STATES:
               error_message = status.get('error_message', None)
+              if state == TASK_UNKNOWN:
+                error_message = 'Task %s is unknown to Earth Engine' % task_id
               print('Task %s ended at state: %s after %.2f seconds'
                     % (task_id, state, elapsed))
               if error_message:
@@ -146,21 +359,151 @@ class assetManagement(object):
               break
         print('Wait for task %s timed out after %.2f seconds' % (task_id, elapsed))
 
-    def execute(self):
+    def start(self):
+        """
+        Checks and stages the images and starts their ingestion, returns the task id without waiting
+        Returns None if the asset was already ingested from the same files
+        """
         #Checks if the images are correct
         self.checksImages()
+
+        #Skips images already ingested from identical files
+        ingested = self.isIngested()
+        self.saveCache()
+        if ingested:
+            print('{0} already ingested from these files, skipping'.format(self.assetId()))
+            return None
         
         #sets up credentials and assets
         
         self.setUpGeeAsset()
         
         #Uploads file/s to GCS
-        self.sources = list(map(self.uploadGCS, self.imageNames))
+        self.sources = self.stageSources()
         
         #Transfers it from GCS to GEE
-        task_id = self.transferGEE()
+        return self.transferGEE()
+
+    def execute(self):
+        task_id = self.start()
+        if task_id is None:
+            return
         
         print('TaskID: {0}'.format(task_id))
         print('Status: {0}'.format(ee.data.getTaskStatus(task_id)[0]))
         self.taskStatus(task_id)
-        
\ No newline at end of file
+
+
+class taskManager(object):
+    """
+    Runs many ingestion/export tasks at once and polls them all together
+    tasks = taskManager(maxInFlight=5)
+    for date in dates:
+        tasks.submit(ee.batch.Export.image.toAsset(...), key=date)
+    for date, status in tasks.results():
+        print(date, status['state'])
+    Submitted tasks are started as soon as fewer than maxInFlight are
+    running; the status of every running task is taken from one
+    ee.data.getTaskStatus call for all their ids per round, every POLL_MIN
+    seconds while tasks finish and backing off to POLL_MAX while none do.
+    Tasks that fail to start end as FAILED with the error as error_message,
+    without stopping the others. Tasks reported UNKNOWN end as failed;
+    tasks still running or queued timeout seconds
+    after results() started end in state TIMED_OUT (running ones are left
+    to finish on the server).
+    """
+    def __init__(self, maxInFlight=MAX_IN_FLIGHT, pollMin=POLL_MIN, pollMax=POLL_MAX, timeout=TASK_TIMEOUT):
+        self.maxInFlight = maxInFlight
+        self.pollMin = pollMin
+        self.pollMax = pollMax
+        self.timeout = timeout
+        self.queued = []
+        self.running = {}
+        self.skipped = []
+        self.keys = itertools.count()
+
+    def submit(self, task, key=None):
+        """
+        Queues a task: an ee.batch.Task (started by the manager), an assetManagement (its start() is called)
+        or a function that starts a task and returns its id, or None if there is nothing to run
+        key identifies the task in results(), by default 0, 1, 2... in order of submission
+        """
+        if key is None:
+            key = next(self.keys)
+        self.queued.append((key, task))
+        self.startQueued()
+        return key
+
+    def startQueued(self):
+        """Starts queued tasks while there is room"""
+        while self.queued and len(self.running) < self.maxInFlight:
+            key, task = self.queued.pop(0)
+            try:
+                if isinstance(task, ee.batch.Task):
+                    task.start()
+                    task_id = task.id
+                elif isinstance(task, assetManagement):
+                    task_id = task.start()
+                else:
+                    task_id = task()
+            except Exception as e:
+                print('Could not start task for {0}: {1}'.format(key, e))
+                self.skipped.append((key, {'id': None, 'state': ee.batch.Task.State.FAILED, 'error_message': str(e)}))
+                continue
+            if task_id is None:
+                # nothing to do, e.g. already ingested from the same files
+                self.skipped.append((key, {'id': None, 'state': ee.batch.Task.State.COMPLETED, 'skipped': True}))
+                continue
+            print('Started task {0} for {1}'.format(task_id, key))
+            self.running[task_id] = key
+
+    def poll(self):
+        """Fetches the status of all running tasks at once, returns [(key, status)] of those that ended"""
+        if not self.running:
+            return []
+        finished = []
+        for status in ee.data.getTaskStatus(list(self.running)):
+            task_id = status['id']
+            if task_id in self.running and status['state'] in TASK_FINISHED_STATES:
+                if status['state'] == TASK_UNKNOWN:
+                    status = dict(status, error_message='Task {0} is unknown to Earth Engine'.format(task_id))
+                finished.append((self.running.pop(task_id), status))
+        return finished
+
+    def expire(self):
+        """Gives up on all running and queued tasks, returns [(key, status)] for them"""
+        expired = [(key, {'id': task_id, 'state': TASK_TIMED_OUT})
+                   for task_id, key in self.running.items()]
+        expired += [(key, {'id': None, 'state': TASK_TIMED_OUT}) for key, task in self.queued]
+        self.running = {}
+        self.queued = []
+        return expired
+
+    def results(self):
+        """Yields (key, status) for every task as it ends, in order of completion"""
+        delay = self.pollMin / 1.5
+        deadline = time.time() + self.timeout
+        while self.running or self.queued or self.skipped:
+            self.startQueued()
+            finished, self.skipped = self.skipped + self.poll(), []
+            if time.time() >= deadline:
+                print('Tasks still running after {0:.0f}s, giving up on them'.format(self.timeout))
+                finished += self.expire()
+            for key, status in finished:
+                print('Task for {0} ended at state: {1}'.format(key, status['state']))
+                yield key, status
+            self.startQueued()
+            if self.running:
+                # poll often while tasks are finishing, less while none are
+                delay = self.pollMin if finished else min(self.pollMax, delay * 1.5)
+                time.sleep(max(0, min(delay, deadline - time.time())))
+
+    def wait(self):
+        """Waits for all tasks, returns {key: status}; raises if any task did not complete"""
+        statuses = dict(self.results())
+        failed = {key: status.get('error_message', status['state'])
+                  for key, status in statuses.items()
+                  if status['state'] != ee.batch.Task.State.COMPLETED}
+        if failed:
+            raise ValueError('Tasks failed: {0}'.format(failed))
+        return statuses
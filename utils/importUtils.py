@@ -0,0 +1,138 @@
+'''
+Start-up cost of the jobs: an import profiler and lazy-import helpers
+Profile a job's imports (from the repository root):
+```
+python utils/importUtils.py cit_002_gmao_air_quality dis_001_significant_earthquakes
+```
+Defer heavy imports and import-time work in a job module:
+```
+from importUtils import lazyImport, deferred
+gpd = lazyImport('geopandas')  # imported on first use of gpd.<anything>
+
+@deferred
+def country_table():
+    return pd.read_csv(COUNTRY_CSV_URL)  # fetched on the first call only
+```
+Jobs can't import utils/ yet (their containers only get contents/), so they
+write the same getter with @functools.lru_cache(maxsize=None), as
+upload_eia_data and upload_worldbank_data do.
+'''
+from __future__ import print_function, unicode_literals
+import argparse
+import functools
+import glob
+import importlib
+import importlib.util
+import os
+import subprocess
+import sys
+import threading
+import time
+
+
+def lazyImport(name):
+    '''
+    Module `name`, actually imported on its first attribute access
+    Already imported modules are returned as they are.
+    '''
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError('No module named {}'.format(name))
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+def deferred(fn):
+    '''
+    Decorator for zero-argument initializers (reference tables, clients,
+    credentials): run on the first call, then return the same value
+    '''
+    lock = threading.Lock()
+    result = []
+
+    @functools.wraps(fn)
+    def wrapper():
+        if not result:
+            with lock:
+                if not result:
+                    result.append(fn())
+        return result[0]
+    wrapper.reset = result.clear
+    return wrapper
+
+
+def profileImports(modules, cwd=None, python=sys.executable):
+    '''
+    Import `modules` in a fresh interpreter with -X importtime
+    `cwd` directory to import from, e.g. a job's contents/
+    Returns (seconds of the whole interpreter run, {top-level package:
+        seconds spent importing it})
+    '''
+    code = ';'.join('import {}'.format(m) for m in modules)
+    start = time.time()
+    proc = subprocess.run([python, '-X', 'importtime', '-c', code], cwd=cwd,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True)
+    elapsed = time.time() - start
+    packages = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        fields = line[len('import time:'):].split('|')
+        if not fields[0].strip().isdigit():
+            # the header line
+            continue
+        package = fields[2].strip().split('.')[0]
+        packages[package] = packages.get(package, 0) + int(fields[0]) / 1e6
+    if proc.returncode:
+        tail = proc.stderr.strip().splitlines()[-1:]
+        raise Exception('Importing {} failed: {}'.format(
+            ', '.join(modules), tail[0] if tail else proc.returncode))
+    return elapsed, packages
+
+
+def jobModules(job):
+    '''Modules imported by a job's main.py: src, or each src/*.py'''
+    src = os.path.join(job, 'contents', 'src')
+    if os.path.exists(os.path.join(src, '__init__.py')):
+        return ['src']
+    return ['src.' + os.path.splitext(os.path.basename(path))[0]
+            for path in sorted(glob.glob(os.path.join(src, '*.py')))]
+
+
+def profileJob(job, top=10):
+    '''Print the import cost of a job folder, heaviest packages first'''
+    try:
+        elapsed, packages = profileImports(
+            jobModules(job), cwd=os.path.join(job, 'contents'))
+    except Exception as e:
+        print('{}: {}'.format(os.path.basename(job), e))
+        return
+    print('{}: {:.2f}s to start, {:.2f}s in imports'.format(
+        os.path.basename(os.path.abspath(job)), elapsed,
+        sum(packages.values())))
+    for package, seconds in sorted(packages.items(),
+                                   key=lambda p: -p[1])[:top]:
+        print('  {:<24} {:>6.3f}s'.format(package, seconds))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import time per job')
+    parser.add_argument('jobs', nargs='*', help='job folders (default: all)')
+    parser.add_argument('--top', type=int, default=10,
+                        help='packages to list per job')
+    args = parser.parse_args()
+    jobs = args.jobs or sorted(os.path.dirname(p) for p in
+                               glob.glob(os.path.join('*', 'time.cron')))
+    for job in jobs:
+        profileJob(job, args.top)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+'''
+Local persistent record of what a job has already loaded into CARTO
+Example:
+```
+from ingestState import IngestState
+state = IngestState(CARTO_TABLE, id_field=UID_FIELD, time_field=TIME_FIELD)
+# pulls the UID column from CARTO only on a cold start or when the
+# periodic checksum no longer matches
+state.reconcile()
+new_rows = [row for row in rows if row[0] not in state]
+cartoUploads.insertRows(CARTO_TABLE, fields, dtypes, new_rows)
+state.add(row[0] for row in new_rows)
+state.advance(max(row[3] for row in new_rows))
+# rows deleted by retention are dropped from the state too
+cartoRetention.deleteExcessRows(CARTO_TABLE, MAX_ROWS, TIME_FIELD, state=state)
+```
+State lives in an SQLite file, one set of UIDs (as 64-bit hashes),
+high-water mark and source cursors per table. It is kept out of data/,
+which the jobs empty on every run; set INGEST_STATE_PATH to a file on a
+volume that outlives the container (start.sh runs jobs with --rm).
+'''
+from __future__ import unicode_literals
+import datetime
+import hashlib
+import logging
+import os
+import sqlite3
+import struct
+import time
+import cartoUploads
+from cartoUploads import CARTO_USER, CARTO_KEY
+
+STATE_PATH = os.environ.get('INGEST_STATE_PATH',
+                            os.path.join('state', 'ingest_state.db'))
+# seconds between checksum comparisons with the CARTO table
+RECONCILE_EVERY = 24 * 3600
+# UIDs written to SQLite per statement
+ADD_BATCH = 10000
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS uids (
+    tbl TEXT NOT NULL, h INTEGER NOT NULL, PRIMARY KEY (tbl, h)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS meta (
+    tbl TEXT NOT NULL, name TEXT NOT NULL, value TEXT,
+    PRIMARY KEY (tbl, name)
+);
+'''
+_INT64 = struct.Struct('>q')
+
+
+def uidHash(uid):
+    '''
+    Signed 64-bit hash of a UID: the first 8 bytes of its md5, which
+    CARTO computes as ('x' || substr(md5(uid), 1, 16))::bit(64)::bigint
+    '''
+    digest = hashlib.md5(str(uid).encode('utf-8')).digest()
+    return _INT64.unpack(digest[:8])[0]
+
+
+class IngestState(object):
+    '''
+    UIDs, latest timestamp and source cursors already ingested into a table
+    `table` CARTO table the state tracks
+    `path` SQLite file, shared by all tables of a job
+    `id_field` UID column in CARTO, used to reconcile
+    `time_field` datetime column in CARTO; seeds the high-water mark
+    '''
+    def __init__(self, table, path=STATE_PATH, id_field='uid',
+                 time_field='', user=CARTO_USER, key=CARTO_KEY):
+        self.table = table
+        self.id_field = id_field
+        self.time_field = time_field
+        self.user = user
+        self.key = key
+        if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.db = sqlite3.connect(path)
+        self.db.executescript(_SCHEMA)
+
+    def __contains__(self, uid):
+        return self.db.execute(
+            'SELECT 1 FROM uids WHERE tbl = ? AND h = ?',
+            (self.table, uidHash(uid))).fetchone() is not None
+
+    def __len__(self):
+        return self.db.execute('SELECT count(*) FROM uids WHERE tbl = ?',
+                               (self.table,)).fetchone()[0]
+
+    def filterNew(self, uids):
+        '''UIDs from `uids` not seen before, in order'''
+        return [uid for uid in uids if uid not in self]
+
+    def add(self, uids):
+        '''Record UIDs as ingested'''
+        batch = []
+        with self.db:
+            for uid in uids:
+                batch.append((self.table, uidHash(uid)))
+                if len(batch) >= ADD_BATCH:
+                    self.db.executemany(
+                        'INSERT OR IGNORE INTO uids VALUES (?, ?)', batch)
+                    batch = []
+            self.db.executemany('INSERT OR IGNORE INTO uids VALUES (?, ?)',
+                                batch)
+
+    def discard(self, uids):
+        '''Forget UIDs, e.g. of rows deleted from the CARTO table'''
+        batch = []
+        with self.db:
+            for uid in uids:
+                batch.append((self.table, uidHash(uid)))
+                if len(batch) >= ADD_BATCH:
+                    self.db.executemany(
+                        'DELETE FROM uids WHERE tbl = ? AND h = ?', batch)
+                    batch = []
+            self.db.executemany('DELETE FROM uids WHERE tbl = ? AND h = ?',
+                                batch)
+
+    def get(self, name, default=None):
+        '''Stored value of `name` (a source cursor, say), or `default`'''
+        row = self.db.execute('SELECT value FROM meta WHERE tbl = ? AND '
+                              'name = ?', (self.table, name)).fetchone()
+        return row[0] if row else default
+
+    def set(self, name, value):
+        '''Store a value, such as a source cursor, under `name`'''
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?, ?)',
+                            (self.table, name, value))
+
+    @property
+    def latest(self):
+        '''Latest ingested timestamp, as an ISO string, or None'''
+        return self.get('latest')
+
+    def advance(self, timestamp):
+        '''Move the high-water mark forward to `timestamp` if it is newer'''
+        if isinstance(timestamp, (datetime.datetime, datetime.date)):
+            timestamp = timestamp.isoformat()
+        if timestamp and (self.latest is None or timestamp > self.latest):
+            self.set('latest', timestamp)
+
+    def checksum(self):
+        '''(count, sum of UID hashes) of the local state'''
+        count = total = 0
+        for (h,) in self.db.execute('SELECT h FROM uids WHERE tbl = ?',
+                                    (self.table,)):
+            count += 1
+            total += h
+        return count, total
+
+    def remoteChecksum(self):
+        '''(count, sum of UID hashes) of the CARTO table'''
+        # the sum as text, since a JSON number loses precision past 2**53
+        sql = ("SELECT count({0}) AS n, sum(('x' || substr(md5({0}::text), "
+               "1, 16))::bit(64)::bigint)::text AS s FROM \"{1}\"").format(
+                   self.id_field, self.table)
+        row = cartoUploads.get(sql, self.user, self.key).json()['rows'][0]
+        return int(row['n']), int(row['s'] or 0)
+
+    def reconcile(self, force=False):
+        '''
+        Resync the local state with CARTO on a cold start, when `force`d, or
+        every RECONCILE_EVERY seconds if the checksums disagree
+        Returns True if the state was reloaded
+        '''
+        checked = float(self.get('checked_at', 0))
+        if not force and checked:
+            if time.time() - checked < RECONCILE_EVERY:
+                return False
+            if self.remoteChecksum() == self.checksum():
+                self.set('checked_at', time.time())
+                return False
+            logging.info('Ingest state of {} out of date'.format(self.table))
+        logging.info('Loading ingest state of {} from CARTO'.format(
+            self.table))
+        uids = cartoUploads.iterFields(self.id_field, self.table,
+                                       user=self.user, key=self.key)
+        with self.db:
+            self.db.execute('DELETE FROM uids WHERE tbl = ?', (self.table,))
+        self.add(uid for uid in uids if uid != '')
+        if self.time_field:
+            sql = 'SELECT max({}) AS latest FROM "{}"'.format(
+                self.time_field, self.table)
+            latest = cartoUploads.get(sql, self.user, self.key).json()
+            self.set('latest', latest['rows'][0]['latest'])
+        self.set('checked_at', time.time())
+        return True
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,336 @@
+'''
+Long-lived runner for the NRT jobs, instead of a docker build and a fresh
+interpreter on every cron tick
+Usage:
+```
+# from the repository root, in an environment with the jobs' requirements
+python utils/jobRunner.py --workers 4
+# run a single job once, now
+python utils/jobRunner.py --once dis_001_significant_earthquakes
+```
+Every folder with a time.cron and a contents/main.py is scheduled from its
+time.cron. Heavy libraries are imported once in the runner; each run is
+then forked off it, so the job starts warm but still gets its own process,
+working directory (contents/, so DATA_DIR is the job's own contents/data
+as in its container) and environment (from the job's .env). Import and
+main() times of every run are appended to runner_stats.jsonl; a run whose
+process dies, or that is still going after JOB_TIMEOUT, is recorded as
+failed.
+'''
+from __future__ import unicode_literals
+import argparse
+import datetime
+import glob
+import importlib
+import io
+import json
+import logging
+import multiprocessing
+import os
+import runpy
+import sys
+import time
+from collections import deque
+
+# imported before forking, so runs don't pay for them; missing ones skipped
+PRELOAD = ('numpy', 'pandas', 'requests', 'shapely.geometry', 'geopandas',
+           'fiona', 'rasterio', 'netCDF4', 'ee', 'boto3', 'cartoframes',
+           'LMIPy', 'cartosql', 'eeUtil')
+STATS_PATH = 'runner_stats.jsonl'
+# seconds a run may take before it is terminated
+JOB_TIMEOUT = float(os.environ.get('JOB_TIMEOUT', 6 * 3600))
+
+_DAYS = ['SUN', 'MON', 'TUE', 'WED', 'THU', 'FRI', 'SAT']
+_MONTHS = ['JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN', 'JUL', 'AUG', 'SEP',
+           'OCT', 'NOV', 'DEC']
+
+
+def _cronField(field, low, high, names=()):
+    '''Set of values matched by one crontab field'''
+    values = set()
+    for part in field.upper().split(','):
+        part, _, step = part.partition('/')
+        if part == '*':
+            start, end = low, high
+        else:
+            bounds = [names.index(b) + low if b in names else int(b)
+                      for b in part.split('-')]
+            start, end = bounds[0], bounds[-1]
+            if step and len(bounds) == 1:
+                end = high
+        values.update(range(start, end + 1, int(step or 1)))
+    if names is _DAYS and 7 in values:
+        # 7 is also Sunday
+        values.add(0)
+    return values
+
+
+class Cron(object):
+    '''
+    A five-field crontab schedule
+    `spec` e.g. '50 23 1-9 * *' or '30 23 * * WED'
+    '''
+    def __init__(self, spec):
+        fields = spec.split()
+        if len(fields) != 5:
+            raise Exception('Not a five-field crontab line: {}'.format(spec))
+        self.spec = spec
+        self.minutes = _cronField(fields[0], 0, 59)
+        self.hours = _cronField(fields[1], 0, 23)
+        self.days = _cronField(fields[2], 1, 31)
+        self.months = _cronField(fields[3], 1, 12, _MONTHS)
+        self.weekdays = _cronField(fields[4], 0, 7, _DAYS)
+        self._anyDay = fields[2] == '*'
+        self._anyWeekday = fields[4] == '*'
+
+    def matches(self, t):
+        '''True if the schedule fires at datetime t (to the minute)'''
+        if (t.minute not in self.minutes or t.hour not in self.hours
+                or t.month not in self.months):
+            return False
+        day = t.day in self.days
+        weekday = (t.weekday() + 1) % 7 in self.weekdays
+        # as in cron, a restricted day of month and day of week are OR'ed
+        if self._anyDay or self._anyWeekday:
+            return day and weekday
+        return day or weekday
+
+
+class Job(object):
+    '''A job folder: `name`, `path` and `cron` schedule'''
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.name = os.path.basename(self.path)
+        with io.open(os.path.join(self.path, 'time.cron')) as f:
+            self.cron = Cron(f.read().strip())
+
+    def env(self):
+        '''Variables from the job's .env file, as docker --env-file reads it'''
+        env = {}
+        path = os.path.join(self.path, '.env')
+        if os.path.exists(path):
+            with io.open(path, encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if line and not line.startswith('#') and '=' in line:
+                        name, value = line.split('=', 1)
+                        env[name.strip()] = value
+        return env
+
+
+def findJobs(root='.'):
+    '''Jobs in the top-level folders of root'''
+    jobs = []
+    for cron in sorted(glob.glob(os.path.join(root, '*', 'time.cron'))):
+        path = os.path.dirname(cron)
+        if not os.path.exists(os.path.join(path, 'contents', 'main.py')):
+            logging.warning('Skipping {}: no contents/main.py'.format(path))
+            continue
+        try:
+            jobs.append(Job(path))
+        except Exception as e:
+            logging.error('Skipping {}: {}'.format(path, e))
+    return jobs
+
+
+def preload(modules=PRELOAD):
+    '''Import heavy libraries into the runner; returns seconds spent'''
+    start = time.time()
+    for name in modules:
+        try:
+            importlib.import_module(name)
+        except Exception as e:
+            logging.debug('Not preloading {}: {}'.format(name, e))
+    return time.time() - start
+
+
+def runJob(path):
+    '''
+    Import and run a job's src.main() in this (forked) process, or its
+    main.py as a script if src is not a package with a main()
+    Returns a dict of the job's import and run times
+    '''
+    job = Job(path)
+    contents = os.path.join(job.path, 'contents')
+    os.environ.update(job.env())
+    os.environ['NAME'] = job.name
+    os.chdir(contents)
+    if not os.path.isdir('data'):
+        os.makedirs('data')
+    sys.path.insert(0, contents)
+    stats = {'job': job.name, 'started': datetime.datetime.utcnow().isoformat(),
+             'ok': False}
+    start = time.time()
+    try:
+        if os.path.exists(os.path.join('src', '__init__.py')):
+            src = importlib.import_module('src')
+            stats['import_seconds'] = round(time.time() - start, 3)
+            start = time.time()
+        if hasattr(sys.modules.get('src'), 'main'):
+            sys.modules['src'].main()
+        else:
+            # e.g. a main.py running several src modules in turn
+            runpy.run_path('main.py', run_name='__main__')
+        stats['ok'] = True
+    except BaseException as e:
+        logging.exception('{} failed'.format(job.name))
+        stats['error'] = repr(e)
+    stats['run_seconds'] = round(time.time() - start, 3)
+    return stats
+
+
+def _record(stats, path=STATS_PATH):
+    logging.info('{job}: import {import_seconds}s, run {run_seconds}s, '
+                 'ok={ok}'.format(**dict({'import_seconds': None}, **stats)))
+    with io.open(path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(stats) + '\n')
+
+
+def _run(path, conn):
+    '''
+    Body of a forked run: send runJob's stats back to the runner. The fork
+    exits without running atexit hooks, so a trace report is written here
+    '''
+    trace = sys.modules.get('traceUtils')
+    if trace is not None:
+        # forget what the runner itself traced before forking
+        trace.reset()
+    try:
+        conn.send(runJob(path))
+    finally:
+        conn.close()
+        trace = sys.modules.get('traceUtils')
+        if trace is not None and trace.enabled():
+            trace.report()
+
+
+class Runner(object):
+    '''
+    Schedules jobs from their time.cron, each run in a fresh fork of the
+    warm runner, so module state of one job never leaks into the next
+    `jobs` list of Job
+    `workers` runs allowed at the same time; runs due while all are busy
+        wait for a free one
+    `timeout` seconds before a run is terminated and recorded as failed
+    '''
+    def __init__(self, jobs, workers=4, stats_path=STATS_PATH,
+                 timeout=JOB_TIMEOUT):
+        self.jobs = jobs
+        self.workers = workers
+        self.timeout = timeout
+        self.stats_path = os.path.abspath(stats_path)
+        self.ctx = multiprocessing.get_context('fork')
+        # job name: (process, connection its stats arrive on, start time)
+        self.running = {}
+        self.waiting = deque()
+
+    def submit(self, job):
+        '''Start a run of job unless its previous run is still going'''
+        self.reap()
+        if job.name in self.running or \
+                any(j.name == job.name for j in self.waiting):
+            logging.warning('{} still running, skipping'.format(job.name))
+            return
+        if len(self.running) >= self.workers:
+            logging.info('Queueing {}'.format(job.name))
+            self.waiting.append(job)
+            return
+        self._start(job)
+
+    def _start(self, job):
+        logging.info('Starting {}'.format(job.name))
+        receive, send = self.ctx.Pipe(duplex=False)
+        process = self.ctx.Process(target=_run, args=(job.path, send),
+                                   name=job.name)
+        process.start()
+        send.close()
+        self.running[job.name] = (process, receive, time.time())
+
+    def reap(self):
+        '''
+        Record finished runs, including those whose process died (e.g. a
+        segfault) or was terminated for overrunning the timeout, and start
+        waiting runs in their place
+        '''
+        for name, (process, conn, started) in list(self.running.items()):
+            stats = None
+            error = 'worker exited with code {}'
+            if conn.poll():
+                try:
+                    stats = conn.recv()
+                except EOFError:
+                    # exited without sending its stats
+                    pass
+            elif process.is_alive():
+                if time.time() - started < self.timeout:
+                    continue
+                logging.error('{} still running after {:.0f}s, '
+                              'terminating'.format(name, self.timeout))
+                process.terminate()
+                error = 'timed out, terminated with code {}'
+            process.join()
+            conn.close()
+            del self.running[name]
+            if stats is None:
+                stats = {'job': name, 'ok': False,
+                         'run_seconds': round(time.time() - started, 3),
+                         'error': error.format(process.exitcode)}
+            _record(stats, self.stats_path)
+        while self.waiting and len(self.running) < self.workers:
+            self._start(self.waiting.popleft())
+
+    def tick(self, now):
+        for job in self.jobs:
+            if job.cron.matches(now):
+                self.submit(job)
+        self.reap()
+
+    def serve(self):
+        '''Run jobs on schedule until interrupted'''
+        logging.info('Scheduling {} jobs'.format(len(self.jobs)))
+        try:
+            while True:
+                now = datetime.datetime.now().replace(second=0, microsecond=0)
+                self.tick(now)
+                nxt = now + datetime.timedelta(minutes=1)
+                # reap finished runs while waiting for the next minute
+                while datetime.datetime.now() < nxt:
+                    time.sleep(max(0, min(5, (nxt - datetime.datetime.now())
+                                          .total_seconds())))
+                    self.reap()
+        finally:
+            for process, conn, started in self.running.values():
+                process.terminate()
+
+    def close(self):
+        '''Wait for the runs in progress and those waiting'''
+        self.reap()
+        while self.running or self.waiting:
+            time.sleep(1)
+            self.reap()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--root', default='.', help='repository root')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--once', nargs='+', metavar='JOB',
+                        help='run these jobs now and exit')
+    parser.add_argument('--no-preload', action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+    jobs = findJobs(args.root)
+    if not args.no_preload:
+        logging.info('Preloaded libraries in {:.1f}s'.format(preload()))
+    if args.once:
+        jobs = [job for job in jobs if job.name in args.once]
+        runner = Runner(jobs, args.workers)
+        for job in jobs:
+            runner.submit(job)
+        runner.close()
+    else:
+        Runner(jobs, args.workers).serve()
+
+
+if __name__ == '__main__':
+    main()
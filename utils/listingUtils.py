@@ -0,0 +1,110 @@
+'''
+Directory listings of Apache/nginx autoindex pages, memoized for the run
+Example:
+```
+import listingUtils
+# replaces list_available_files(url, file_start=...)
+files = listingUtils.listFiles(url, prefix='GEOS-CF.v01.rpl.chm_tavg')
+# list the folders of the last 10 days at once before walking back
+listingUtils.prefetch([SOURCE_URL.format(date=d) for d in dates])
+```
+Pages are streamed through a stdlib HTMLParser that only looks at <a>
+tags, instead of building a BeautifulSoup tree of the whole page, and each
+URL is fetched at most once per process. A folder the server doesn't have
+(404) lists as empty; any other error is raised, and never memoized, so an
+outage is not mistaken for a folder without new files.
+'''
+from __future__ import unicode_literals
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from html.parser import HTMLParser
+import requests
+
+WORKERS = 8
+CHUNK_BYTES = 64 * 1024
+# statuses meaning there is no such folder (yet), listed as empty
+MISSING_STATUS = (404, 410)
+
+_listings = {}
+_lock = threading.Lock()
+_session = requests.Session()
+
+
+class _HrefParser(HTMLParser):
+    '''Collects the href of every <a> tag fed to it'''
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.hrefs = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            for name, value in attrs:
+                if name == 'href' and value:
+                    self.hrefs.append(value)
+
+
+def _fetchListing(url, verify=True):
+    '''
+    Links on the index page at url; [] if the server has no page there
+    Raises requests.RequestException on network and other HTTP errors
+    '''
+    parser = _HrefParser()
+    with _session.get(url, verify=verify, stream=True) as r:
+        if r.status_code in MISSING_STATUS:
+            logging.debug('No listing at {} ({})'.format(url, r.status_code))
+            return []
+        r.raise_for_status()
+        r.encoding = r.encoding or 'utf-8'
+        for chunk in r.iter_content(CHUNK_BYTES, decode_unicode=True):
+            parser.feed(chunk)
+    parser.close()
+    # skip autoindex column-sort links
+    return [href for href in parser.hrefs if not href.startswith('?')]
+
+
+def listing(url, verify=True):
+    '''
+    All links on the index page at url, fetched once per run
+    Raises requests.RequestException if the page could not be fetched
+    '''
+    with _lock:
+        if url in _listings:
+            return _listings[url]
+    # failures raise before anything is memoized, so a later call retries
+    hrefs = _fetchListing(url, verify)
+    with _lock:
+        return _listings.setdefault(url, hrefs)
+
+
+def listFiles(url, prefix='', suffix='', verify=True):
+    '''
+    Links on the index page at url that start with `prefix` and end with
+    `suffix`, in page order
+    `verify` check the server's TLS certificate
+    '''
+    return [href for href in listing(url, verify)
+            if href.startswith(prefix) and href.endswith(suffix)]
+
+
+def prefetch(urls, workers=WORKERS, verify=True):
+    '''
+    Fetch the listings of several folders concurrently; failed ones are
+    only logged here, and raise when listed
+    '''
+    def fetch(url):
+        try:
+            listing(url, verify)
+        except requests.RequestException as e:
+            logging.warning('Could not list {}: {}'.format(url, e))
+
+    urls = [url for url in urls if url not in _listings]
+    if urls:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(fetch, urls))
+
+
+def clear():
+    '''Forget memoized listings, e.g. between runs of a long-lived process'''
+    with _lock:
+        _listings.clear()
@@ -0,0 +1,193 @@
+'''
+Cloud-Optimized GeoTIFF writer for the raster convert steps
+Example:
+```
+import rasterUtils
+
+# netcdf subdataset to a tiled, compressed COG with overviews, in one pass
+result = rasterUtils.translate(SDS_NAME.format(fname=f), tif, codec='ZSTD',
+                               args=['-a_nodata', str(NODATA_VALUE),
+                                     '-a_srs', 'EPSG:4326'])
+logging.info('{} bytes in {:.1f}s'.format(result.size, result.seconds))
+
+# numpy array (rasterio profile) to a COG, without a temporary GeoTIFF
+rasterUtils.writeArray(tif, data, profile, tile=256)
+```
+Codec, level, predictor and tile size are set per dataset; the defaults are
+DEFLATE with a predictor on 512px tiles. Every write counts bytes_written
+and encode_seconds into the open traceUtils stages. To compare settings on
+a sample file:
+```
+python utils/rasterUtils.py data/sample.tif --codec ZSTD --tile 256
+```
+'''
+from __future__ import print_function, unicode_literals
+import argparse
+import os
+import subprocess
+import tempfile
+import time
+
+try:
+    import traceUtils
+except ImportError:
+    # optional: without it writes are not counted
+    traceUtils = None
+
+
+def _traceCount(**counts):
+    '''traceUtils.count, if traceUtils is available'''
+    if traceUtils is not None:
+        traceUtils.count(**counts)
+
+
+CODEC = 'DEFLATE'
+TILE_SIZE = 512
+# 'YES' lets GDAL pick horizontal differencing for integers and floating
+# point prediction for floats
+PREDICTOR = 'YES'
+# 'AUTO' builds overviews down to a single tile; 'NONE' skips them
+OVERVIEWS = 'AUTO'
+RESAMPLING = 'NEAREST'
+
+
+class WriteResult(object):
+    '''
+    Outcome of a COG write
+    `path` file written
+    `size` bytes written
+    `seconds` wall time spent encoding
+    '''
+    def __init__(self, path, size, seconds):
+        self.path = path
+        self.size = size
+        self.seconds = seconds
+
+    def __repr__(self):
+        return 'WriteResult({!r}, {}, {:.3f})'.format(self.path, self.size,
+                                                      self.seconds)
+
+
+def cogOptions(codec=CODEC, tile=TILE_SIZE, predictor=PREDICTOR, level=None,
+               overviews=OVERVIEWS, resampling=RESAMPLING):
+    '''
+    Creation options of the GDAL COG driver, as a dict
+    `codec` 'DEFLATE', 'ZSTD', 'LZW', ... or 'NONE'
+    `tile` tile width and height in pixels (a multiple of 16)
+    `predictor` 'YES', 'NO', 'STANDARD' or 'FLOATING_POINT'
+    `level` compression level, None for the codec's default
+    '''
+    options = {
+        'COMPRESS': codec.upper(),
+        'BLOCKSIZE': str(tile),
+        'OVERVIEWS': overviews,
+        'RESAMPLING': resampling,
+        'BIGTIFF': 'IF_SAFER',
+        'NUM_THREADS': 'ALL_CPUS',
+    }
+    if codec.upper() in ('DEFLATE', 'ZSTD', 'LZW', 'LZMA'):
+        options['PREDICTOR'] = predictor
+    if level is not None:
+        options['LEVEL'] = str(level)
+    return options
+
+
+# creation options for the tifs we upload: a Cloud-Optimized GeoTIFF,
+# internally tiled and compressed, with overviews, written in a single pass.
+# Jobs can't import utils/ (their containers only get contents/), so each
+# keeps its own copy, with the codec and tile size set per dataset.
+COG_OPTIONS = cogOptions()
+
+
+def cogArgs(**cog):
+    '''gdal_translate / gdalwarp arguments writing a COG, see cogOptions'''
+    args = ['-of', 'COG']
+    for name, value in sorted(cogOptions(**cog).items()):
+        args += ['-co', '{}={}'.format(name, value)]
+    return args
+
+
+def _written(path, start):
+    result = WriteResult(path, os.path.getsize(path), time.time() - start)
+    _traceCount(bytes_written=result.size,
+                     encode_seconds=round(result.seconds, 3))
+    return result
+
+
+def translate(src, dst, args=(), **cog):
+    '''
+    gdal_translate src into a COG at dst in a single pass
+    `src` any GDAL dataset name, e.g. 'NETCDF:"file.nc":var' or a VRT
+    `args` further gdal_translate arguments, e.g. ['-b', '1', '-a_srs', ...]
+    `cog` codec, tile, predictor, level, overviews, resampling
+    Returns a WriteResult
+    '''
+    start = time.time()
+    subprocess.check_call(['gdal_translate', '-q'] + list(args) +
+                          cogArgs(**cog) + [src, dst])
+    return _written(dst, start)
+
+
+def warp(src, dst, args=(), **cog):
+    '''gdalwarp src into a COG at dst in a single pass, as translate()'''
+    start = time.time()
+    subprocess.check_call(['gdalwarp', '-q', '-overwrite'] + list(args) +
+                          cogArgs(**cog) + [src, dst])
+    return _written(dst, start)
+
+
+def writeArray(dst, data, profile, band_names=None, **cog):
+    '''
+    Write an array as a COG without an intermediate file on disk
+    `data` 2D array for one band, or 3D (band, row, col)
+    `profile` rasterio profile (width, height, count, dtype, crs,
+        transform, nodata); driver and creation options are ignored
+    `band_names` optional band descriptions
+    Returns a WriteResult
+    '''
+    import rasterio
+    import rasterio.shutil
+    start = time.time()
+    profile = dict(profile, driver='GTiff')
+    for key in ('compress', 'tiled', 'blockxsize', 'blockysize', 'predictor',
+                'interleave'):
+        profile.pop(key, None)
+    # the COG driver can only copy a dataset, so build it in memory first
+    with rasterio.MemoryFile() as memfile:
+        with memfile.open(**profile) as mem:
+            if data.ndim == 2:
+                mem.write(data.astype(profile['dtype']), 1)
+            else:
+                mem.write(data.astype(profile['dtype']))
+            for i, name in enumerate(band_names or []):
+                mem.set_band_description(i + 1, name)
+            rasterio.shutil.copy(mem, dst, driver='COG', **cogOptions(**cog))
+    return _written(dst, start)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Size and encode time of a raster as a COG')
+    parser.add_argument('rasters', nargs='+')
+    parser.add_argument('--codec', default=CODEC)
+    parser.add_argument('--tile', type=int, default=TILE_SIZE)
+    parser.add_argument('--level', type=int)
+    parser.add_argument('--predictor', default=PREDICTOR)
+    parser.add_argument('--overviews', default=OVERVIEWS)
+    args = parser.parse_args()
+    tmp = tempfile.mkdtemp()
+    for path in args.rasters:
+        dst = os.path.join(tmp, os.path.basename(path) + '.cog.tif')
+        result = translate(path, dst, codec=args.codec, tile=args.tile,
+                           level=args.level, predictor=args.predictor,
+                           overviews=args.overviews)
+        size = os.path.getsize(path)
+        print('{}: {} -> {} bytes ({:.0%}) in {:.2f}s'.format(
+            os.path.basename(path), size, result.size,
+            result.size / float(size or 1), result.seconds))
+        os.remove(dst)
+    os.rmdir(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+'''
+cartoUploads against the local CARTO stand-in
+Run from the repository root:
+```
+python -m pytest utils/tests
+```
+'''
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import cartoUploads
+from cartoStandIn import CartoStandIn
+
+
+class InsertRowsTest(unittest.TestCase):
+    def setUp(self):
+        self.strict = cartoUploads.STRICT
+        cartoUploads.STRICT = False
+        self.server = CartoStandIn().start()
+        self.client = cartoUploads.CartoClient('user', 'key',
+                                               url=self.server.url)
+        self.client.createTable('t', {'id': 'numeric', 'name': 'text'})
+        self.client.createIndex('t', 'id', unique=True)
+
+    def tearDown(self):
+        self.server.stop()
+        cartoUploads.STRICT = self.strict
+
+    def assertFailedCoversMissing(self, rows, result):
+        stored = set(self.server.query('SELECT id, name FROM t'))
+        missing = set(i for i, row in enumerate(rows)
+                      if tuple(row) not in stored)
+        failed = set(i for start, stop in result.failed
+                     for i in range(start, stop))
+        self.assertTrue(missing)
+        self.assertEqual(missing, failed)
+
+    def test_failed_block(self):
+        # rows 2 and 3 repeat an id, so their block fails; the rest go in
+        rows = [[0, 'a'], [1, 'b'], [2, 'c'], [2, 'd'], [4, 'e'], [5, 'f'],
+                [6, 'g']]
+        result = self.client.insertRows('t', ['id', 'name'],
+                                        ['numeric', 'text'], rows,
+                                        blocksize=2)
+        self.assertFalse(result)
+        self.assertEqual(result.failed, [(2, 4)])
+        self.assertEqual(result.rows, 5)
+        self.assertFailedCoversMissing(rows, result)
+
+    def test_failed_block_pipelined(self):
+        rows = [[i, str(i)] for i in range(20)] + [[3, 'again']]
+        result = self.client.insertRows('t', ['id', 'name'],
+                                        ['numeric', 'text'], rows,
+                                        blocksize=3, workers=3)
+        self.assertFalse(result)
+        self.assertFailedCoversMissing(rows, result)
+
+    def test_upsert(self):
+        self.client.insertRows('t', ['id', 'name'], ['numeric', 'text'],
+                               [[0, 'a'], [1, 'b']])
+        result = self.client.insertRows(
+            't', ['id', 'name'], ['numeric', 'text'], [[1, 'c'], [2, 'd']],
+            on_conflict='id', update=True)
+        # overwritten rows count as written
+        self.assertEqual(result.inserted, 2)
+        self.assertEqual(
+            self.server.query('SELECT id, name FROM t ORDER BY id'),
+            [(0, 'a'), (1, 'c'), (2, 'd')])
+
+    def test_upsert_only_targets(self):
+        # nothing besides the conflict target to overwrite: skip instead
+        result = self.client.insertRows('t', ['id'], ['numeric'],
+                                        [[0], [1], [1]], on_conflict='id',
+                                        update=True)
+        self.assertTrue(result)
+        self.assertEqual(result.inserted, 2)
+
+
+class CatalogTest(unittest.TestCase):
+    '''Tables and columns created outside the client are found'''
+    def setUp(self):
+        self.server = CartoStandIn().start()
+        self.client = cartoUploads.CartoClient('user', 'key',
+                                               url=self.server.url)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_created_elsewhere(self):
+        self.assertFalse(self.client.tableExists('t'))
+        self.client.post('CREATE TABLE "t" (id numeric)')
+        self.assertTrue(self.client.tableExists('t'))
+        self.assertEqual(self.client.catalog.dtypes('t', ['id']), ['numeric'])
+        self.client.post('ALTER TABLE "t" ADD COLUMN name text')
+        self.assertEqual(self.client.catalog.dtypes('t', ['id', 'name']),
+                         ['numeric', 'text'])
+
+    def test_ids_cast(self):
+        self.client.createTable('t', {'day': 'timestamp', 'v': 'numeric'})
+        self.client.insertRows('t', ['day', 'v'], ['timestamp', 'numeric'],
+                               [['2020-01-01', 1], ['2020-01-02', 2]])
+        rows = self.client.selectRowsByIDs('t', ['2020-01-02'], 'v',
+                                           id_field='day')
+        self.assertEqual(rows, [{'v': 2}])
+        # compared as timestamps, not text
+        self.assertTrue(self.server.statements[-1].endswith(
+            "day = ANY(ARRAY['2020-01-02']::timestamp[])"))
+
+
+class NullTest(unittest.TestCase):
+    '''NaN, pandas' missing value, is stored as NULL by both paths'''
+    def setUp(self):
+        self.strict = cartoUploads.STRICT
+        cartoUploads.STRICT = False
+        self.server = CartoStandIn().start()
+        self.client = cartoUploads.CartoClient('user', 'key',
+                                               url=self.server.url)
+        self.client.createTable('t', {'v': 'numeric', 'name': 'text',
+                                      'the_geom': 'geometry'})
+        self.fields = ['v', 'name', 'the_geom']
+        self.dtypes = ['numeric', 'text', 'geometry']
+
+    def tearDown(self):
+        self.server.stop()
+        cartoUploads.STRICT = self.strict
+
+    def stored(self):
+        return self.server.query(
+            'SELECT v, name, the_geom IS NULL FROM t ORDER BY cartodb_id')
+
+    def test_insert(self):
+        try:
+            from shapely.geometry import Point
+        except ImportError:
+            raise unittest.SkipTest('shapely not installed')
+        nan = float('nan')
+        rows = [[1, 'a', Point(1, 2)], [nan, nan, nan]]
+        self.assertTrue(self.client.insertRows('t', self.fields, self.dtypes,
+                                               rows))
+        self.assertEqual(self.stored(), [(1, 'a', 0), (None, None, 1)])
+
+    def test_copy(self):
+        nan = float('nan')
+        rows = [[1, 'a', {'type': 'Point', 'coordinates': [1, 2]}],
+                [nan, nan, nan]]
+        self.assertEqual(self.client.copyRows('t', self.fields, self.dtypes,
+                                              rows), 2)
+        self.assertEqual(self.stored(), [(1, 'a', 0), (None, None, 1)])
+
+
+if __name__ == '__main__':
+    unittest.main()
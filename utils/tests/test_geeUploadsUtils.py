@@ -0,0 +1,142 @@
+'''
+Staging of sources in geeUploadsUtils, against an in-memory bucket
+Run from the repository root:
+```
+python -m pytest utils/tests
+```
+The Earth Engine, Cloud Storage and rasterio clients are replaced by
+stand-ins when they are not installed; no request leaves the process.
+'''
+import os
+import shutil
+import sys
+import tempfile
+import types
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _standIns():
+    '''Modules geeUploadsUtils imports, for environments without them'''
+    try:
+        import ee
+    except ImportError:
+        ee = types.ModuleType('ee')
+        state = types.SimpleNamespace(COMPLETED='COMPLETED', FAILED='FAILED',
+                                      CANCELLED='CANCELLED')
+        ee.batch = types.SimpleNamespace(
+            Task=types.SimpleNamespace(State=state))
+        sys.modules['ee'] = ee
+    try:
+        from google.cloud import storage
+    except ImportError:
+        google = sys.modules.setdefault('google', types.ModuleType('google'))
+        cloud = types.ModuleType('google.cloud')
+        cloud.storage = types.ModuleType('google.cloud.storage')
+        google.cloud = cloud
+        sys.modules['google.cloud'] = cloud
+        sys.modules['google.cloud.storage'] = cloud.storage
+    try:
+        import rasterio
+    except ImportError:
+        sys.modules['rasterio'] = types.ModuleType('rasterio')
+
+
+_standIns()
+import geeUploadsUtils
+
+
+class FakeAcl(object):
+    '''Object ACL, read from the bucket's set of public objects'''
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+
+    def all(self):
+        self.bucket.calls.append(('acl', self.name))
+        roles = set(['READER']) if self.name in self.bucket.public else set()
+        return types.SimpleNamespace(get_roles=lambda: roles)
+
+
+class FakeBlob(object):
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.metadata = bucket.metadata.get(name)
+        self.acl = FakeAcl(bucket, name)
+
+    def upload_from_filename(self, path, predefined_acl=None):
+        with open(path, 'rb') as f:
+            self.bucket.objects[self.name] = f.read()
+        self.bucket.metadata[self.name] = self.metadata
+        if predefined_acl == 'publicRead':
+            self.bucket.public.add(self.name)
+        self.bucket.calls.append(('upload', self.name))
+
+    def make_public(self):
+        self.bucket.public.add(self.name)
+        self.bucket.calls.append(('make_public', self.name))
+
+
+class FakeBucket(object):
+    def __init__(self):
+        self.objects = {}
+        self.metadata = {}
+        self.public = set()
+        self.calls = []
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+    def get_blob(self, name):
+        return FakeBlob(self, name) if name in self.objects else None
+
+
+class StageSourcesTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.source = os.path.join(self.tmp, 'image.tif')
+        with open(self.source, 'wb') as f:
+            f.write(b'not really a tif')
+        self.bucket = FakeBucket()
+        # skip __init__, which sets up credentials
+        self.asset = geeUploadsUtils.assetManagement.__new__(
+            geeUploadsUtils.assetManagement)
+        self.asset.meta = {'sources': [self.source], 'gcsBucket': 'bucket',
+                           'collectionAsset': 'users/test/collection'}
+        self.asset.imageNames = self.asset.getImageName()
+        self.asset.sourcePaths = dict(zip(self.asset.imageNames,
+                                          self.asset.meta['sources']))
+        self.asset.hashes = {}
+        self.asset.cache = {}
+        self.asset.gcsBucket = self.bucket
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_stage_twice(self):
+        name = 'users/test/collection/image.tif'
+        first = self.asset.stageSources()
+        self.assertEqual(self.bucket.calls, [('upload', name)])
+        self.assertIn(name, self.bucket.public)
+        del self.bucket.calls[:]
+        second = self.asset.stageSources()
+        self.assertEqual(first, second)
+        # reused, and already public: the ACL is read but not written
+        self.assertEqual(self.bucket.calls, [('acl', name)])
+
+    def test_restage_private(self):
+        name = 'users/test/collection/image.tif'
+        self.asset.stageSources()
+        # as if the previous run had stopped before setting its ACL
+        self.bucket.public.discard(name)
+        del self.bucket.calls[:]
+        self.asset.stageSources()
+        self.assertEqual(self.bucket.calls,
+                         [('acl', name), ('make_public', name)])
+        self.assertIn(name, self.bucket.public)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,234 @@
+'''
+Stage-level tracing of a job run
+Example:
+```
+import traceUtils
+
+@traceUtils.traced()
+def fetch(new_dates):
+    ...
+
+with traceUtils.stage('convert') as s:
+    tifs = convert(files)
+    s.add(assets=len(tifs), bytes_written=traceUtils.fileBytes(tifs))
+```
+Each stage records wall and CPU seconds, the process's peak RSS and
+counters: bytes_downloaded (fetchUtils), rows and bytes_uploaded (CARTO
+requests through cartoUploads, GCS staging in geeUploadsUtils) and whatever
+the stage adds itself. The shared helpers also open stages of their own,
+nested in the job's: fetch (fetchUtils.fetch and download), carto_insert
+and carto_copy (cartoUploads insertRows and copyRows), gcs_staging and
+gee_ingestion (geeUploadsUtils).
+
+Tracing is off unless the TRACE_DIR environment variable is set or enable()
+is called; until then stages cost nothing, log nothing and record nothing.
+Once enabled, the stages are written as one JSON report per run to
+TRACE_DIR (by default logs/) when the process exits, or by report().
+'''
+from __future__ import unicode_literals
+import atexit
+import datetime
+import functools
+import io
+import json
+import logging
+import os
+import sys
+import threading
+import time
+try:
+    import resource
+except ImportError:
+    resource = None
+
+TRACE_DIR = os.environ.get('TRACE_DIR') or 'logs'
+
+_lock = threading.Lock()
+# stages in progress, outermost first; counts go to all of them, from any
+# thread, so a stage includes the work of its nested stages and pools
+_open = []
+_stages = []
+_started = time.time()
+_reporting = []
+_enabled = [False]
+
+
+def enable(trace_dir=None, at_exit=True):
+    '''
+    Turn tracing on for the rest of the process
+    `trace_dir` folder for the report, by default TRACE_DIR
+    `at_exit` write the report when the process exits; off for callers that
+    collect stages() themselves. A forked process exits without atexit
+    hooks and has to call report() itself
+    '''
+    global TRACE_DIR
+    if trace_dir:
+        TRACE_DIR = trace_dir
+    _enabled[0] = True
+    if at_exit and not _reporting:
+        _reporting.append(atexit.register(report))
+
+
+def enabled():
+    '''Check if tracing is on'''
+    return _enabled[0]
+
+
+def _peakRss():
+    '''Peak resident set size of the process so far, in bytes'''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def count(**counts):
+    '''Add to the counters of every stage in progress, if any'''
+    if not _open:
+        return
+    with _lock:
+        for s in _open:
+            s.add(**counts)
+
+
+def fileBytes(paths):
+    '''Total size of existing files, for bytes_written'''
+    if isinstance(paths, str):
+        paths = [paths]
+    return sum(os.path.getsize(p) for p in paths if os.path.exists(p))
+
+
+def _cartoSink(record):
+    '''cartoUploads instrumentation sink feeding the open stages'''
+    counts = {'bytes_uploaded': record['request_bytes'] or 0}
+    if record['kind'] in ('INSERT', 'COPY') and record['rows']:
+        counts['rows'] = record['rows']
+    count(**counts)
+
+
+def _hookCarto():
+    carto = sys.modules.get('cartoUploads')
+    if carto is not None and _cartoSink not in carto.SINKS:
+        carto.SINKS.append(_cartoSink)
+
+
+class Stage(object):
+    '''
+    One traced stage of a run; use through stage() or traced()
+    `name` e.g. 'fetch', 'convert', 'upload', 'updateResourceWatch'
+    `counts` counters added with add() or count()
+    '''
+    def __init__(self, name, **attrs):
+        self.name = name
+        self.attrs = attrs
+        self.counts = {}
+        self.ok = None
+
+    def add(self, **counts):
+        '''Add to this stage's counters'''
+        for k, v in counts.items():
+            self.counts[k] = self.counts.get(k, 0) + v
+
+    def __enter__(self):
+        self.traced = _enabled[0]
+        if not self.traced:
+            return self
+        _hookCarto()
+        self._wall = time.time()
+        self._cpu = time.process_time()
+        with _lock:
+            _open.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if not self.traced:
+            return False
+        with _lock:
+            _open.remove(self)
+        self.ok = exc_type is None
+        self.record = dict(self.attrs, **{
+            'stage': self.name,
+            'start': self._wall,
+            'wall_seconds': round(time.time() - self._wall, 3),
+            'cpu_seconds': round(time.process_time() - self._cpu, 3),
+            'peak_rss_bytes': _peakRss(),
+            'ok': self.ok,
+        })
+        self.record.update(self.counts)
+        with _lock:
+            _stages.append(self.record)
+        logging.info('Stage {} took {:.1f}s ({:.1f}s CPU){}'.format(
+            self.name, self.record['wall_seconds'],
+            self.record['cpu_seconds'],
+            ''.join(', {} {}'.format(k, v)
+                    for k, v in sorted(self.counts.items()))))
+        return False
+
+
+def stage(name, **attrs):
+    '''Context manager tracing the enclosed block as stage `name`'''
+    return Stage(name, **attrs)
+
+
+def traced(name=None):
+    '''Decorator tracing each call as a stage, by default named after fn'''
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled[0]:
+                return fn(*args, **kwargs)
+            with Stage(name or fn.__name__):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def stages():
+    '''Records of the stages finished so far'''
+    with _lock:
+        return list(_stages)
+
+
+def reset():
+    '''
+    Forget the stages finished so far and start timing a new run, e.g.
+    between runs in one process or in a process forked for a run
+    '''
+    global _started
+    with _lock:
+        del _stages[:]
+        _started = time.time()
+
+
+def report(path=None):
+    '''
+    Write the run's stages as JSON; returns the path written, or None if
+    nothing was traced
+    `path` by default TRACE_DIR/<job name>-<start time>.json
+    '''
+    records = stages()
+    if not records:
+        return None
+    job = os.environ.get('NAME') or os.path.basename(os.getcwd())
+    started = datetime.datetime.utcfromtimestamp(_started)
+    if path is None:
+        path = os.path.join(TRACE_DIR, '{}-{}.json'.format(
+            job, started.strftime('%Y%m%dT%H%M%S')))
+    if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    run = {
+        'job': job,
+        'started': started.isoformat(),
+        'wall_seconds': round(time.time() - _started, 3),
+        'cpu_seconds': round(time.process_time(), 3),
+        'peak_rss_bytes': _peakRss(),
+        'stages': records,
+    }
+    with io.open(path, 'w', encoding='utf-8') as f:
+        f.write(json.dumps(run, indent=2))
+    return path
+
+
+if os.environ.get('TRACE_DIR'):
+    enable()